@@ -0,0 +1,327 @@
+"""Block device topology from /proc, /sys, and /dev, without subprocesses
+"""
+
+# devprobe.py
+# Used by drivelayout.py and file_keeper/file_db.py instead of mount,
+# blkid, fdisk, and lsblk.  Roots can be overridden to probe a fixture
+# tree, see tests/test_devprobe.py.
+
+import os
+import re
+
+SECTOR = 512  # /sys/class/block/*/size is always in 512 byte sectors
+
+
+class Roots(object):
+    """Where to find procfs, sysfs, /dev, and udev's database"""
+
+    def __init__(
+        self, proc='/proc', sys='/sys', dev='/dev', udev='/run/udev'
+    ):
+        self.proc = proc
+        self.sys = sys
+        self.dev = dev
+        self.udev = udev
+
+
+def read_file(path, default=None):
+    """read_file - stripped text of a (sysfs) file, or default if missing
+
+    :param str path: file to read
+    :param default: value if path can't be read
+    """
+    try:
+        with open(path) as data:
+            return data.read().strip()
+    except (OSError, UnicodeDecodeError):
+        return default
+
+
+def unescape(text):
+    """unescape - undo \\040 style octal escapes used in mountinfo"""
+    return re.sub(r'\\([0-7]{3})', lambda m: chr(int(m.group(1), 8)), text)
+
+
+def unhex(text):
+    """unhex - undo \\x20 style escapes used in /dev/disk/by-label names"""
+    return re.sub(
+        r'\\x([0-9a-fA-F]{2})', lambda m: chr(int(m.group(1), 16)), text
+    )
+
+
+def read_mountinfo(roots=None):
+    """read_mountinfo - parse /proc/self/mountinfo
+
+    :param Roots roots: where to look
+    :return: [{majmin, root, mountpoint, fstype, source}] in mount order
+    """
+    roots = roots or Roots()
+    ans = []
+    text = read_file(os.path.join(roots.proc, 'self', 'mountinfo'), '')
+    for line in text.split('\n'):
+        if ' - ' not in line:
+            continue
+        pre, post = line.split(' - ', 1)
+        pre, post = pre.split(), post.split()
+        ans.append(
+            dict(
+                majmin=pre[2],
+                root=unescape(pre[3]),
+                mountpoint=unescape(pre[4]),
+                fstype=post[0],
+                source=unescape(post[1]) if len(post) > 1 else None,
+            )
+        )
+    return ans
+
+
+def read_links(path):
+    """read_links - {device name: link name} for /dev/disk/by-* links
+
+    :param str path: directory of symlinks
+    """
+    ans = {}
+    try:
+        names = os.listdir(path)
+    except OSError:
+        return ans
+    for name in names:
+        try:
+            target = os.readlink(os.path.join(path, name))
+        except OSError:
+            continue
+        ans[os.path.basename(target)] = unhex(name)
+    return ans
+
+
+def read_udev(roots, majmin):
+    """read_udev - E: properties from udev's database for a device
+
+    :param Roots roots: where to look
+    :param str majmin: device's major:minor
+    :return: {property: value}, empty if udev data isn't available
+    """
+    ans = {}
+    text = read_file(os.path.join(roots.udev, 'data', 'b' + majmin), '')
+    for line in text.split('\n'):
+        if line.startswith('E:') and '=' in line:
+            key, val = line[2:].split('=', 1)
+            ans[key] = val
+    return ans
+
+
+def source_majmin(roots, source):
+    """source_majmin - major:minor of a mount's /dev source, if any
+
+    :param Roots roots: where to look
+    :param str source: mountinfo source, e.g. /dev/sdb1
+    :return: major:minor, or None if source isn't a block device
+    """
+    if not source or not source.startswith('/dev/'):
+        return None
+    path = os.path.join(roots.dev, os.path.relpath(source, '/dev'))
+    name = os.path.basename(os.path.realpath(path))  # /dev/mapper/x links
+    return read_file(os.path.join(roots.sys, 'class', 'block', name, 'dev'))
+
+
+def read_mounts(roots=None):
+    """read_mounts - mount points and filesystem types by major:minor
+
+    btrfs and other filesystems on anonymous devices have a 0:N
+    major:minor in mountinfo, so they're keyed by their source's device
+    instead, where it is one.
+
+    :param Roots roots: where to look
+    :return: {majmin: [mount point]}, {majmin: fstype}, ignoring bind
+        mounts of subdirectories
+    """
+    roots = roots or Roots()
+    mounts = {}
+    fstypes = {}
+    for mount in read_mountinfo(roots):
+        if mount['root'] != '/':  # bind mounts of subdirs
+            continue
+        majmin = mount['majmin']
+        if majmin.startswith('0:'):
+            majmin = source_majmin(roots, mount['source']) or majmin
+        mounts.setdefault(majmin, []).append(mount['mountpoint'])
+        fstypes.setdefault(majmin, mount['fstype'])
+    return mounts, fstypes
+
+
+def read_partitions(roots=None):
+    """read_partitions - /proc/partitions as {name: size in 1K blocks}
+
+    :param Roots roots: where to look
+    """
+    roots = roots or Roots()
+    ans = {}
+    text = read_file(os.path.join(roots.proc, 'partitions'), '')
+    for line in text.split('\n'):
+        fields = line.split()
+        if len(fields) == 4 and fields[0].isdigit():
+            ans[fields[3]] = int(fields[2])
+    return ans
+
+
+def probe(roots=None, names=None):
+    """probe - describe all block devices
+
+    Reads each source once: /sys/class/block for devices, sizes,
+    rotational, partitions, and holders / slaves (LVM / dm), mountinfo
+    for mount points, /dev/disk/by-* for UUIDs and labels, and udev's
+    database, if present, for filesystem types, models, and serials.
+
+    :param Roots roots: where to look
+    :param names: only probe these devices, and partitions' disks, e.g.
+        ones that changed, default all
+    :return: {name: {name, path, majmin, size (bytes), rotational,
+        removable, readonly, type, parent, holders, slaves, model,
+        serial, uuid, partuuid, label, fstype, mountpoints}}
+    """
+    roots = roots or Roots()
+    block = os.path.join(roots.sys, 'class', 'block')
+    by_uuid = read_links(os.path.join(roots.dev, 'disk', 'by-uuid'))
+    by_label = read_links(os.path.join(roots.dev, 'disk', 'by-label'))
+    by_partuuid = read_links(os.path.join(roots.dev, 'disk', 'by-partuuid'))
+    mounts, fstypes = read_mounts(roots)
+
+    wanted = names
+    names = sorted(listdir(block))
+    if wanted is not None:
+        wanted = set(wanted)
+        for name in list(wanted):
+            sysdir = os.path.join(block, name)
+            if os.path.exists(os.path.join(sysdir, 'partition')):
+                parent = os.path.dirname(os.path.realpath(sysdir))
+                wanted.add(os.path.basename(parent))
+        names = [i for i in names if i in wanted]
+    devs = {}
+    for name in names:
+        sysdir = os.path.join(block, name)
+        majmin = read_file(os.path.join(sysdir, 'dev'), '')
+        size = read_file(os.path.join(sysdir, 'size'))
+        rotational = read_file(os.path.join(sysdir, 'queue', 'rotational'))
+        dev = dict(
+            name=name,
+            path=os.path.join(roots.dev, name),
+            majmin=majmin,
+            size=int(size) * SECTOR if size else None,
+            rotational=rotational == '1',
+            removable=read_file(os.path.join(sysdir, 'removable')) == '1',
+            readonly=read_file(os.path.join(sysdir, 'ro')) == '1',
+            type='disk',
+            parent=None,
+            holders=sorted(listdir(os.path.join(sysdir, 'holders'))),
+            slaves=sorted(listdir(os.path.join(sysdir, 'slaves'))),
+            model=read_file(os.path.join(sysdir, 'device', 'model')),
+            serial=read_file(os.path.join(sysdir, 'device', 'serial')),
+            uuid=by_uuid.get(name),
+            partuuid=by_partuuid.get(name),
+            label=by_label.get(name),
+            fstype=fstypes.get(majmin),
+            mountpoints=mounts.get(majmin, []),
+        )
+        dm_name = read_file(os.path.join(sysdir, 'dm', 'name'))
+        if dm_name:
+            dev['path'] = os.path.join(roots.dev, 'mapper', dm_name)
+            dev['type'] = 'lvm' if dev['slaves'] else 'dm'
+        elif name.startswith('loop'):
+            dev['type'] = 'loop'
+        elif name.startswith('sr'):
+            dev['type'] = 'rom'
+        udev = read_udev(roots, majmin)
+        dev['fstype'] = dev['fstype'] or udev.get('ID_FS_TYPE')
+        dev['uuid'] = dev['uuid'] or udev.get('ID_FS_UUID')
+        dev['label'] = dev['label'] or udev.get('ID_FS_LABEL')
+        dev['model'] = dev['model'] or udev.get('ID_MODEL')
+        dev['serial'] = dev['serial'] or udev.get(
+            'ID_SERIAL_SHORT', udev.get('ID_SERIAL')
+        )
+        devs[name] = dev
+
+    # partitions' sysfs directories are in their disk's directory
+    for name, dev in devs.items():
+        sysdir = os.path.join(block, name)
+        if os.path.exists(os.path.join(sysdir, 'partition')):
+            dev['type'] = 'part'
+            parent = os.path.dirname(os.path.realpath(sysdir))
+            parent = os.path.basename(parent)
+            if parent in devs:
+                dev['parent'] = parent
+                for key in 'rotational', 'model', 'serial':
+                    if not dev[key]:
+                        dev[key] = devs[parent][key]
+    return devs
+
+
+def listdir(path):
+    """listdir - os.listdir(), but empty if path doesn't exist"""
+    try:
+        return os.listdir(path)
+    except OSError:
+        return []
+
+
+def lsblk_size(size):
+    """lsblk_size - size in bytes as lsblk shows it, e.g. 465.8G"""
+    if size is None:
+        return None
+    units = 'BKMGTPE'
+    unit = 0
+    value = float(size)
+    while value >= 1024 and unit < len(units) - 1:
+        value /= 1024
+        unit += 1
+    text = ('%.1f' % value).rstrip('0').rstrip('.')
+    return text + units[unit]
+
+
+def as_lsblk(devs):
+    """as_lsblk - probe() results in `lsblk --json --output-all` form
+
+    Partitions and holders (dm / LVM devices) are children, as in lsblk.
+
+    :param dict devs: from probe()
+    :return: {'blockdevices': [device tree]}
+    """
+
+    def node(dev, pkname=None):
+        return dict(
+            name=dev['name'],
+            path=dev['path'],
+            uuid=dev['uuid'],
+            partuuid=dev['partuuid'],
+            label=dev['label'],
+            fstype=dev['fstype'],
+            model=dev['model'],
+            serial=dev['serial'],
+            size=lsblk_size(dev['size']),
+            rota=dev['rotational'],
+            rm=dev['removable'],
+            ro=dev['readonly'],
+            type=dev['type'],
+            pkname=pkname,
+            mountpoint=(dev['mountpoints'] or [None])[0],
+            mountpoints=dev['mountpoints'] or [None],
+            children=[
+                node(devs[i], pkname=dev['name'])
+                for i in children(devs, dev['name'])
+            ],
+            **{'maj:min': dev['majmin']}
+        )
+
+    return {
+        'blockdevices': [
+            node(dev)
+            for dev in devs.values()
+            if not dev['parent'] and not dev['slaves']
+        ]
+    }
+
+
+def children(devs, name):
+    """children - names of devices on device name: partitions, holders"""
+    ans = [i for i, dev in devs.items() if dev['parent'] == name]
+    ans.extend(i for i in devs[name]['holders'] if i in devs)
+    return sorted(ans)
@@ -0,0 +1,340 @@
+"""Fleet drive inventory from drivelayout.py snapshots
+"""
+
+# drivefleet.py
+# Loads drivelayout.py --opml / --json output collected from many hosts
+# into SQLite, one row per partition per snapshot, and answers questions
+# like where a UUID is now, which hosts are low on space, and which
+# drives have moved between hosts.
+#
+#   drivefleet.py --db fleet.db --ingest snapshots/
+#   drivefleet.py --db fleet.db --where 0737f555-dccf-4196-8dc3-6c15c041a303
+#   drivefleet.py --db fleet.db --low-free 10
+#   drivefleet.py --db fleet.db --moved
+
+from __future__ import print_function
+
+import hashlib
+import json
+import optparse
+import os
+import re
+import sqlite3
+import sys
+import time
+
+from xml.etree import ElementTree as ET
+
+SCHEMA = """
+create table if not exists snapshot (
+    snapshot integer primary key,
+    host text not null,
+    time text not null,  -- ISO 8601, local time of the host
+    last_seen text not null,  -- time of latest identical snapshot
+    source text,  -- file it was loaded from
+    digest text not null  -- of its partitions, see snapshot_digest()
+);
+create unique index if not exists idx_snapshot_host_time
+    on snapshot(host, time);
+create table if not exists collapsed (  -- identical to an earlier snapshot
+    host text not null,
+    time text not null,
+    snapshot integer not null references snapshot(snapshot),
+    source text,
+    primary key (host, time)
+);
+create table if not exists part (
+    snapshot integer not null references snapshot(snapshot),
+    host text not null,
+    device text not null,
+    part text not null,
+    uuid text,
+    label text,
+    type text,
+    size text,
+    mounted_on text,
+    free text,
+    free_pct integer,
+    resv text,
+    distrib text,
+    files text  -- JSON list
+);
+create index if not exists idx_part_snapshot on part(snapshot);
+create index if not exists idx_part_uuid on part(uuid, host);
+create index if not exists idx_part_free_pct on part(free_pct);
+create view if not exists latest as
+    select part.*, snapshot.time, snapshot.last_seen
+      from part join snapshot using (snapshot, host)
+     where snapshot.snapshot = (
+        select s.snapshot from snapshot s
+         where s.host = snapshot.host order by s.time desc limit 1);
+"""
+
+FIELDS = (  # part column, drivelayout key
+    ('uuid', 'UUID'), ('label', 'LABEL'), ('type', 'TYPE'), ('size', 'SIZE'),
+    ('mounted_on', 'ON'), ('free', 'FREE'), ('resv', 'RESV'),
+    ('distrib', 'DISTRIB_DESCRIPTION'),
+)
+
+def connect(path):
+    """connect - open the inventory, creating tables as needed
+
+    :param str path: SQLite file
+    :return: sqlite3.Connection
+    """
+
+    con = sqlite3.connect(path)
+    con.row_factory = sqlite3.Row
+    con.executescript(SCHEMA)
+    return con
+
+def read_opml(path):
+    """read_opml - parse drivelayout.py --opml output
+
+    :param str path: OPML file
+    :return: host, time (ISO 8601), devs as from stat_devs() plus the
+        desc_devs_detail() keys, FILES only the first ten
+    """
+
+    top = ET.parse(path).getroot().find('body/outline')
+    title = top.get('text')  # Drives on HOST Sun May 25 12:00:00 2008
+    match = re.match(r'Drives on (\S+) (.*)$', title)
+    host = match.group(1)
+    when = time.strftime('%Y-%m-%dT%H:%M:%S',
+                         time.strptime(match.group(2).strip()))
+    devs = {}
+    for dev in top.findall('outline'):
+        dev_name = dev.get('text').split()[0]
+        devs[dev_name] = {}
+        for part in dev.findall('outline'):
+            part_data = devs[dev_name][part.get('text').split()[0]] = {}
+            for attr in part.findall('outline'):
+                key, val = attr.get('text').split(': ', 1)
+                part_data[key] = val.split() if key == 'FILES' else val
+    return host, when, devs
+
+def read_json(path):
+    """read_json - parse drivelayout.py --json output, JSON or NDJSON
+
+    :param str path: JSON file
+    :return: host, time, devs, see read_opml()
+    """
+
+    with open(path) as inp:
+        if path.endswith('.ndjson'):
+            recs = [json.loads(line) for line in inp if line.strip()]
+            host = [i for i in recs if i['record'] == 'host'][0]
+            devices = [i for i in recs if i['record'] == 'device']
+        else:
+            host = json.load(inp)
+            devices = host['devices']
+    devs = dict((i['device'], i['partitions']) for i in devices)
+    return host['host'], host['time'], devs
+
+def read_snapshot(path):
+    """read_snapshot - read_opml() or read_json() by file extension
+
+    :param str path: snapshot file
+    :return: host, time, devs, None if path isn't a snapshot, or False
+        if it can't be read, which is reported on stderr
+    """
+
+    try:
+        if path.endswith('.opml'):
+            return read_opml(path)
+        if path.endswith(('.json', '.ndjson')):
+            return read_json(path)
+    except (OSError, ET.ParseError, ValueError, KeyError, IndexError,
+            AttributeError, TypeError) as err:
+        sys.stderr.write("Skipping %s: %s\n" % (path, err))
+        return False
+    return None
+
+def part_rows(host, devs):
+    """part_rows - part table rows, without snapshot, for devs
+
+    :param str host: host name
+    :param dict devs: see read_opml()
+    :return: list of tuples, in part's column order after snapshot
+    """
+
+    rows = []
+    for dev in sorted(i for i in devs if not i.startswith('_:')):
+        for part in sorted(i for i in devs[dev] if not i.startswith('_:')):
+            data = devs[dev][part]
+            free_pct = re.search(r'(\d+)%', data.get('FREE') or '')
+            rows.append(
+                (host, dev, part)
+                + tuple(data.get(key) for col, key in FIELDS[:6])
+                + (int(free_pct.group(1)) if free_pct else None,)
+                + tuple(data.get(key) for col, key in FIELDS[6:])
+                + (json.dumps(data.get('FILES', [])),))
+    return rows
+
+def snapshot_digest(rows):
+    """snapshot_digest - identical for snapshots with the same content
+
+    :param list rows: from part_rows()
+    """
+
+    return hashlib.sha1(json.dumps(rows).encode('utf-8')).hexdigest()
+
+def ingest(con, paths):
+    """ingest - load snapshot files / directories of them
+
+    Files are loaded in time order, per host.  A snapshot identical to
+    its host's previous one only updates that one's last_seen, and is
+    recorded in the collapsed table.  A file already loaded or collapsed
+    (same host and time) is skipped, so the same directory can be
+    ingested again as snapshots are added to it.  Files that can't be
+    read are counted as bad and otherwise ignored.
+
+    :param sqlite3.Connection con: from connect()
+    :param list paths: files, or directories to search for *.opml,
+        *.json, and *.ndjson
+    :return: dict of counts, loaded, unchanged, skipped, bad, parts
+    """
+
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for dirpath, dirnames, filenames in os.walk(path):
+                files.extend(os.path.join(dirpath, i) for i in filenames)
+        else:
+            files.append(path)
+    n = dict(loaded=0, unchanged=0, skipped=0, bad=0, parts=0)
+    snapshots = []
+    for path in files:
+        snapshot = read_snapshot(path)
+        if snapshot:
+            snapshots.append(snapshot + (path,))
+        elif snapshot is False:
+            n['bad'] += 1
+    snapshots.sort(key=lambda i: (i[0], i[1]))
+
+    cols = ', '.join(['snapshot', 'host', 'device', 'part']
+                     + [i[0] for i in FIELDS[:6]] + ['free_pct']
+                     + [i[0] for i in FIELDS[6:]] + ['files'])
+    insert = "insert into part (%s) values (%s)" % (
+        cols, ', '.join('?' * len(cols.split(', '))))
+    with con:  # one transaction
+        for host, when, devs, path in snapshots:
+            if con.execute(
+                    "select 1 from snapshot where host = ? and time = ? "
+                    "union all select 1 from collapsed "
+                    "where host = ? and time = ?",
+                    [host, when] * 2).fetchone():
+                n['skipped'] += 1
+                continue
+            rows = part_rows(host, devs)
+            digest = snapshot_digest(rows)
+            prev = con.execute(
+                "select snapshot, digest from snapshot where host = ? "
+                "and time < ? order by time desc limit 1",
+                [host, when]).fetchone()
+            if prev and prev['digest'] == digest:
+                con.execute(
+                    "update snapshot set last_seen = max(last_seen, ?) "
+                    "where snapshot = ?", [when, prev['snapshot']])
+                con.execute(
+                    "insert into collapsed (host, time, snapshot, source) "
+                    "values (?, ?, ?, ?)",
+                    [host, when, prev['snapshot'], path])
+                n['unchanged'] += 1
+                continue
+            snapshot = con.execute(
+                "insert into snapshot (host, time, last_seen, source, digest) "
+                "values (?, ?, ?, ?, ?)",
+                [host, when, when, path, digest]).lastrowid
+            con.executemany(insert, [(snapshot,) + i for i in rows])
+            n['loaded'] += 1
+            n['parts'] += len(rows)
+    return n
+
+def where(con, uuid):
+    """where - where a filesystem UUID was last seen
+
+    :param sqlite3.Connection con: from connect()
+    :param str uuid: filesystem UUID
+    :return: rows, host, device, part, mounted_on, time, last_seen,
+        newest first
+    """
+
+    return con.execute(
+        "select host, device, part, mounted_on, max(time) as time, "
+        "max(last_seen) as last_seen "
+        "from part join snapshot using (snapshot, host) where uuid = ? "
+        "group by host, device, part order by last_seen desc",
+        [uuid]).fetchall()
+
+def low_free(con, pct):
+    """low_free - mounted partitions with less than pct% free, as of each
+    host's latest snapshot
+
+    :param sqlite3.Connection con: from connect()
+    :param int pct: threshold
+    :return: rows, host, part, mounted_on, free, time
+    """
+
+    return con.execute(
+        "select host, part, mounted_on, free, time from latest "
+        "where free_pct < ? order by free_pct, host, part", [pct]).fetchall()
+
+def moved(con):
+    """moved - UUIDs seen on more than one host
+
+    :param sqlite3.Connection con: from connect()
+    :return: rows, uuid, label, hosts (host=last seen, ...), latest
+        host first
+    """
+
+    return con.execute(
+        "select uuid, max(label) as label, group_concat(host || '=' || seen, "
+        "', ') as hosts from (select uuid, label, host, "
+        "max(last_seen) as seen from part "
+        "join snapshot using (snapshot, host) where uuid is not null "
+        "group by uuid, host order by uuid, seen desc) "
+        "group by uuid having count(*) > 1 order by uuid").fetchall()
+
+def main():
+
+    parser = makeParser()
+    opt, arg = parser.parse_args()
+    if not opt.db:
+        parser.error("--db is required")
+    con = connect(opt.db)
+
+    if opt.ingest:
+        n = ingest(con, opt.ingest + arg)
+        print(' '.join('%s:%s' % (k, v) for k, v in sorted(n.items())))
+    if opt.where:
+        for row in where(con, opt.where):
+            print(' '.join(str(i) for i in row))
+    if opt.low_free is not None:
+        for row in low_free(con, opt.low_free):
+            print(' '.join(str(i) for i in row))
+    if opt.moved:
+        for row in moved(con):
+            print(' '.join(str(i) for i in row))
+
+def makeParser():
+    """return the OptionParser for this app."""
+
+    parser = optparse.OptionParser(
+        usage="%prog --db FILE [--ingest PATH [PATH...]] [queries]")
+    parser.add_option("--db", type=str,
+                  help="SQLite inventory file, created if needed")
+    parser.add_option("--ingest", action="append", default=[],
+                  help="load snapshots from this file or directory, "
+                       "extra arguments are loaded too")
+    parser.add_option("--where", type=str, metavar="UUID",
+                  help="where has this filesystem UUID been seen")
+    parser.add_option("--low-free", type=int, metavar="PCT",
+                  help="partitions with less than PCT%% free now")
+    parser.add_option("--moved",
+                  action="store_true", default=False,
+                  help="filesystems seen on more than one host")
+    return parser
+
+if __name__ == '__main__':
+    main()
@@ -7,21 +7,49 @@
 
 from __future__ import print_function
 
+import fcntl
 import glob
+import json
 import os
+import select
+import struct
 import subprocess
+import threading
 import time
-import shlex
 import socket
 import sys
-import time
 import optparse
 
+from concurrent import futures
+
 from xml.etree import ElementTree as ET
+from xml.sax.saxutils import quoteattr
+
+import devprobe
 
 TMPMP = "/mnt/drive-test-temp"  # temporary mount point for testing
 
-TMPMP_N = [0]
+MOUNT_TIMEOUT = 10  # seconds to wait for a temporary mount
+
+PROBE_WORKERS = 16  # partitions probed at once
+
+# --ls results for unmounted partitions, by UUID, see load_probes()
+PROBE_CACHE = os.path.join(
+    os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),
+    'drivelayout', 'probes.json')
+
+EXT_MAGIC = 0xEF53  # ext2/3/4 superblock s_magic
+
+BTRFS_MAGIC = b'_BHRfS_M'  # btrfs superblock magic, at 64 KiB + 0x40
+
+WATCH_INTERVAL = 0.5  # seconds between --watch checks of /proc/partitions
+
+BLKGETSIZE64 = 0x80081272  # ioctl, linux/fs.h
+
+SIZES = {}  # device path -> bytes, see sizeof()
+
+CLAIMED = set()  # mount points handed out by mount_temp(), see there
+CLAIM_LOCK = threading.Lock()
 
 def desc_devs(opt, devs, mntpnt):
     """
@@ -36,12 +64,23 @@ def desc_devs(opt, devs, mntpnt):
     - `mntpnt`: parition to mount point mapping
     """
 
+    exports = open_exports(opt)
+    if exports:
+        summarize(devs)  # up front, as it heads the exports
+    for export in exports:
+        export.begin(devs['_:SUMMARY'])
     if not opt.summary:
-        desc_devs_detail(opt, devs, mntpnt)
+        desc_devs_detail(opt, devs, mntpnt, exports)
+    else:
+        for dev in sorted(i for i in devs if not i.startswith('_:')):
+            for export in exports:
+                export.device(dev, devs[dev])
     if not opt.details:
         desc_devs_summary(opt, devs, mntpnt)
+    for export in exports:
+        export.end()
 
-def desc_devs_detail(opt, devs, mntpnt):
+def desc_devs_detail(opt, devs, mntpnt, exports=()):
     d = '\033[32m'
     l = '\033[39m'
     f = '\033[31m'
@@ -56,10 +95,24 @@ def desc_devs_detail(opt, devs, mntpnt):
     else:
         print(l)
 
-    for dev in sorted(devs.keys()):
+    temp = []
+    try:
+        probe_parts(opt, devs, mntpnt, temp)
+        print_devs_detail(opt, devs, mntpnt, exports, d, l, f, bh, bl)
+    finally:
+        if not opt.mount_all:
+            unmount_temp(temp)
+
+def print_devs_detail(opt, devs, mntpnt, exports, d, l, f, bh, bl):
+    """print_devs_detail - print desc_devs_detail() output, in device
+    order, from what probe_parts() gathered, see desc_devs_detail(),
+    passing each device to exports as soon as it's printed
+    """
+
+    for dev in sorted(i for i in devs if not i.startswith('_:')):
         # get size info for whole device
         sz = sizeof(dev)
-        parts = sorted(devs[dev].keys())
+        parts = sorted(i for i in devs[dev] if not i.startswith('_:'))
         devs[dev]['_:SIZE'] = dsz(sz) if sz else '???'
         if len(parts) == 1:
             # LVM lv names ending in digits, see dev = key.strip('0123456789') above
@@ -72,69 +125,311 @@ def desc_devs_detail(opt, devs, mntpnt):
                 del devs[dev][part]['SEC_TYPE']
             print(part, end= ' ') # '   ',os.path.basename(part),
             print(' '.join([d+k+':'+l+str(devs[dev][part][k])
-                            for k in sorted(devs[dev][part].keys())]))
-            if (opt.ls #X and devLines
-                and part not in mntpnt
-                and devs[dev][part].get('TYPE') not in ('swap', 'LVM2_member', None)):
-                try:
-                    MP = TMPMP
-                    if opt.mount_all:
-                        if devs[dev][part].get('LABEL'):
-                            MP = "/mnt/%s" % devs[dev][part]['LABEL']
-                        else:
-                            MP = TMPMP+str(TMPMP_N[0])
-                            TMPMP_N[0] += 1
-                    runCmd('mkdir -p '+MP)
-                    runCmd('umount '+MP)
-                    time.sleep(1)
-                    runCmd('mount %s %s' % (part, MP))
-                    time.sleep(1)
-                    mntpnt[part] = MP
-                except:
-                    pass
-            if part in mntpnt and is_mounted(mntpnt[part]): #X and devLines:
-                stat = os.statvfs(mntpnt[part])
-
-                devs[dev][part]['ON'] = mntpnt[part]
-                print(d+'          ON:'+l,mntpnt[part], end= ' ')
-                devs[dev][part]['FREE'] = '%s %d%%' % (dsz(stat.f_bsize*stat.f_bavail),
-                                          int(stat.f_bavail*100/stat.f_blocks))
-                print(d+' FREE:'+l+devs[dev][part]['FREE'], end= ' ')
-                devs[dev][part]['RESV'] = dsz(stat.f_bsize*(stat.f_bfree-stat.f_bavail))
-                print(d+' RESV:'+l+devs[dev][part]['RESV'])
-                files = [os.path.basename(i)[:10]
-                         for i in glob.glob(os.path.join(mntpnt[part],'*'))]
-                if files:
-                    files.sort()
-                    devs[dev][part]['FILES'] = files
-                    print(f+'         ',' '.join(files)[:70]+l)
-                release = os.path.join(mntpnt[part], 'etc/lsb-release')
-                if os.path.isfile(release):
-                    for line in open(release):
-                        if 'DISTRIB_DESCRIPTION' in line:
-                            print('         ', line.strip())
-                            devs[dev][part]['DISTRIB_DESCRIPTION'] = line.strip().split('=', 1)[-1]
-
-    runCmd('umount '+TMPMP)
+                            for k in sorted(devs[dev][part].keys())
+                            if not k.startswith('_:')]))
+            info = devs[dev][part].pop('_:MOUNTED', None)
+            if info:
+                devs[dev][part].update(info)
+                if 'CACHED' in info:
+                    print(d+'      CACHED:'+l,info['CACHED'], end= ' ')
+                else:
+                    print(d+'          ON:'+l,info['ON'], end= ' ')
+                print(d+' FREE:'+l+info['FREE'], end= ' ')
+                print(d+' RESV:'+l+info['RESV'])
+                if info.get('FILES'):
+                    print(f+'         ',' '.join(info['FILES'])[:70]+l)
+                if info.get('DISTRIB_DESCRIPTION'):
+                    print('          DISTRIB_DESCRIPTION=%s' %
+                          info['DISTRIB_DESCRIPTION'])
+        for export in exports:
+            export.device(dev, devs[dev])
+
+def probe_parts(opt, devs, mntpnt, temp=None):
+    """probe_parts - mount (with --ls) and describe partitions concurrently
+
+    Each partition gets its own worker, and with --ls unmounted ones
+    their own read-only temporary mount point, so the time taken is
+    that of the slowest partition, not the sum of all of them.  Results
+    are left in devs[dev][part]['_:MOUNTED'] for print_devs_detail().
+    Unmounted partitions whose UUID and fs_signature() match a cache
+    entry aren't mounted at all, see --refresh and --cache-ttl.  Those
+    with no fs_signature() are always mounted, and not cached.
+
+    :param optparse Values opt: options
+    :param dict devs: see desc_devs()
+    :param dict mntpnt: parition to mount point mapping, updated with
+        temporary mount points
+    :param list temp: appended to with each temporary mount point as
+        soon as it's mounted, so the caller can unmount_temp() them even
+        if probing fails part way
+    :return: temp, the list of temporary mount points
+    """
+
+    temp = [] if temp is None else temp
+
+    todo = []
+    for dev in sorted(i for i in devs if not i.startswith('_:')):
+        for part in sorted(i for i in devs[dev] if not i.startswith('_:')):
+            todo.append((part, devs[dev][part]))
+
+    use_cache = not opt.mount_all and opt.cache_ttl > 0
+    cache = load_probes(opt.cache_ttl) if use_cache else {}
+    probed = {}  # UUID -> new cache entry
+
+    def probe(part, info):
+        mp = mntpnt.get(part)
+        mounted = None
+        if (opt.ls
+            and part not in mntpnt
+            and info.get('TYPE') not in ('swap', 'LVM2_member', None)):
+            uuid = info.get('UUID')
+            signature = fs_signature(part, info)
+            cacheable = uuid and signature and not opt.refresh
+            hit = cache.get(uuid) if cacheable else None
+            if hit and hit['signature'] == signature:
+                info['_:MOUNTED'] = dict(hit['info'], CACHED=time.strftime(
+                    '%Y-%m-%d %H:%M', time.localtime(hit['time'])))
+                return part, None
+            mp = mounted = mount_temp(opt, part, info)
+            if mounted:
+                temp.append(mounted)
+            if mounted and uuid and signature:
+                probed[uuid] = dict(time=time.time(), signature=signature)
+        if mp and is_mounted(mp):
+            info['_:MOUNTED'] = mount_info(mp)
+            if mounted and info.get('UUID') in probed:
+                probed[info['UUID']]['info'] = dict(
+                    (k, v) for k, v in info['_:MOUNTED'].items() if k != 'ON')
+        return part, mounted
+
+    if not todo:
+        return temp
+    with futures.ThreadPoolExecutor(min(len(todo), PROBE_WORKERS)) as pool:
+        for part, mp in pool.map(lambda i: probe(*i), todo):
+            if mp:
+                mntpnt[part] = mp
+    if use_cache:
+        cache.update((k, v) for k, v in probed.items() if 'info' in v)
+        save_probes(cache)
+    return temp
+
+def fs_signature(part, info):
+    """fs_signature - cheap signal that a partition's content changed
+
+    Type and size, plus from the superblock the last mount and last
+    write times for ext2/3/4, or the transaction generation for btrfs,
+    which needs read access to the device, as mounting does.  Other
+    filesystems (vfat, ntfs, xfs...) keep nothing as cheap to read that
+    reliably changes with every write, so they get no signature.
+
+    :param str part: partition, e.g. /dev/sdb1
+    :param dict info: partition info from stat_devs()
+    :return: list, equal for unchanged partitions, also after a JSON
+        round trip, or None if there's no way to tell
+    """
+
+    fstype = info.get('TYPE') or ''
+    if fstype.startswith('ext'):
+        offset, size = 1024, 1024
+    elif fstype == 'btrfs':
+        offset, size = 0x10000, 0x50
+    else:
+        return None
+    try:
+        with open(part, 'rb') as dev:
+            dev.seek(offset)
+            block = dev.read(size)
+        if fstype == 'btrfs':
+            if block[0x40:0x48] != BTRFS_MAGIC:
+                return None
+            changed = struct.unpack_from('<Q', block, 0x48)
+        else:
+            if struct.unpack_from('<H', block, 56)[0] != EXT_MAGIC:
+                return None
+            changed = struct.unpack_from('<II', block, 44)
+    except (IOError, OSError, struct.error):
+        return None
+    return [fstype, sizeof(part)] + list(changed)
+
+def load_probes(ttl, path=None):
+    """load_probes - cached --ls results younger than ttl seconds
+
+    :param int ttl: maximum age in seconds
+    :param str path: cache file, default PROBE_CACHE
+    :return: {UUID: {time, signature, info}}
+    """
+
+    try:
+        with open(path or PROBE_CACHE) as inp:
+            cache = json.load(inp)
+    except (IOError, OSError, ValueError):
+        return {}
+    now = time.time()
+    return dict((k, v) for k, v in cache.items()
+                if isinstance(v, dict) and now - v.get('time', 0) < ttl)
+
+def save_probes(cache, path=None):
+    """save_probes - save cached --ls results, see load_probes()
+
+    :param dict cache: {UUID: {time, signature, info}}
+    :param str path: cache file, default PROBE_CACHE
+    """
+
+    path = path or PROBE_CACHE
+    try:
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        tmp = path + '.%d' % os.getpid()
+        with open(tmp, 'w') as out:
+            json.dump(cache, out)
+        os.replace(tmp, path)
+    except (IOError, OSError):
+        pass  # caching's optional
+
+def mount_temp(opt, part, info):
+    """mount_temp - mount part read-only on its own mount point
+
+    With --mount-all that's /mnt/LABEL, unless another partition with
+    the same label is already mounted there, or has claimed it in a
+    concurrent probe_parts() worker, in which case the partition's name
+    is appended, /mnt/LABEL-sdb1.
+
+    :param optparse Values opt: options
+    :param str part: partition, e.g. /dev/sdb1
+    :param dict info: partition info from stat_devs()
+    :return: mount point, or None if part couldn't be mounted
+    """
+
+    if opt.mount_all and info.get('LABEL'):
+        MP = "/mnt/%s" % info['LABEL']
+    else:
+        MP = "%s-%s" % (TMPMP, os.path.basename(part))
+    with CLAIM_LOCK:
+        source = mount_source(MP)
+        if MP in CLAIMED or source and source != os.path.realpath(part):
+            MP = "%s-%s" % (MP, os.path.basename(part))
+            source = mount_source(MP)
+        CLAIMED.add(MP)
+    if source == os.path.realpath(part):  # left over from --mount-all
+        return MP
+    try:
+        if not os.path.isdir(MP):
+            os.makedirs(MP)
+        failed = subprocess.call(['mount', '-o', 'ro', part, MP],
+                                 stderr=subprocess.DEVNULL)
+    except OSError:
+        failed = True
+    if not failed and wait_mounted(MP):
+        return MP
+    try:
+        os.rmdir(MP)
+    except OSError:
+        pass
+    with CLAIM_LOCK:
+        CLAIMED.discard(MP)
+    return None
+
+def mount_source(mp, roots=None):
+    """mount_source - the device mounted on mp, or None
+
+    :param str mp: mount point
+    :param devprobe.Roots roots: where to find mountinfo
+    :return: real path of the topmost mount's source, e.g. /dev/sdb1
+    """
+
+    mp = os.path.realpath(mp)
+    source = None
+    for i in devprobe.read_mountinfo(roots):
+        if i['mountpoint'] == mp and i['source']:
+            source = os.path.realpath(i['source'])
+    return source
+
+def wait_mounted(mp, timeout=MOUNT_TIMEOUT):
+    """wait_mounted - wait until mp shows up in mountinfo
+
+    mount(8) normally returns with the filesystem mounted, but FUSE
+    helpers like ntfs-3g can return before it's ready, so poll briefly
+    rather than sleeping a fixed time.
+
+    :param str mp: mount point
+    :param float timeout: seconds to wait
+    :return: True if mp is mounted
+    """
+
+    deadline = time.time() + timeout
+    while not is_mounted(mp):
+        if time.time() > deadline:
+            return False
+        time.sleep(0.05)
+    return True
+
+def mount_info(mp):
+    """mount_info - ON, FREE, RESV, FILES, DISTRIB_DESCRIPTION for a
+    mounted partition
+
+    :param str mp: mount point
+    :return: dict
+    """
+
+    stat = os.statvfs(mp)
+    ans = {'ON': mp}
+    ans['FREE'] = '%s %d%%' % (dsz(stat.f_bsize*stat.f_bavail),
+                               int(stat.f_bavail*100/(stat.f_blocks or 1)))
+    ans['RESV'] = dsz(stat.f_bsize*(stat.f_bfree-stat.f_bavail))
+    files = [os.path.basename(i)[:10]
+             for i in glob.glob(os.path.join(mp, '*'))]
+    if files:
+        files.sort()
+        ans['FILES'] = files
+    release = os.path.join(mp, 'etc/lsb-release')
+    if os.path.isfile(release):
+        for line in open(release):
+            if 'DISTRIB_DESCRIPTION' in line:
+                ans['DISTRIB_DESCRIPTION'] = line.strip().split('=', 1)[-1]
+    return ans
+
+def unmount_temp(temp):
+    """unmount_temp - unmount and remove temporary mount points, in order
+
+    :param list temp: mount points from probe_parts()
+    """
+
+    for mp in sorted(temp, reverse=True):
+        subprocess.call(['umount', mp], stderr=subprocess.DEVNULL)
+        if not is_mounted(mp):
+            try:
+                os.rmdir(mp)
+            except OSError:
+                pass
+            with CLAIM_LOCK:
+                CLAIMED.discard(mp)
 
 def desc_devs_summary(opt, devs, mntpnt):
 
-    summary = []  # pass on to save_opml
+    if '_:SUMMARY' not in devs:
+        summarize(devs)
+    print('\n'+devs['_:SUMMARY'])
+
+def summarize(devs):
+    """summarize - set devs['_:SUMMARY'], LVM and one line per device info
+
+    :param dict devs: see desc_devs()
+    """
+
+    summary = []  # pass on to exports
 
     # LVM summary
     try:
         head = "LVM info (check VFree):"
-        print("\n"+head)
-        sys.stdout.flush()
         out, err = runCmd('vgs', return_data=True)  # to show unallocated LVM space
-        print(out)
+        if not isinstance(out, str):
+            out = out.decode('utf-8', 'replace')
         summary = [head, out]
     except OSError:
-        print("none found")  # not installed?
-        summary = [head, "none found"]
+        summary = [head, "none found"]  # not installed?
 
     # device summary
-    for dev in sorted(devs.keys()):
+    for dev in sorted(i for i in devs.keys() if not i.startswith('_:')):
         parts = sorted(i for i in devs[dev] if not i.startswith('_:'))
         sz = sizeof(dev)
         if not sz:
@@ -153,7 +448,6 @@ def desc_devs_summary(opt, devs, mntpnt):
         else:
             text = "%s %s %s" % (dev.replace('/dev/', ''), '(size?)', labels)
 
-        print(text)
         summary.append(text)
 
     devs["_:SUMMARY"] = '\n'.join(summary)
@@ -170,18 +464,16 @@ def dsz(x):
         u += 1
     return "%d %s" % (int(x), ['b','kb','Mb','Gb','Tb','Pb'][u])
 
-def is_mounted(mp):
+def is_mounted(mp, roots=None):
     """is_mounted - Return True if mp is mounted and not just a mount point
 
     :Parameters:
     - `mp`: path to mount point
+    - `roots`: devprobe.Roots, where to find mountinfo
     """
 
-    if not mp.startswith(TMPMP):
-        return True  # weak but sufficient
-
-    # FIXME broken with --mount-all, or always broken?
-    return os.stat(TMPMP).st_dev != os.stat(os.path.dirname(TMPMP)).st_dev
+    mp = os.path.realpath(mp)
+    return any(i['mountpoint'] == mp for i in devprobe.read_mountinfo(roots))
 
 def main():
 
@@ -192,12 +484,16 @@ def main():
     if opt.summary:
         opt.ls = False
 
+    if opt.watch:
+        try:
+            watch(opt)
+        except KeyboardInterrupt:
+            pass
+        return
+
     devs, mntpnt = stat_devs()
     desc_devs(opt, devs, mntpnt)
 
-    if opt.opml:
-        save_opml(opt, devs, mntpnt)
-
 def makeParser():
     """return the OptionParser for this app."""
 
@@ -214,11 +510,32 @@ def makeParser():
     parser.add_option("--mount-all",
                   action="store_true", default=False,
                   help="leave all unmounted drives mounted for inspection")
+    parser.add_option("--refresh",
+                  action="store_true", default=False,
+                  help="mount partitions for --ls even if cached results "
+                       "are still valid")
+    parser.add_option("--cache-ttl", type=int, default=7*24*3600,
+                  help="reuse --ls results for unchanged ext2/3/4 and btrfs "
+                       "partitions for up to this many seconds, 0 to "
+                       "disable the cache")
+    parser.add_option("--watch",
+                  action="store_true", default=False,
+                  help="print events as devices are added, removed, "
+                       "(un)mounted, or changed, until interrupted")
+    parser.add_option("--interval", type=float, default=WATCH_INTERVAL,
+                  help="seconds between --watch checks for new devices, "
+                       "(un)mounts are seen immediately")
+    parser.add_option("--ndjson",
+                  action="store_true", default=False,
+                  help="print --watch events as JSON, one per line")
     parser.add_option("--color",
                   action="store_true", default=False,
                   help="use color output even when redirected")
     parser.add_option("--opml", type=str,
                   help="save output in OPML format")
+    parser.add_option("--json", type=str,
+                  help="save output in JSON format, or NDJSON, one "
+                       "device per line, if the file name ends in .ndjson")
     return parser
 
 def runCmd(s, return_data=False):
@@ -232,57 +549,140 @@ def runCmd(s, return_data=False):
         proc = subprocess.Popen(s.split(), stderr=subprocess.PIPE)
         proc.wait()
 
-def save_opml(opt, devs, mntpnt):
-    """save_opml - save drives in OPML format for outliner import
+def open_exports(opt):
+    """open_exports - exporters for --opml and --json, see OpmlExport
 
-    :param optparse Namespace opt: options
-    :param dict devs: see desc_devs(()
-    :param dict mntpnt: parition to mount point mapping
+    :param optparse Values opt: options
+    :return: list of exporters
+    """
 
+    exports = []
+    if opt.opml:
+        exports.append(OpmlExport(opt.opml))
+    if opt.json:
+        exports.append(JsonExport(opt.json))
+    return exports
+
+class OpmlExport(object):
+    """Write drives in OPML format for outliner import, a device at a
+    time, so a reader can start before the inventory's finished and the
+    whole tree's never in memory.  Partition outlines have a Leo body
+    text, and an outline per attribute.
     """
 
     LEO = "leo:com:leo-opml-version-1"
-    BODY = "{%s}body" % LEO
 
-    def kv(d, k):
-        if k in d:
-            return "%s: %s " % (k, d[k])
-        else:
-            return ''
-
-    ET.register_namespace('leo', LEO)
-    opml = ET.Element("opml", version="2.0")
-    head = ET.SubElement(opml, "head")
-    title = "Drives on %s %s" % (socket.gethostname(), time.asctime())
-    ET.SubElement(head, "title").text = title
-    body = ET.SubElement(opml, "body")
-    top = ET.SubElement(body, "outline")
-    top.set("text", title)
-    ET.SubElement(top, BODY).text = devs['_:SUMMARY']
-    for dev_name in sorted([i for i in devs if not i.startswith("_:")]):
-        dev = ET.SubElement(top, "outline")
-        dev.set("text", "%s %s" % (dev_name, devs[dev_name]['_:SIZE']))
-        for part_name in sorted(i for i in devs[dev_name] if not i.startswith('_:')):
+    def __init__(self, path):
+        self.out = open(path, 'w', encoding='us-ascii',
+                        errors='xmlcharrefreplace')
+
+    def begin(self, summary):
+        """begin - write the head and the top outline's body text
+
+        :param str summary: devs['_:SUMMARY'], see summarize()
+        """
+        title = "Drives on %s %s" % (socket.gethostname(), time.asctime())
+        head = ET.Element("head")
+        ET.SubElement(head, "title").text = title
+        self.out.write('<opml xmlns:leo="%s" version="2.0">' % self.LEO)
+        self.out.write(ET.tostring(head, encoding='unicode'))
+        self.out.write('<body><outline text=%s>' % quoteattr(title))
+        body = ET.Element('leo:body')  # prefix declared on <opml>
+        body.text = summary
+        self.write(body)
+
+    def device(self, dev_name, parts):
+        """device - write a device's outline
+
+        :param str dev_name: device, e.g. /dev/sda
+        :param dict parts: devs[dev_name], see desc_devs()
+        """
+
+        def kv(d, k):
+            if k in d:
+                return "%s: %s " % (k, d[k])
+            else:
+                return ''
+
+        dev = ET.Element("outline")
+        sz = sizeof(dev_name)
+        dev.set("text", "%s %s" % (dev_name, dsz(sz) if sz else '???'))
+        for part_name in sorted(i for i in parts if not i.startswith('_:')):
             part = ET.SubElement(dev, "outline")
-            part_data = devs[dev_name][part_name]
+            part_data = parts[part_name]
             part.set("text", ' '.join(i for i in [part_name,
                 part_data.get('LABEL'), part_data.get('ON'), part_data.get('SIZE'),
-                part_data.get('TYPE')] if i and i != TMPMP))
+                part_data.get('TYPE')] if i and not i.startswith(TMPMP)))
             text = "%s\n%s\n%s\n\n%s\n" % (
                 kv(part_data, 'LABEL')+kv(part_data, 'SIZE')+kv(part_data, 'TYPE')+kv(part_data, 'UUID'),
                 kv(part_data, 'ON')+kv(part_data, 'FREE')+kv(part_data, 'RESV'),
                 kv(part_data, 'DISTRIB_DESCRIPTION'),
                 ' '.join(part_data.get('FILES', [])),
             )
-            ET.SubElement(part, BODY).text = text.replace('\n\n\n', '\n\n')
+            ET.SubElement(part, 'leo:body').text = text.replace('\n\n\n', '\n\n')
             for attr_name in sorted(part_data):
                 attr = ET.SubElement(part, 'outline')
                 text="%s: %s" % (attr_name, part_data[attr_name])
                 if attr_name == 'FILES':
                     text="%s: %s" % (attr_name, ' '.join(part_data[attr_name][:10]))
                 attr.set('text', text)
+        self.write(dev)
+
+    def write(self, element):
+        self.out.write(ET.tostring(element, encoding='unicode'))
+        self.out.flush()
 
-    ET.ElementTree(opml).write(opt.opml)
+    def end(self):
+        self.out.write('</outline></body></opml>')
+        self.out.close()
+
+class JsonExport(object):
+    """Write drives as JSON, a device at a time, see OpmlExport.  If the
+    file name ends in .ndjson, one object per line, a host record then a
+    record per device, otherwise one {host, time, summary, devices}
+    object.
+    """
+
+    def __init__(self, path):
+        self.out = open(path, 'w')
+        self.ndjson = path.endswith('.ndjson')
+        self.count = 0
+
+    def begin(self, summary):
+        """begin - write host information
+
+        :param str summary: devs['_:SUMMARY'], see summarize()
+        """
+        host = dict(host=socket.gethostname(),
+                    time=time.strftime('%Y-%m-%dT%H:%M:%S'), summary=summary)
+        if self.ndjson:
+            self.write(dict(host, record='host'))
+        else:
+            self.out.write(json.dumps(host)[:-1] + ', "devices": [\n')
+
+    def device(self, dev_name, parts):
+        """device - write a device's record
+
+        :param str dev_name: device, e.g. /dev/sda
+        :param dict parts: devs[dev_name], see desc_devs()
+        """
+        rec = dict(device=dev_name, size=sizeof(dev_name), partitions=dict(
+            (k, v) for k, v in parts.items() if not k.startswith('_:')))
+        if self.ndjson:
+            self.write(dict(rec, record='device'))
+        else:
+            self.out.write((',\n' if self.count else '') + json.dumps(rec))
+            self.out.flush()
+        self.count += 1
+
+    def write(self, rec):
+        self.out.write(json.dumps(rec, sort_keys=True) + '\n')
+        self.out.flush()
+
+    def end(self):
+        if not self.ndjson:
+            self.out.write('\n]}\n')
+        self.out.close()
 
 """
     sde1 SIZE:44 Gb TYPE:ext4 UUID:0737f555-dccf-4196-8dc3-6c15c041a303
@@ -291,63 +691,221 @@ def save_opml(opt, devs, mntpnt):
          DISTRIB_DESCRIPTION="Ubuntu 14.04.3 LTS"
 """
 
-def sizeof(thing):
-    """determine the size of a device or partition according to `fdisk -s`
+def sizeof(thing, roots=None):
+    """size in bytes of a device or partition, e.g. /dev/sda, or None
+
+    sysfs size files count 512 byte sectors whatever the device's
+    logical block size, the BLKGETSIZE64 ioctl is the fallback.  Sizes
+    are memoized in SIZES, which stat_devs() fills from its probe, so
+    the detail, summary, and OPML output don't size devices again.
 
-    FIXME - hardwired 1024 byte blocks
+    :param str thing: path to device
+    :param devprobe.Roots roots: where to probe, default the live system
     """
 
-    proc = subprocess.Popen(('fdisk', '-s', thing), stdout=subprocess.PIPE,
-                            stderr=subprocess.PIPE)
-    proc.wait()
-    txt = proc.stdout.read().strip()
-    if not txt.strip():
-        sz = None
+    if thing in SIZES:
+        return SIZES[thing]
+
+    roots = roots or devprobe.Roots()
+    name = os.path.basename(os.path.realpath(thing))  # /dev/mapper/x -> dm-0
+    sectors = devprobe.read_file(
+        os.path.join(roots.sys, 'class', 'block', name, 'size'))
+    if sectors:
+        sz = int(sectors) * devprobe.SECTOR
     else:
-        sz = int(txt)*1024
+        try:
+            with open(thing, 'rb') as dev:
+                buf = fcntl.ioctl(dev.fileno(), BLKGETSIZE64, b' ' * 8)
+            sz = struct.unpack('Q', buf)[0]
+        except (IOError, OSError):
+            sz = None
 
-    return sz
+    SIZES[thing] = sz or None
+    return SIZES[thing]
 
-def stat_devs():
+def stat_devs(roots=None):
     """returns devs, mntpnt - the parameters
-    for desc_devs(), see desc_devs() for docs."""
+    for desc_devs(), see desc_devs() for docs.
+
+    :param devprobe.Roots roots: where to probe, default the live system
+    """
+
+    probed = devprobe.probe(roots)
+    for info in probed.values():
+        SIZES[info['path']] = info['size'] or None  # see sizeof()
 
     # collect list of mount points for mounted volumes
-    proc = subprocess.Popen('mount', stdout=subprocess.PIPE)
-    proc.wait()
-    mntLines = [i.decode('utf-8').strip() for i in proc.stdout.readlines()]
     mntpnt = {}
-    for line in mntLines:
-        line, _ = line.rsplit(' type ', 1)
-        line = line.split(None, 2)
-        if line[0] not in mntpnt:
-            mntpnt[line[0]] = line[2]
-
-    # get info about all partitions
-    proc = subprocess.Popen('blkid', stdout=subprocess.PIPE,
-                            stderr=subprocess.PIPE)
-    proc.wait()
-    devLines = [i.decode('utf-8').strip() for i in proc.stdout.readlines()]
+    for dev in probed.values():
+        if dev['mountpoints']:
+            mntpnt[dev['path']] = dev['mountpoints'][0]
+
+    # get info about all partitions, those blkid would list
     devs = {}
-    for line in devLines:
-        key, info = line.split(': ')
-        dev = key.strip('0123456789')
-        if dev not in devs: devs[dev] = {}
-        parts = devs[dev]
-        parts[key] = {}
-        for item in shlex.split(info):  # LABEL="A space!"
-            ikey, val = item.split('=')
-            parts[key][ikey] = val.strip('"')
-
-        # get size info for partition
-        sz = sizeof(key)
-        if sz:
-            parts[key]['SIZE'] = dsz(sz)
+    for name in sorted(probed):
+        info = probed[name]
+        if not (info['uuid'] or info['fstype'] or info['label']):
+            continue
+        if info['parent']:
+            dev = probed[info['parent']]['path']
         else:
-            parts[key]['SIZE'] = 'N/A'
+            dev = info['path']
+        if dev not in devs: devs[dev] = {}
+        devs[dev][info['path']] = part_info(info)
 
     return devs, mntpnt
 
+def part_info(info):
+    """part_info - LABEL, UUID, PARTUUID, TYPE, SIZE for a partition
+
+    :param dict info: a device from devprobe.probe()
+    :return: dict, as in desc_devs()'s devs
+    """
+
+    ans = {}
+    for ikey, val in (('LABEL', info['label']), ('UUID', info['uuid']),
+                      ('PARTUUID', info['partuuid']),
+                      ('TYPE', info['fstype'])):
+        if val:
+            ans[ikey] = val
+
+    # size info for partition
+    ans['SIZE'] = dsz(info['size']) if info['size'] else 'N/A'
+    return ans
+
+def watch_signature(roots):
+    """watch_signature - cheap to read state that changes with devices
+
+    :param devprobe.Roots roots: where to look
+    :return: (/proc/partitions, {device name: UUID}, {device name: label},
+        mountinfo (mtime, size)), mountinfo's stat only changes in a
+        fixture tree, the live one is poll()ed, see watch_events()
+    """
+
+    disk = os.path.join(roots.dev, 'disk')
+    try:
+        stat = os.stat(os.path.join(roots.proc, 'self', 'mountinfo'))
+        mounts = (stat.st_mtime, stat.st_size)
+    except OSError:
+        mounts = None
+    return (devprobe.read_partitions(roots),
+            devprobe.read_links(os.path.join(disk, 'by-uuid')),
+            devprobe.read_links(os.path.join(disk, 'by-label')),
+            mounts)
+
+def snapshot(probed):
+    """snapshot - {device path: part_info() and ON} for watch_events()
+
+    :param dict probed: from devprobe.probe()
+    """
+
+    ans = {}
+    for info in probed.values():
+        if info['size']:  # not empty loop devices, card readers, etc.
+            ans[info['path']] = part_info(info)
+            if info['mountpoints']:
+                ans[info['path']]['ON'] = info['mountpoints'][0]
+    return ans
+
+def diff_snapshots(old, new):
+    """diff_snapshots - add / remove / change events between snapshots
+
+    :param dict old: from snapshot()
+    :param dict new: from snapshot()
+    :return: list of {event, device, info} dicts, change events also
+        have changes {key: [old, new]}
+    """
+
+    events = []
+    for dev in sorted(set(old) | set(new)):
+        if dev not in new:
+            events.append(dict(event='remove', device=dev, info=old[dev]))
+        elif dev not in old:
+            events.append(dict(event='add', device=dev, info=new[dev]))
+        elif old[dev] != new[dev]:
+            changes = dict((k, [old[dev].get(k), new[dev].get(k)])
+                           for k in set(old[dev]) | set(new[dev])
+                           if old[dev].get(k) != new[dev].get(k))
+            events.append(dict(event='change', device=dev, info=new[dev],
+                               changes=changes))
+    return events
+
+def watch_events(roots=None, interval=WATCH_INTERVAL):
+    """watch_events - generate lists of events as devices change
+
+    The first list adds every device.  After that, mountinfo is poll()ed,
+    the kernel flags it when anything's (un)mounted, and /proc/partitions
+    and /dev/disk/by-* checked every interval seconds.  Only devices that
+    appeared, disappeared, or changed size, UUID, or label are probed
+    again, (un)mounts just re-read mountinfo.
+
+    :param devprobe.Roots roots: where to look, default the live system
+    :param float interval: seconds between checks of /proc/partitions
+    """
+
+    roots = roots or devprobe.Roots()
+    mountinfo = open(os.path.join(roots.proc, 'self', 'mountinfo'))
+    poller = select.poll()
+    poller.register(mountinfo, select.POLLPRI | select.POLLERR)
+    try:
+        mountinfo.read()
+        last = watch_signature(roots)  # before probing, so nothing's missed
+        probed = devprobe.probe(roots)
+        state = snapshot(probed)
+        yield diff_snapshots({}, state)
+        while True:
+            mounted = bool(poller.poll(interval * 1000))
+            if mounted:
+                mountinfo.seek(0)
+                mountinfo.read()  # clears the event
+            sig = watch_signature(roots)
+            if sig == last and not mounted:
+                continue
+            changed = set()
+            for old, new in zip(last[:3], sig[:3]):
+                changed.update(i for i in set(old) | set(new)
+                               if old.get(i) != new.get(i))
+            for name in changed:
+                probed.pop(name, None)
+            if changed:
+                probed.update(devprobe.probe(roots, changed))
+            if mounted or sig[3] != last[3]:
+                mounts, fstypes = devprobe.read_mounts(roots)
+                for info in probed.values():
+                    info['mountpoints'] = mounts.get(info['majmin'], [])
+                    info['fstype'] = (fstypes.get(info['majmin'])
+                                      or info['fstype'])
+            last = sig
+            new = snapshot(probed)
+            events = diff_snapshots(state, new)
+            state = new
+            if events:
+                yield events
+    finally:
+        mountinfo.close()
+
+def watch(opt, roots=None):
+    """watch - print device events until interrupted, see --watch
+
+    :param optparse Values opt: options
+    :param devprobe.Roots roots: where to look, default the live system
+    """
+
+    for events in watch_events(roots, opt.interval):
+        for event in events:
+            event['time'] = time.strftime('%Y-%m-%dT%H:%M:%S')
+            if opt.ndjson:
+                print(json.dumps(event, sort_keys=True))
+            elif event['event'] == 'change':
+                print(event['time'], 'change', event['device'], ' '.join(
+                    '%s:%s->%s' % (k, v[0], v[1])
+                    for k, v in sorted(event['changes'].items())))
+            else:
+                print(event['time'], event['event'], event['device'],
+                      ' '.join('%s:%s' % (k, v)
+                               for k, v in sorted(event['info'].items())))
+        sys.stdout.flush()
+
 if __name__ == '__main__':
     main()
 
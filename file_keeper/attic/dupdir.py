@@ -2,13 +2,25 @@
 dupdir.py - scan for subtrees with duplicate content
 
 Terry Brown, Terry_N_Brown@yahoo.com, Sat Oct 29 16:53:07 2016
+
+Now done from the file_db.py DB, this runs --update-dir-hashes then
+--list-dupe-dirs with any other file_db.py options given.
+
+file_db.py, and the metrics.py etc. it imports, are imported from
+file_keeper/, which must be on PYTHONPATH, as this is in attic/, e.g.
+
+    PYTHONPATH=file_keeper python file_keeper/attic/dupdir.py --db-file my.db
 """
 
-import os
 import sys
 
+import file_db
+
+
 def main():
-    <|code|>
+    for action in '--update-dir-hashes', '--list-dupe-dirs':
+        file_db.run_opt(file_db.get_options([action] + sys.argv[1:]))
+
 
 if __name__ == '__main__':
     main()
@@ -5,18 +5,29 @@ Terry Brown, terrynbrown@gmail.com, Sun Apr 22 16:36:40 2018
 """
 
 import argparse
+import hashlib
 import json
 import os
 import sqlite3
 import sys
+import threading
 import time
 
-from collections import defaultdict
+from collections import defaultdict, namedtuple
 from hashlib import sha1
-from subprocess import Popen, PIPE
+
+# concurrent.futures, mmap, queue, and subprocess are imported where
+# they're used, by scans and hashing.  addict isn't deferred, every query
+# result is a Dict, as is most of metrics.py's state.
 
 from addict import Dict
 
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+import metrics
 from humanread import hr
 
 
@@ -27,7 +38,153 @@ class FileKeeperError(Exception):
 # field names matching os.stat() attributes
 STATFLDS = 'st_size', 'st_mtime', 'st_ino'
 
-BLKSIZE = 100000000  # amount to read when hashing files
+BLKSIZE = 8 * 1024 * 1024  # default amount to read when hashing files
+
+# hash_path() algorithms, rows with no file.hash_algo are sha1
+HASH_ALGOS = {
+    'sha1': hashlib.sha1,
+    'sha256': hashlib.sha256,
+    'blake2b': hashlib.blake2b,
+}
+if xxhash is not None and hasattr(xxhash, 'xxh3_128'):
+    HASH_ALGOS['xxh3_128'] = xxhash.xxh3_128  # fast, non-cryptographic
+
+FP_SAMPLE = 1024 * 1024  # bytes per sample in fingerprint_path()
+FP_SAMPLES = 8  # samples per fingerprint, including first and last
+
+HASH_BACKLOG = 1000  # records read ahead to keep all devices busy
+
+BULK_BATCH = 10000  # rows per executemany() in --bulk scans
+
+SCAN_BACKLOG = 100  # directory listings walker threads can get ahead
+
+# SQL for the directory part of path, 'a/b/' for 'a/b/c', '' for 'c',
+# rtrim() with all of path's other characters leaves it, indexed by
+# idx_file_parent / idx_dir_parent
+PARENT = "rtrim(path, replace(path, '/', ''))"
+
+# /proc and /sys based lsblk replacement, see get_devs()
+DEVPROBE = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'devprobe.py'
+)
+
+# lsblk output cache, see cached_devs()
+DEVICES_CACHE = os.path.join(
+    os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),
+    'file_keeper',
+    'lsblk.json',
+)
+
+SCHEMA = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'file_db.sql'
+)
+
+# MIGRATIONS[n] upgrades a DB from user_version n to n + 1, file_db.sql
+# creates the latest version.  Steps are SQL, or (table, column, type)
+# for columns, which are only added if missing, because DBs from before
+# versioning may already have some.  Changes to file_db.sql need a
+# migration here so existing DBs get them.
+MIGRATIONS = [
+    [  # 1: fingerprints, hash algorithm, lookup indexes
+        ('file', 'fingerprint', 'text'),
+        ('file', 'hash_algo', 'text'),
+        "create index if not exists idx_file_uuid_path on file(uuid, path)",
+        "create index if not exists idx_file_hash on file(hash)",
+    ],
+    [  # 2: dir table for incremental scans
+        """create table if not exists dir (
+    dir INTEGER PRIMARY KEY,
+    uuid integer,
+    path text,
+    st_ino integer,
+    st_mtime integer,
+    n_child integer,
+    scan_time integer,
+    FOREIGN KEY(uuid) REFERENCES uuid(uuid)
+)""",
+        "create unique index if not exists idx_dir_uuid_path "
+        "on dir(uuid, path)",
+    ],
+    [  # 3: scan generations for deletion detection
+        ('uuid', 'scan_gen', 'integer'),
+        ('file', 'scan_gen', 'integer'),
+        ('file', 'deleted', 'integer'),
+        "create index if not exists idx_file_deleted on file(deleted) "
+        "where deleted is not null",
+    ],
+    [  # 4: directory hashes
+        ('uuid', 'dir_hash_date', 'integer'),
+        ('dir', 'hash', 'text'),
+        ('dir', 'tree_files', 'integer'),
+        ('dir', 'tree_size', 'integer'),
+        "create index if not exists idx_dir_hash on dir(hash)",
+    ],
+    [  # 5: chunk hashes
+        """create table if not exists chunk (
+    chunk INTEGER PRIMARY KEY,
+    file integer,
+    offset integer,
+    length integer,
+    hash text,
+    hash_algo text,
+    st_size integer,
+    st_mtime integer,
+    hash_date integer,
+    FOREIGN KEY(file) REFERENCES file(file)
+)""",
+        "create unique index if not exists idx_chunk_file "
+        "on chunk(file, offset)",
+    ],
+    [  # 6: hardlinks, see hash_recs()
+        "create index if not exists idx_file_uuid_ino on file(uuid, st_ino)",
+    ],
+    [  # 7: run summaries, see save_run()
+        """create table if not exists run (
+    run INTEGER PRIMARY KEY,
+    run_time integer,
+    action text,
+    paths text,
+    wall real,
+    cpu real,
+    counters text,
+    metrics text
+)""",
+    ],
+    [  # 8: direct children of a directory, see PARENT
+        "create index if not exists idx_file_parent "
+        "on file(uuid, %s)" % PARENT,
+        "create index if not exists idx_dir_parent on dir(uuid, %s)" % PARENT,
+    ],
+]
+
+# actions that only read the DB, see set_profile() and save_run()
+LISTING_ACTIONS = (
+    'list_dupes',
+    'list_files',
+    'list_drives',
+    'list_deleted',
+    'list_dupe_dirs',
+    'chunk_diff',
+)
+
+# pragmas for DB connections, see set_profile()
+DB_PROFILES = {
+    # bulk writing, scans and hashing
+    'scan': [
+        ('journal_mode', 'wal'),
+        ('synchronous', 'normal'),  # safe with WAL, may lose last commit
+        ('cache_size', -256 * 1024),  # KiB
+        ('mmap_size', 1 << 30),  # bytes
+        ('temp_store', 'memory'),
+    ],
+    # read only listing
+    'read': [
+        ('cache_size', -64 * 1024),
+        ('mmap_size', 1 << 30),  # bytes
+        ('temp_store', 'memory'),
+    ],
+    'none': [],  # SQLite's defaults
+}
 
 if sys.version_info < (3, 6):
     # need dict insertion order
@@ -67,7 +224,24 @@ def make_parser():
     parser.add_argument(
         "--db-file", default='file_keeper.db', help="Path to DB file"
     )
-    parser.add_argument("--path", help="Path to process")
+    parser.add_argument(
+        "--connection-profile",
+        choices=['auto'] + sorted(DB_PROFILES),
+        default='auto',
+        help="DB connection settings, 'auto' uses 'read' for listing "
+        "actions and --dry-run, 'scan' otherwise",
+    )
+    parser.add_argument(
+        "--path",
+        nargs='+',
+        help="Paths to process, paths on different devices are scanned "
+        "concurrently",
+    )
+    parser.add_argument(
+        "--all-mounted",
+        action='store_true',
+        help="Process all mounted devices",
+    )
     parser.add_argument(
         "--min-size",
         type=int,
@@ -82,6 +256,41 @@ def make_parser():
         help="Re-hash files with hashes older than DAYS",
         metavar='DAYS',
     )
+    parser.add_argument(
+        "--hash-workers",
+        type=int,
+        default=4,
+        help="Concurrent hashes per SSD / NVMe device, "
+        "spinning disks always get one",
+        metavar='N',
+    )
+    parser.add_argument(
+        "--hash-algo",
+        choices=sorted(HASH_ALGOS),
+        default='sha1',
+        help="Hash algorithm for new hashes, with --dupes-only files "
+        "hashed with another algorithm are re-hashed when compared",
+    )
+    parser.add_argument(
+        "--hash-block-size",
+        type=int,
+        default=BLKSIZE // 1024 // 1024,
+        help="Read buffer per hashing thread",
+        metavar='MB',
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=0,
+        help="Hash files larger than MB in MB chunks, saving each chunk's "
+        "hash so interrupted hashing can resume, 0 to hash whole files",
+        metavar='MB',
+    )
+    parser.add_argument(
+        "--hash-mmap",
+        action='store_true',
+        help="Hash through mmap() instead of a read buffer",
+    )
     parser.add_argument(
         "--dupes-only",
         action='store_true',
@@ -90,6 +299,49 @@ def make_parser():
     parser.add_argument(
         "--dry-run", action='store_true', help="Make no changes to DB"
     )
+    parser.add_argument(
+        "--walker",
+        choices=['scandir', 'walk'],
+        default='scandir',
+        help="Directory walker, 'walk' is the old os.walk() + os.stat()",
+    )
+    parser.add_argument(
+        "--walk-workers",
+        type=int,
+        default=1,
+        help="Threads listing directories for --walker scandir, "
+        "more helps on network / USB drives",
+        metavar='N',
+    )
+    parser.add_argument(
+        "--full",
+        action='store_true',
+        help="List directories and check files even if the directory's "
+        "mtime hasn't changed since the last scan",
+    )
+    parser.add_argument(
+        "--bulk",
+        action='store_true',
+        help="Preload catalog for --path and write changes in batches",
+    )
+    parser.add_argument(
+        "--devices-ttl",
+        type=int,
+        default=60,
+        help="Reuse cached lsblk output for up to SEC seconds if nothing's "
+        "been (un)mounted, 0 to always run lsblk",
+        metavar='SEC',
+    )
+    parser.add_argument(
+        "--metrics-json",
+        help="Write timings, SQL latencies, etc. to FILE as JSON",
+        metavar='FILE',
+    )
+    parser.add_argument(
+        "--metrics-prom",
+        help="Write metrics to FILE for Prometheus' textfile collector",
+        metavar='FILE',
+    )
 
     # actions
 
@@ -108,6 +360,33 @@ def make_parser():
     parser.add_argument(
         "--list-drives", action='store_true', help="Show list of known drives"
     )
+    parser.add_argument(
+        "--update-dir-hashes",
+        action='store_true',
+        help="Hash directories from their files' hashes",
+    )
+    parser.add_argument(
+        "--list-dupe-dirs",
+        action='store_true',
+        help="List duplicate directories, needs --update-dir-hashes",
+    )
+    parser.add_argument(
+        "--chunk-diff",
+        type=int,
+        nargs=2,
+        help="Show which chunks differ between two files, by file key",
+        metavar='FILE',
+    )
+    parser.add_argument(
+        "--list-deleted",
+        action='store_true',
+        help="List files scans found missing",
+    )
+    parser.add_argument(
+        "--forget-deleted",
+        action='store_true',
+        help="Remove files scans found missing from DB",
+    )
 
     return parser
 
@@ -128,20 +407,68 @@ def list_files(opt):
     Args:
         opt (argparse Namespace): options
     """
-    for path in do_query(opt, "select * from file order by st_size desc"):
-        print(path)
+    for path in iter_query(opt, "select * from file order by st_size desc"):
+        print(path._asdict())
+
+
+def list_deleted(opt):
+    """List files scans found missing
+
+    Args:
+        opt (argparse Namespace): options
+    """
+    q = "select * from file where deleted is not null order by uuid, path"
+    for path in iter_query(opt, q):
+        print(path._asdict())
+
+
+def forget_deleted(opt):
+    """Remove files scans found missing from DB
+
+    Args:
+        opt (argparse Namespace): options
+    """
+    count = do_one(
+        opt, "select count(*) as n from file where deleted is not null"
+    ).n
+    do_query(
+        opt,
+        "delete from chunk where file in "
+        "(select file from file where deleted is not null)",
+    )
+    do_query(opt, "delete from file where deleted is not null")
+    commit(opt)
+    print("%s deleted files forgotten" % count)
 
 
 def dupe_check(opt, todo):
+    """dupe_check - report duplicates in a list of same sized files
+
+    Files with the same full hash are confirmed duplicates.  Files
+    with the same fingerprint, at least one of which has no hash yet,
+    are probable duplicates, whether or not the others have a hash, so
+    a new copy of an already hashed file is reported before it's hashed.
+    Files with neither are listed together as the same size only.
+
+    Args:
+        opt (argparse namespace): options
+        todo ([Row]): file records with the same st_size, see iter_query()
+    """
     lists = defaultdict(list)
     for rec in todo:
         if rec.hash:
-            lists[rec.hash].append(rec)
-        else:
-            lists['NOHASH'].append(rec)
-    for hash_text, list_ in lists.items():
+            # hashes from different algorithms can't be compared
+            status = 'confirmed, %s' % (rec.hash_algo or 'sha1')
+            lists[(rec.hash, status)].append(rec)
+        if rec.fingerprint:
+            lists[(rec.fingerprint, 'probable')].append(rec)
+        elif not rec.hash:
+            lists[('NOHASH', 'size only')].append(rec)
+    for (hash_text, status), list_ in lists.items():
+        if status == 'probable' and all(rec.hash for rec in list_):
+            continue  # compared by hash above
         if len(list_) > 1:
-            print("\n%s %s" % (hash_text, hr(list_[0].st_size)))
+            print("\n%s %s (%s)" % (hash_text, hr(list_[0].st_size), status))
             inos = defaultdict(list)
             for rec in list_:
                 inos[(rec.uuid, rec.st_ino)].append(rec)
@@ -154,10 +481,38 @@ def dupe_check(opt, todo):
 
 
 def list_dupes(opt):
+    """List duplicates in DB
+
+    SQLite picks out size classes with more than one file, and drops
+    files whose hash is unique unless an unhashed file shares their
+    fingerprint, so only candidates reach dupe_check(), one size class
+    at a time.
 
+    Args:
+        opt (argparse Namespace): options
+    """
+    # cross join makes the size classes the outer loop, so each class's
+    # files come out together, largest first, without sorting them all
+    q = """
+select file.* from (select st_size as class from file
+                     where deleted is null
+                     group by st_size having count(*) > 1
+                     order by st_size desc) as x
+ cross join file on (st_size = class)
+ where deleted is null
+   and (hash is null
+        or hash in (select hash from file
+                     where hash is not null and deleted is null
+                     group by hash having count(*) > 1)
+        or (st_size, fingerprint) in (
+            select st_size, fingerprint from file
+             where fingerprint is not null and deleted is null
+             group by st_size, fingerprint
+            having count(*) > 1 and count(hash) < count(*)))
+"""
     size = None
     todo = []
-    for path in do_query(opt, "select * from file order by st_size desc"):
+    for path in iter_query(opt, q):
         if size != path.st_size:
             if todo:
                 dupe_check(opt, todo)
@@ -165,6 +520,189 @@ def list_dupes(opt):
             todo = [path]
         else:
             todo.append(path)
+    if todo:
+        dupe_check(opt, todo)
+
+
+def update_dir_hashes(opt):
+    """update_dir_hashes - hash directories from the hashes of their contents
+
+    A directory's hash is a hash of its files' (name, hash) and
+    subdirectories' (name, hash) pairs, so identical subtrees have the
+    same hash wherever they are.  The first pass for a drive hashes all
+    its directories, later passes only directories with files hashed or
+    deleted, or which were listed by a scan, since the last pass, and
+    their ancestors.  Directories containing a file with no hash get no
+    hash.
+
+    Args:
+        opt (argparse namespace): options
+    """
+    for drive in do_query(opt, "select * from uuid"):
+        dirty = set()
+        live = set()  # dirs with files, which need a dir row
+        if drive.dir_hash_date is None:
+            q = "select path, deleted from file "
+            q += "where uuid = ? and deleted is null"
+            vals = [drive.uuid]
+        else:
+            q = (
+                "select path, deleted from file where uuid = ? "
+                "and (hash_date >= ? or deleted >= ?)"
+            )
+            vals = [drive.uuid] + [drive.dir_hash_date] * 2
+        for row in iter_query(opt, q, vals):
+            dirty.add(os.path.dirname(row.path) or '.')
+            if row.deleted is None:
+                live.add(os.path.dirname(row.path) or '.')
+        known = {
+            row.path: row.dir
+            for row in iter_query(
+                opt, "select dir, path from dir where uuid = ?", [drive.uuid]
+            )
+        }
+        q = "select path from dir where uuid = ?"
+        vals = [drive.uuid]
+        if drive.dir_hash_date is not None:
+            q += " and scan_time >= ?"
+            vals.append(drive.dir_hash_date)
+        for row in iter_query(opt, q, vals):
+            dirty.add(row.path)
+        live.update(dirty.intersection(known))
+        for rels in dirty, live:
+            for rel in list(rels):
+                while rel != '.':
+                    rel = os.path.dirname(rel) or '.'
+                    rels.add(rel)
+        # dirs only left by deleted files, which a scan has already
+        # dropped from the dir table, see prune_dirs()
+        dirty.intersection_update(live)
+
+        print("%s: %d directories to hash" % (drive.uuid_text, len(dirty)))
+        do_query(
+            opt,
+            "insert into dir (uuid, path) values (?, ?)",
+            [[drive.uuid, rel] for rel in dirty if rel not in known],
+            many=True,
+        )
+        commit(opt)
+
+        done = {}  # rel -> (hash, tree_files, tree_size) from this pass
+
+        def depth(rel):
+            return -1 if rel == '.' else rel.count('/')
+
+        # deepest first, so subdirectories are done before their parents
+        for rel in sorted(dirty, key=depth, reverse=True):
+            done[rel] = hash_dir(opt, drive.uuid, rel, done)
+            opt.n['dirs hashed'] += 1
+        do_query(
+            opt,
+            "update dir set hash=?, tree_files=?, tree_size=? "
+            "where uuid=? and path=?",
+            [list(v) + [drive.uuid, k] for k, v in done.items()],
+            many=True,
+        )
+        save_rec(opt, {'uuid': drive.uuid, 'dir_hash_date': opt.run_time})
+        commit(opt)
+
+
+def hash_dir(opt, uuid, rel, done):
+    """hash_dir - hash one directory for update_dir_hashes()
+
+    Args:
+        opt (argparse namespace): options
+        uuid (int): drive's key
+        rel (str): directory relative to mount point
+        done (dict): subdirectory results from this pass, which the DB
+            may not have yet (--dry-run)
+    Returns:
+        tuple: (hash or None, file count, total size)
+    """
+    # direct children only, by idx_file_parent / idx_dir_parent
+    vals = [uuid, '' if rel == '.' else rel + '/']
+    parts = []
+    files, size, complete = 0, 0, True
+    q = "select path, hash, hash_algo, st_size from file "
+    q += "where deleted is null and uuid = ? and %s = ?" % PARENT
+    for row in iter_query(opt, q, vals):
+        if row.hash is None:
+            complete = False
+            break
+        name = os.path.basename(row.path)
+        parts.append('f %s %s:%s' % (name, row.hash_algo or 'sha1', row.hash))
+        files += 1
+        size += row.st_size
+    if complete:
+        q = "select path, hash, tree_files, tree_size, st_ino from dir "
+        q += "where uuid = ? and %s = ?" % PARENT
+        for row in iter_query(opt, q, vals):
+            if row.path == '.':  # its PARENT is '' too
+                continue
+            hash_text, tree_files, tree_size = done.get(row.path, row[1:4])
+            if hash_text is None:
+                complete = False
+                break
+            if row.st_ino is None and not tree_files:
+                # no scan saw it, and its files are gone
+                continue
+            parts.append('d %s %s' % (os.path.basename(row.path), hash_text))
+            files += tree_files
+            size += tree_size
+    if not complete:
+        return None, None, None
+    ans = sha1()
+    for part in sorted(parts):
+        ans.update(part.encode('utf-8', 'surrogateescape') + b'\n')
+    return ans.hexdigest(), files, size
+
+
+def list_dupe_dirs(opt):
+    """List duplicate directories, see update_dir_hashes()
+
+    Directories inside a duplicated directory aren't listed separately,
+    unless they're also duplicated elsewhere.  Each directory's parent
+    is joined in the query, which is streamed a hash group at a time.
+
+    Args:
+        opt (argparse Namespace): options
+    """
+    # parent of 'a/b' is 'a', of 'a' is '.', '.' has none
+    q = """
+with dupe as (select hash from dir where hash is not null and tree_files > 0
+               group by hash having count(*) > 1)
+select dir.*, uuid_text, parent.hash in dupe as nested
+  from dir join uuid using (uuid)
+  left join dir as parent
+    on (parent.uuid = dir.uuid
+        and parent.path = case when dir.path = '.' then null
+            when instr(dir.path, '/')
+            then rtrim(rtrim(dir.path, replace(dir.path, '/', '')), '/')
+            else '.' end)
+ where dir.hash in dupe
+ order by dir.tree_size desc, dir.hash, uuid_text, dir.path
+"""
+
+    def show(group):
+        # only show groups with a member whose parent isn't a dupe
+        if all(member.nested for member in group):
+            return
+        first = group[0]
+        print(
+            "\n%s %s (%d files)"
+            % (first.hash, hr(first.tree_size), first.tree_files)
+        )
+        for member in group:
+            print("  %s %s" % (member.uuid_text, member.path))
+
+    group = []
+    for row in iter_query(opt, q):
+        if group and row.hash != group[0].hash:
+            show(group)
+            group = []
+        group.append(row)
+    if group:
+        show(group)
 
 
 def list_drivers(opt):
@@ -176,19 +714,25 @@ def can_path(path):
     return os.path.abspath(os.path.realpath(os.path.expanduser(path)))
 
 
-def do_query(opt, q, vals=None):
+def do_query(opt, q, vals=None, many=False):
     select = q.lower().strip().startswith('select')
     if opt.dry_run and not select:
         return
+    start = time.perf_counter()
     try:
-        opt.cur.execute(q, vals or [])
+        if many:
+            opt.cur.executemany(q, vals)
+        else:
+            opt.cur.execute(q, vals or [])
     except Exception:
         print(q)
         print(vals)
         raise
     if not select:
+        metrics.add_sql(opt.metrics, q, time.perf_counter() - start)
         return None
     res = opt.cur.fetchall()
+    metrics.add_sql(opt.metrics, q, time.perf_counter() - start)
     flds = [i[0] for i in opt.cur.description]
     if False:
         print(q)
@@ -200,6 +744,37 @@ def do_query(opt, q, vals=None):
     return [Dict(zip(flds, i)) for i in res]
 
 
+def iter_query(opt, q, vals=None):
+    """iter_query - yield rows from a select query as they're read
+
+    Unlike do_query(), rows aren't all fetched first and are read only
+    namedtuples rather than Dicts, and the query has its own cursor, so
+    other queries can run while this one is being consumed.
+
+    Args:
+        opt (argparse namespace): options
+        q (str): select query
+        vals (list): values for query
+    """
+    cur = opt.con.cursor()
+    sec = 0  # time spent in SQLite, not the caller
+    try:
+        start = time.perf_counter()
+        cur.execute(q, vals or [])
+        sec += time.perf_counter() - start
+        Row = namedtuple('Row', [i[0] for i in cur.description], rename=True)
+        while True:
+            start = time.perf_counter()
+            rows = cur.fetchmany(1000)
+            sec += time.perf_counter() - start
+            if not rows:
+                break
+            yield from map(Row._make, rows)
+    finally:
+        cur.close()
+        metrics.add_sql(opt.metrics, q, sec)
+
+
 def do_one(opt, q, vals=None):
     """Run a query expected to create a single record response"""
     ans = do_query(opt, q, vals=vals)
@@ -209,16 +784,128 @@ def do_one(opt, q, vals=None):
 
 
 def get_devs():
-    """get_devs - get output from `lsblk`
+    """get_devs - get block devices, as `lsblk --json` would
+
+    Uses devprobe.py from the parent directory, which reads /proc and /sys
+    directly, if it's there and finds UUIDs, otherwise runs lsblk.  It's
+    loaded from its file, so sys.path and any other devprobe module are
+    left alone.
 
     Returns:
         Dict: lsblk output
     """
+    if os.path.exists(DEVPROBE):
+        import importlib.util
+
+        spec = importlib.util.spec_from_file_location('devprobe', DEVPROBE)
+        devprobe = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(devprobe)
+        probed = devprobe.probe()
+        if any(dev['uuid'] for dev in probed.values()):
+            return Dict(devprobe.as_lsblk(probed))
+
+    from subprocess import Popen, PIPE
+
     cmd = Popen(['lsblk', '--json', '--output-all'], stdout=PIPE)
     out, err = cmd.communicate()
     return Dict(json.loads(out))
 
 
+def topology_signature():
+    """topology_signature - hash of the kernel's mount / partition tables
+
+    Returns:
+        str: hex hash, None if they can't be read
+    """
+    ans = sha1()
+    try:
+        for path in '/proc/self/mountinfo', '/proc/partitions':
+            with open(path, 'rb') as data:
+                ans.update(data.read())
+    except OSError:
+        return None
+    return ans.hexdigest()
+
+
+def cached_devs(opt):
+    """cached_devs - get_devs(), cached on disk for --devices-ttl seconds
+
+    The cache is also discarded if anything's been mounted / unmounted or
+    partitions have changed since it was saved.
+
+    Args:
+        opt (argparse namespace): options
+    Returns:
+        Dict: lsblk output
+    """
+    signature = topology_signature()
+    if opt.devices_ttl > 0:
+        try:
+            with open(DEVICES_CACHE) as inp:
+                cache = json.load(inp)
+            if (
+                cache['signature'] == signature
+                and signature is not None
+                and time.time() - cache['time'] < opt.devices_ttl
+            ):
+                return Dict(cache['devs'])
+        except (OSError, ValueError, KeyError):
+            pass
+    devs = get_devs()
+    if opt.devices_ttl > 0:
+        try:
+            os.makedirs(os.path.dirname(DEVICES_CACHE), exist_ok=True)
+            tmp = DEVICES_CACHE + '.%d' % os.getpid()
+            with open(tmp, 'w') as out:
+                json.dump(
+                    dict(time=time.time(), signature=signature, devs=devs), out
+                )
+            os.replace(tmp, DEVICES_CACHE)
+        except OSError:
+            pass  # caching's optional
+    return devs
+
+
+def get_mntpnts(opt):
+    """get_mntpnts - devices by UUID, found when first needed
+
+    Actions that only read the DB never run lsblk.
+
+    Args:
+        opt (argparse namespace): options
+    Returns:
+        dict: {UUID: Dict(lsblk device info)}
+    """
+    if opt.mntpnts is None:
+        with metrics.phase(opt.metrics, 'lsblk'):
+            opt.dev = cached_devs(opt)
+        opt.mntpnts = {}
+        index_devs(opt.dev["blockdevices"], opt.mntpnts)
+    return opt.mntpnts
+
+
+def index_devs(nodes, d, parent=None):
+    """index_devs - add lsblk device nodes with UUIDs to d, recursively
+
+    Args:
+        nodes ([dict]): lsblk device records
+        d (dict): {UUID: Dict(device info)} to update
+        parent (Dict): parent device of nodes
+    """
+    for node in nodes:
+        inf = Dict()
+        inf.update(node)
+        # copy values like model etc. down from parent records
+        if parent is not None:
+            for k, v in inf.items():
+                if v is None and k in inf:
+                    inf[k] = parent.get(k)
+        if node.get('uuid'):
+            d[node['uuid']] = inf
+
+        index_devs(node.get('children', []), d, parent=inf)
+
+
 def get_pk(opt, table, ident, return_obj=False, multi=False):
 
     if table in ident and ident[table] is None:
@@ -285,39 +972,122 @@ def get_recs(opt, table, ident):
     return get_rec(opt, table, ident, multi=True)
 
 
-def hash_path(path, callback=None):
+def hash_path(
+    path, callback=None, algo='sha1', blksize=BLKSIZE, use_mmap=False
+):
     """hash_path - hash a file path
 
+    Reads into a buffer reused by each thread rather than allocating a
+    new block per read, or hashes straight from an mmap() of the file.
+
     Args:
         path (str): path to file
+        callback (callable): called with bytes hashed so far, per block
+        algo (str): key in HASH_ALGOS
+        blksize (int): bytes per read
+        use_mmap (bool): hash from mmap() instead of read buffer
     Returns:
         str: hex hash for file
     """
-    ans = sha1()
+    ans = HASH_ALGOS[algo]()
     count = 0
     with open(path, 'rb') as data:
-        while True:
-            block = data.read(BLKSIZE)
-            ans.update(block)
-            if len(block) != BLKSIZE:
-                break
-            count += 1
-            if callback:
-                callback(count * BLKSIZE)
+        if use_mmap:
+            size = os.fstat(data.fileno()).st_size
+            if size:  # can't mmap() empty files
+                import mmap
+
+                with mmap.mmap(
+                    data.fileno(), 0, access=mmap.ACCESS_READ
+                ) as mapped, memoryview(mapped) as view:
+                    for start in range(0, size, blksize):
+                        ans.update(view[start : start + blksize])
+                        count += 1
+                        if callback and start + blksize < size:
+                            callback(count * blksize)
+        else:
+            buf = hash_buffer(blksize)
+            with memoryview(buf) as view:
+                while True:
+                    got = data.readinto(buf)
+                    ans.update(view[:got])
+                    if got != blksize:
+                        break
+                    count += 1
+                    if callback:
+                        callback(count * blksize)
 
     return ans.hexdigest()
 
 
-def proc_file(opt, dev, filepath):
-    if os.path.islink(filepath):
-        opt.n['sym. links (ignored)'] += 1
-        return
-    if not os.path.exists(filepath):
-        print(filepath, 'not found')
-        opt.n['offline/deleted'] += 1
-        return
-    stat = os.stat(filepath)
+_hash_buffers = threading.local()  # per thread buffer for hash_path()
+
+
+def hash_buffer(blksize):
+    """hash_buffer - this thread's read buffer for hash_path()
+
+    Args:
+        blksize (int): size of buffer
+    Returns:
+        bytearray: buffer, reused by later calls from the same thread
+    """
+    buf = getattr(_hash_buffers, 'buf', None)
+    if buf is None or len(buf) != blksize:
+        buf = _hash_buffers.buf = bytearray(blksize)
+    return buf
+
+
+def fingerprint_path(path):
+    """fingerprint_path - cheap partial hash of a file
+
+    Hashes the size and FP_SAMPLES blocks of FP_SAMPLE bytes spread from
+    the start to the end of the file, so files with different
+    fingerprints are certainly different, and files with the same
+    fingerprint are probably the same. Small files are read completely.
+
+    Args:
+        path (str): path to file
+    Returns:
+        str: hex fingerprint for file
+    """
+    ans = sha1()
+    with open(path, 'rb') as data:
+        size = os.fstat(data.fileno()).st_size
+        ans.update(str(size).encode('ascii'))
+        if size <= FP_SAMPLES * FP_SAMPLE:
+            ans.update(data.read())
+        else:
+            step = (size - FP_SAMPLE) // (FP_SAMPLES - 1)
+            for i in range(FP_SAMPLES):
+                data.seek(i * step)
+                ans.update(data.read(FP_SAMPLE))
+
+    return ans.hexdigest()
+
+
+def proc_file(opt, dev, filepath, stat=None):
+    """proc_file - check a file against the catalog
+
+    Args:
+        opt (argparse namespace): options
+        dev (Dict): device, see start_dev()
+        filepath (str): path to file
+        stat (os.stat_result): stat for file if walk_files() already
+            has it, otherwise links / existence are checked here
+    """
+    if stat is None:
+        if os.path.islink(filepath):
+            opt.n['sym. links (ignored)'] += 1
+            return
+        if not os.path.exists(filepath):
+            print(filepath, 'not found')
+            opt.n['offline/deleted'] += 1
+            return
+        stat = os.stat(filepath)
     opt.n['stated'] += 1
+    if opt.bulk:
+        proc_stat_bulk(opt, filepath, stat)
+        return
     file_rec, new = get_or_make_rec(
         opt,
         'file',
@@ -325,133 +1095,738 @@ def proc_file(opt, dev, filepath):
             uuid=opt.uuid, path=os.path.relpath(filepath, start=opt.mntpnt)
         ),
         defaults=dict(
-            st_ino=stat.st_ino, st_size=stat.st_size, st_mtime=stat.st_mtime
+            st_ino=stat.st_ino,
+            st_size=stat.st_size,
+            st_mtime=stat.st_mtime,
+            scan_gen=opt.scan_gen,
         ),
     )
 
     if not new:
+        mark_seen(opt, file_rec.file)
         # old/new pairs for size / mtime / inode
         stats = [(k, getattr(file_rec, k), getattr(stat, k)) for k in STATFLDS]
-        # name/old/new tuples for changed values, e.g. 'size',234,345
-        changes = [i for i in stats if i[1] != i[2]]
-        if changes:
-            opt.n['changed_stat'] += 1
-            print(
-                "%s changed (%s)"
-                % (filepath, ', '.join('%s:%s→%s' % i for i in changes))
-            )
-            if opt.accept_current:
-                for k in STATFLDS:
-                    setattr(file_rec, k, getattr(stat, k))
-                save_rec(opt, file_rec)
-        else:
-            opt.n['unchanged_stat'] += 1
+        if report_changes(opt, filepath, stats) and opt.accept_current:
+            for k in STATFLDS:
+                setattr(file_rec, k, getattr(stat, k))
+            file_rec.fingerprint = None
+            save_rec(opt, file_rec)
     else:
         opt.n['new'] += 1
 
 
-# ## def proc_dev(opt, dev):
-# ##     dev.setdefault('label', '???')
-# ##     print("{part} ({label}, {uuid}) on {mntpnt}".format(**dev))
-# ##     opt.base = os.path.relpath(opt.path, start=dev.mntpnt)
-# ##     opt.mntpnt = dev.mntpnt
-# ##     assert os.path.join(dev.mntpnt, opt.base) == opt.path
-
-
-def proc_dev(opt, uuid):
-    dev = opt.mntpnts[uuid]
-    dev.setdefault('label', '???')
-    print("{name} ({label}, {uuid}) on {mountpoint}".format(**dev))
-    opt.base = os.path.relpath(opt.path, start=dev.mountpoint)
-    opt.mntpnt = dev.mountpoint
-    assert os.path.join(dev.mountpoint, opt.base).rstrip('./') == opt.path, (
-        os.path.join(dev.mountpoint, opt.base),
-        opt.path,
-        opt.mntpnt,
-    )
+def report_changes(opt, filepath, stats):
+    """report_changes - count and report changed stat values for a file
 
-    print(opt.base)
-    rec, new = get_or_make_rec(opt, 'uuid', {'uuid_text': dev.uuid})
-    opt.uuid = rec.uuid
-    info = dict(
-        uuid=opt.uuid,
-        uuid_text=dev.uuid,
-        model=dev.model,
-        serial=dev.serial,
-        part_size=dev.size,
-    )
-    if new:
-        save_rec(opt, info)
+    Args:
+        opt (argparse namespace): options
+        filepath (str): path to file
+        stats ([(str, old, new)]): name/old/new tuples for STATFLDS
+    Returns:
+        bool: True if anything changed
+    """
+    # name/old/new tuples for changed values, e.g. 'size',234,345
+    changes = [i for i in stats if i[1] != i[2]]
+    if changes:
+        opt.n['changed_stat'] += 1
+        print(
+            "%s changed (%s)"
+            % (filepath, ', '.join('%s:%s→%s' % i for i in changes))
+        )
     else:
-        changed = [k for k in info if rec[k] != info[k]]
-        if changed:
-            print("\nUUID %s DESCRIPTION CHANGED" % dev.uuid)
-            for k in changed:
-                print("%s → %s" % (rec[k], info[k]))
-            print()
-
-    print('\n'.join("%s: %s" % (k, v) for k, v in info.items()))
-    assert opt.uuid, opt.uuid
-    c = 0
-    for path, dirs, files in os.walk(opt.path):
-        for filename in files:
-            proc_file(opt, dev, os.path.join(path, filename))
-            c += 1
+        opt.n['unchanged_stat'] += 1
+    return bool(changes)
 
 
-def main():
+def load_known(opt):
+    """load_known - preload catalog rows under opt.base for --bulk scans
 
-    opt = get_options()
-    run_opt(opt)
+    One query replaces the per-file lookups get_or_make_rec() would do.
+
+    Args:
+        opt (argparse namespace): options
+    Returns:
+        dict: {path: (file, st_size, st_mtime, st_ino)}, STATFLDS order
+    """
+    q = "select path, file, {} from file where uuid = ?".format(
+        ', '.join(STATFLDS)
+    )
+    vals = [opt.uuid]
+    if opt.base != '.':
+        # range on path uses idx_file_path, unlike LIKE
+        q += " and (path = ? or (path > ? and path < ?))"
+        vals += [opt.base, opt.base + '/', opt.base + chr(ord('/') + 1)]
+    cur = opt.con.cursor()
+    cur.execute(q, vals)
+    return {row[0]: row[1:] for row in cur}
+
+
+def proc_stat_bulk(opt, filepath, stat):
+    """proc_stat_bulk - --bulk version of proc_file()'s catalog update
+
+    Compares stat with the preloaded opt.batch.known, queuing new and
+    (with --accept-current) changed rows for flush_bulk().
+
+    Args:
+        opt (argparse namespace): options
+        filepath (str): path to file
+        stat (os.stat_result): stat for file
+    """
+    path = os.path.relpath(filepath, start=opt.mntpnt)
+    old = opt.batch.known.get(path)
+    new = [getattr(stat, k) for k in STATFLDS]
+    if old is None:
+        opt.n['new'] += 1
+        opt.batch.new.append([opt.uuid, path, opt.scan_gen] + new)
+    else:
+        mark_seen(opt, old[0])
+        stats = list(zip(STATFLDS, old[1:], new))
+        if report_changes(opt, filepath, stats) and opt.accept_current:
+            opt.batch.changed.append(new + [old[0]])
+    if len(opt.batch.new) + len(opt.batch.changed) >= BULK_BATCH:
+        flush_bulk(opt)
+
+
+def flush_bulk(opt):
+    """flush_bulk - write rows queued by proc_stat_bulk()
+
+    Uses executemany() on the main cursor, so everything stays in the
+    transaction run_opt() commits at the end of the scan.
+
+    Args:
+        opt (argparse namespace): options
+    """
+    if not opt.dry_run:
+        if opt.batch.new:
+            opt.cur.executemany(
+                "insert into file (uuid, path, scan_gen, {}) "
+                "values (?, ?, ?, {})".format(
+                    ', '.join(STATFLDS), ', '.join('?' * len(STATFLDS))
+                ),
+                opt.batch.new,
+            )
+        if opt.batch.changed:
+            opt.cur.executemany(
+                "update file set {}, fingerprint=null where file = ?".format(
+                    ', '.join('%s=?' % k for k in STATFLDS)
+                ),
+                opt.batch.changed,
+            )
+    opt.batch.new = []
+    opt.batch.changed = []
+
+
+def scan_dir(path):
+    """scan_dir - list one directory for walk_files()
+
+    Uses the DirEntry's cached type info, so only regular files and dirs
+    cost a syscall (lstat), and stats them in inode order to cut seeks.
+
+    Args:
+        path (str): directory to list
+    Returns:
+        Dict: files [(path, stat)], dirs [(path, stat)], links (count),
+            gone [path], n_child (count), or None if the directory can't
+            be read
+    """
+    try:
+        with os.scandir(path) as it:
+            entries = sorted(it, key=lambda entry: entry.inode())
+    except OSError:
+        return None
+    ans = Dict(files=[], dirs=[], links=0, gone=[], n_child=len(entries))
+    for entry in entries:
+        try:
+            if entry.is_dir(follow_symlinks=False):
+                ans.dirs.append(
+                    (entry.path, entry.stat(follow_symlinks=False))
+                )
+            elif entry.is_symlink():
+                # os.walk() lists links to dirs as dirs, not files
+                if not entry.is_dir():
+                    ans.links += 1
+            else:
+                ans.files.append(
+                    (entry.path, entry.stat(follow_symlinks=False))
+                )
+        except FileNotFoundError:
+            ans.gone.append(entry.path)
+    return ans
+
+
+def visit_dir(opt, path, stat):
+    """visit_dir - scan_dir(), unless the directory hasn't changed
+
+    A directory whose inode and mtime match the dir table isn't listed,
+    its files are trusted, and its subdirectories come from the dir
+    table, unless --full is used.  A directory with an mtime after the
+    start of its last scan may have changed during that scan, so is
+    listed anyway.
+
+    Args:
+        opt (argparse namespace): options, only read here
+        path (str): directory
+        stat (os.stat_result): lstat for directory
+    Returns:
+        Dict: see scan_dir(), plus rel (path relative to mount point),
+            stat, and listed (False if trusted), or just rel and
+            unreadable
+    """
+    rel = os.path.relpath(path, start=opt.mntpnt)
+    old = opt.dirs.get(rel)  # (dir, st_ino, st_mtime, n_child, scan_time)
+    if (
+        not opt.full
+        and old
+        and (old[1], old[2]) == (stat.st_ino, stat.st_mtime)
+        and stat.st_mtime < old[4] - 2  # 2 sec. for FAT's mtime resolution
+    ):
+        ans = Dict(files=[], dirs=[], links=0, gone=[], n_child=old[3])
+        for name in opt.dir_children.get(rel, []):
+            try:
+                subdir = os.path.join(path, name)
+                ans.dirs.append((subdir, os.lstat(subdir)))
+            except FileNotFoundError:
+                pass
+        ans.listed = False
+    else:
+        ans = scan_dir(path)
+        if ans is None:
+            return Dict(rel=rel, unreadable=True)
+        ans.listed = True
+    # other devices mounted here are scanned as themselves
+    ans.dirs = [i for i in ans.dirs if i[1].st_dev == stat.st_dev]
+    ans.rel = rel
+    ans.stat = stat
+    return ans
+
+
+def load_dirs(opt):
+    """load_dirs - preload dir table rows for opt.uuid for visit_dir()
+
+    Sets opt.dirs, {path: (dir, st_ino, st_mtime, n_child, scan_time)},
+    and opt.dir_children, {path: [subdir name]}.
+
+    Args:
+        opt (argparse namespace): options
+    """
+    opt.dirs = {}
+    opt.dir_children = defaultdict(list)
+    cur = opt.con.cursor()
+    cur.execute(
+        "select path, dir, st_ino, st_mtime, n_child, scan_time "
+        "from dir where uuid = ?",
+        [opt.uuid],
+    )
+    for row in cur:
+        opt.dirs[row[0]] = row[1:]
+        parent, _, name = row[0].rpartition('/')
+        if row[0] != '.':
+            opt.dir_children[parent or '.'].append(name)
+    opt.dir_batch = []
+
+
+def flush_dirs(opt):
+    """flush_dirs - save dir table rows for directories walk_files() listed
+
+    Directories with unaccepted changes aren't queued, see scan_listing().
+
+    Args:
+        opt (argparse namespace): options
+    """
+    new, changed = [], []
+    for rel, stat, n_child in opt.dir_batch:
+        vals = [stat.st_ino, stat.st_mtime, n_child, opt.run_time]
+        if rel in opt.dirs:
+            changed.append(vals + [opt.dirs[rel][0]])
+        else:
+            new.append([opt.uuid, rel] + vals)
+    opt.dir_batch = []
+    if opt.dry_run:
+        return
+    opt.cur.executemany(
+        "insert into dir (uuid, path, st_ino, st_mtime, n_child, scan_time) "
+        "values (?, ?, ?, ?, ?, ?)",
+        new,
+    )
+    opt.cur.executemany(
+        "update dir set st_ino=?, st_mtime=?, n_child=?, scan_time=? "
+        "where dir = ?",
+        changed,
+    )
+
+
+def walk_files(opt, top):
+    """walk_files - yield a listing for each directory under top
+
+    Only reads the filesystem, and the options / dir table preloaded by
+    start_dev(), so it can run in a device's walker thread, see
+    scan_devs().  Directories on other devices aren't entered.
+
+    Args:
+        opt (argparse namespace): options, only read here
+        top (str): directory to walk
+    Yields:
+        Dict: see visit_dir(), --walker walk gives files, links and gone
+            for each directory, or rel and unreadable
+    """
+    if opt.walker == 'walk':
+        errors = []
+        for path, dirs, files in os.walk(top, onerror=errors.append):
+            dirs[:] = [
+                i for i in dirs if not os.path.ismount(os.path.join(path, i))
+            ]
+            listing = Dict(files=[], links=0, gone=[])
+            for filename in files:
+                filepath = os.path.join(path, filename)
+                if os.path.islink(filepath):
+                    listing.links += 1
+                    continue
+                try:
+                    listing.files.append((filepath, os.stat(filepath)))
+                except FileNotFoundError:
+                    listing.gone.append(filepath)
+            yield listing
+            while errors:
+                rel = os.path.relpath(errors.pop().filename, start=opt.mntpnt)
+                yield Dict(rel=rel, unreadable=True)
+        for err in errors:  # top itself
+            rel = os.path.relpath(err.filename, start=opt.mntpnt)
+            yield Dict(rel=rel, unreadable=True)
+        return
+
+    if opt.walk_workers <= 1:
+        todo = [(top, os.lstat(top))]
+        while todo:
+            listing = visit_dir(opt, *todo.pop())
+            todo.extend(reversed(listing.dirs or []))
+            yield listing
+        return
+    from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+    with ThreadPoolExecutor(opt.walk_workers) as pool:
+        pending = {pool.submit(visit_dir, opt, top, os.lstat(top))}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                listing = future.result()
+                pending.update(
+                    pool.submit(visit_dir, opt, *i) for i in listing.dirs or []
+                )
+                yield listing
+
+
+def scan_listing(opt, listing):
+    """scan_listing - update the catalog from a walk_files() listing
+
+    Counters in opt.n and the DB are only updated here, in the DB
+    writer's thread.
+
+    Args:
+        opt (argparse namespace): options, see start_dev()
+        listing (Dict): from walk_files()
+    """
+    if listing.rel:
+        opt.seen_dirs.add(listing.rel)
+    if listing.unreadable:
+        opt.n['unreadable dirs'] += 1
+        opt.unseen_dirs.append((listing.rel, True))
+        return
+    if listing.listed is False:
+        opt.n['dirs unchanged'] += 1
+        opt.unseen_dirs.append((listing.rel, False))
+    opt.n['sym. links (ignored)'] += listing.links
+    for filepath in listing.gone:
+        print(filepath, 'not found')
+        opt.n['offline/deleted'] += 1
+    changed = opt.n['changed_stat']
+    for filepath, stat in listing.files:
+        proc_file(opt, opt.device, filepath, stat=stat)
+    if listing.listed:
+        opt.n['dirs listed'] += 1
+        # a dir with changes that weren't accepted keeps its old row, so
+        # it's listed again next time, when --accept-current can see them
+        if opt.accept_current or opt.n['changed_stat'] == changed:
+            opt.dir_batch.append((listing.rel, listing.stat, listing.n_child))
+        if len(opt.dir_batch) >= BULK_BATCH:
+            flush_dirs(opt)
+
+
+def mark_seen(opt, pk):
+    """mark_seen - queue a file record as seen by this scan
+
+    Args:
+        opt (argparse namespace): options
+        pk (int): file record's key
+    """
+    opt.seen.append((opt.scan_gen, pk))
+    if len(opt.seen) >= BULK_BATCH:
+        flush_seen(opt)
+
+
+def flush_seen(opt):
+    """flush_seen - stamp files queued by mark_seen() with opt.scan_gen
+
+    Args:
+        opt (argparse namespace): options
+    """
+    if not opt.dry_run:
+        opt.cur.executemany(
+            "update file set scan_gen=?, deleted=null where file=?", opt.seen
+        )
+    opt.seen = []
+
+
+def path_range(rel):
+    """path_range - SQL condition / values for paths under rel
+
+    Uses a range on path rather than LIKE so the (uuid, path) indexes
+    are used, see PARENT for paths directly in rel.
+
+    Args:
+        rel (str): directory relative to mount point
+    Returns:
+        tuple: (condition, [values])
+    """
+    if rel == '.':
+        return "path != '.'", []
+    return "(path > ? and path < ?)", [rel + '/', rel + chr(ord('/') + 1)]
+
+
+def flag_deleted(opt):
+    """flag_deleted - flag files this scan didn't see as deleted
+
+    One set based update for all files under opt.base not stamped with
+    opt.scan_gen, except those in directories visit_dir() trusted or
+    couldn't read.  Those directories go in a temp table, matched on
+    each file's exact parent, or as a range for unreadable subtrees, so
+    their files aren't rewritten.
+
+    Args:
+        opt (argparse namespace): options
+    """
+    flush_seen(opt)
+    if opt.dry_run:
+        return
+    if ('.', True) not in opt.unseen_dirs:  # else nothing can be flagged
+        opt.cur.execute("drop table if exists temp.unseen_dir")
+        opt.cur.execute(
+            "create temp table unseen_dir "
+            "(prefix text primary key, prefix_end text, recurse integer)"
+        )
+        rows = {}  # prefix: (prefix, prefix_end, recurse)
+        for rel, recurse in opt.unseen_dirs:
+            if rel == '.':
+                rows[''] = ('', '', 0)  # top level files, parent ''
+            else:
+                prefix = rel + '/'
+                recurse = recurse or rows.get(prefix, (0, 0, 0))[2]
+                rows[prefix] = (prefix, rel + chr(ord('/') + 1), recurse)
+        opt.cur.executemany(
+            "insert into unseen_dir values (?, ?, ?)", rows.values()
+        )
+        cond, vals = path_range(opt.base)
+        opt.cur.execute(
+            "update file set deleted=? where uuid=? and deleted is null "
+            "and (scan_gen is null or scan_gen != ?) and " + cond + " "
+            "and " + PARENT + " not in (select prefix from unseen_dir) "
+            "and not exists (select 1 from unseen_dir where recurse "
+            "and path > prefix and path < prefix_end)",
+            [opt.run_time, opt.uuid, opt.scan_gen] + vals,
+        )
+        opt.n['deleted'] += opt.cur.rowcount
+    save_rec(opt, {'uuid': opt.uuid, 'scan_gen': opt.scan_gen})
+
+
+def prune_dirs(opt):
+    """prune_dirs - drop dir table rows for directories that are gone
+
+    Rows under opt.base for directories this scan didn't reach, except
+    under unreadable directories, are deleted, so update_dir_hashes()
+    doesn't count them.  --walker walk doesn't report directories, so
+    nothing is pruned.
+
+    Args:
+        opt (argparse namespace): options, see start_dev()
+    """
+    if opt.dry_run or opt.walker == 'walk' or ('.', True) in opt.unseen_dirs:
+        return
+    unreadable = [rel + '/' for rel, recurse in opt.unseen_dirs if recurse]
+    gone = [
+        (row[0],)
+        for rel, row in opt.dirs.items()
+        if rel not in opt.seen_dirs
+        and (opt.base == '.' or (rel + '/').startswith(opt.base + '/'))
+        and not any(rel.startswith(i) for i in unreadable)
+    ]
+    opt.cur.executemany("delete from dir where dir = ?", gone)
+    opt.n['dirs gone'] += len(gone)
+
+
+# ## def proc_dev(opt, dev):
+# ##     dev.setdefault('label', '???')
+# ##     print("{part} ({label}, {uuid}) on {mntpnt}".format(**dev))
+# ##     opt.base = os.path.relpath(opt.path, start=dev.mntpnt)
+# ##     opt.mntpnt = dev.mntpnt
+# ##     assert os.path.join(dev.mntpnt, opt.base) == opt.path
+
+
+def start_dev(opt, uuid, path):
+    """start_dev - set up scanning path on device uuid
+
+    Args:
+        opt (argparse namespace): options
+        uuid (str): device's UUID, key in get_mntpnts()
+        path (str): directory to scan
+    Returns:
+        argparse namespace: opt, plus state for this device's scan
+    """
+    opt = argparse.Namespace(**vars(opt))  # shares con, n, etc.
+    opt.path = path
+    dev = opt.device = get_mntpnts(opt)[uuid]
+    dev.setdefault('label', '???')
+    print("{name} ({label}, {uuid}) on {mountpoint}".format(**dev))
+    opt.base = os.path.relpath(opt.path, start=dev.mountpoint)
+    opt.mntpnt = dev.mountpoint
+    # normpath(), not rstrip('./'), which turns '/.' for / into ''
+    here = os.path.normpath(os.path.join(dev.mountpoint, opt.base))
+    assert here == os.path.normpath(opt.path), (here, opt.path, opt.mntpnt)
+
+    print(opt.base)
+    rec, new = get_or_make_rec(opt, 'uuid', {'uuid_text': dev.uuid})
+    opt.uuid = rec.uuid
+    info = dict(
+        uuid=opt.uuid,
+        uuid_text=dev.uuid,
+        model=dev.model,
+        serial=dev.serial,
+        part_size=dev.size,
+    )
+    if new:
+        save_rec(opt, info)
+    else:
+        changed = [k for k in info if rec[k] != info[k]]
+        if changed:
+            print("\nUUID %s DESCRIPTION CHANGED" % dev.uuid)
+            for k in changed:
+                print("%s → %s" % (rec[k], info[k]))
+            print()
+
+    print('\n'.join("%s: %s" % (k, v) for k, v in info.items()))
+    assert opt.uuid, opt.uuid
+    opt.scan_gen = (rec.scan_gen or 0) + 1
+    opt.seen = []  # (scan_gen, file) for flush_seen()
+    opt.unseen_dirs = []  # (rel, recurse) for flag_deleted()
+    opt.seen_dirs = set()  # rel for prune_dirs()
+    if opt.bulk:
+        opt.batch = Dict(known=load_known(opt), new=[], changed=[])
+    load_dirs(opt)
+    return opt
+
+
+def finish_dev(opt):
+    """finish_dev - write what's left of a start_dev() scan
+
+    Also frees the scan's preloaded catalog and dir table.
+
+    Args:
+        opt (argparse namespace): options, from start_dev()
+    """
+    if opt.bulk:
+        flush_bulk(opt)
+        opt.batch = None
+    flush_dirs(opt)
+    with metrics.phase(opt.metrics, 'flag deleted'):
+        flag_deleted(opt)
+        prune_dirs(opt)
+    opt.dirs = opt.dir_children = opt.seen_dirs = None
+
+
+def scan_devs(opt, roots):
+    """scan_devs - scan (UUID, path) roots, one walker thread per disk
+
+    Roots on the same disk, see hash_device(), share a thread, so total
+    time approaches that of the slowest disk.  This thread is the single
+    DB writer, see scan_listing(), and calls start_dev() for each root
+    only when its walker gets to it, so only roots being walked have
+    their catalog rows and dir table loaded.
+
+    Args:
+        opt (argparse namespace): options
+        roots ([(str, str)]): (UUID, path) pairs, see scan_roots()
+    """
+    import queue
+
+    # (kind, scan / root, listing / reply queue / error)
+    listings = queue.Queue(SCAN_BACKLOG)
+
+    def walk(group):
+        started = queue.Queue(1)  # start_dev() result for this walker
+        try:
+            for root in group:
+                listings.put(('start', root, started))
+                scan = started.get()
+                if scan is None:  # start_dev() failed
+                    return
+                for listing in walk_files(scan, scan.path):
+                    listings.put(('listing', scan, listing))
+                listings.put(('done', scan, None))
+        except Exception as err:
+            listings.put(('error', None, err))
+
+    groups = defaultdict(list)
+    for uuid, path in roots:
+        groups[hash_device(opt, get_mntpnts(opt)[uuid])[0]].append(
+            (uuid, path)
+        )
+    for group in groups.values():
+        threading.Thread(target=walk, args=(group,), daemon=True).start()
+    todo = len(roots)
+    while todo:
+        with metrics.phase(opt.metrics, 'scan wait'):
+            kind, scan, item = listings.get()
+        if kind == 'error':
+            raise item
+        if kind == 'start':
+            try:
+                item.put(start_dev(opt, *scan))
+            except BaseException:
+                item.put(None)  # stops the walker waiting for it
+                raise
+        elif kind == 'listing':
+            scan_listing(scan, item)
+        else:
+            finish_dev(scan)
+            todo -= 1
+
+
+def main():
+
+    opt = get_options()
+    run_opt(opt)
 
 
 def run_opt(opt):
 
-    if opt.path:
-        canonical = can_path(opt.path)
-        if opt.path != canonical:
-            print("%s -> %s" % (opt.path, canonical))
-            opt.path = canonical
-        opt.stat = os.stat(opt.path)
+    for i, path in enumerate(opt.path or []):
+        canonical = can_path(path)
+        if path != canonical:
+            print("%s -> %s" % (path, canonical))
+            opt.path[i] = canonical
     opt.run_time = int(time.time())
-    opt.con, opt.cur = get_or_make_db(opt)
+    opt.metrics = metrics.new_metrics()
+    opt.start = time.perf_counter(), time.process_time()  # for save_run()
+    with metrics.phase(opt.metrics, 'open db'):
+        opt.con, opt.cur = get_or_make_db(opt)
+    if opt.metrics_json or opt.metrics_prom:
+        metrics.trace_statements(opt.metrics, opt.con)
     opt.n = defaultdict(lambda: 0)
     opt.n['run_time'] = time.time()
-    opt.dev = get_devs()
-    opt.mntpnts = {}
-
-    def mntpnts(nodes, d, parent=None):
-        for node in nodes:
-            inf = Dict()
-            inf.update(node)
-            # copy values like model etc. down from parent records
-            if parent is not None:
-                for k, v in inf.items():
-                    if v is None and k in inf:
-                        inf[k] = parent.get(k)
-            if node.get('uuid'):
-                d[node['uuid']] = inf
-
-            mntpnts(node.get('children', []), d, parent=inf)
-
-    mntpnts(opt.dev["blockdevices"], opt.mntpnts)
-
-    for action in ['list_dupes', 'list_files', 'update_hashes', 'list_drives']:
+    opt.dev = opt.mntpnts = None  # see get_mntpnts()
+
+    for action in [
+        'list_dupes',
+        'list_files',
+        'update_hashes',
+        'list_drives',
+        'list_deleted',
+        'forget_deleted',
+        'update_dir_hashes',
+        'list_dupe_dirs',
+        'chunk_diff',
+    ]:
         if getattr(opt, action):
-            globals()[action](opt)
-            return
-
-    majmin = '%s:%s' % (os.major(opt.stat.st_dev), os.minor(opt.stat.st_dev))
-    for uuid in opt.mntpnts:
-        if opt.mntpnts[uuid]['maj:min'] == majmin:
-            proc_dev(opt, uuid)
+            with metrics.phase(opt.metrics, action):
+                globals()[action](opt)
             break
     else:
-        raise Exception("No device for path %s" % opt.path)
+        action = 'scan'
+        with metrics.phase(opt.metrics, action):
+            scan_devs(opt, scan_roots(opt))
+        commit(opt)
+        show_stats(opt)
+
+    save_run(opt, action)
+
+
+def commit(opt):
+    """commit - commit opt.con, timed as the 'commit' phase"""
+    with metrics.phase(opt.metrics, 'commit'):
+        opt.con.commit()
+
+
+def save_run(opt, action):
+    """save_run - save a run's summary to the run table, export metrics
+
+    Runs of LISTING_ACTIONS only export metrics, so they don't write to
+    the DB.
+
+    Args:
+        opt (argparse namespace): options
+        action (str): what the run did
+    """
+    wall = time.perf_counter() - opt.start[0]
+    cpu = time.process_time() - opt.start[1]
+    counters = dict(opt.n, run_time=wall)
+    if opt.metrics_json:
+        metrics.write_file(
+            opt.metrics_json, metrics.as_json(opt.metrics, counters)
+        )
+    if opt.metrics_prom:
+        metrics.write_file(
+            opt.metrics_prom, metrics.as_prometheus(opt.metrics, counters)
+        )
+    if action in LISTING_ACTIONS:
+        return
+    do_query(
+        opt,
+        "insert into run (run_time, action, paths, wall, cpu, counters, "
+        "metrics) values (?, ?, ?, ?, ?, ?, ?)",
+        [
+            opt.run_time,
+            action,
+            json.dumps(opt.path),
+            wall,
+            cpu,
+            json.dumps(counters),
+            metrics.as_json(opt.metrics, {}),
+        ],
+    )
+    commit(opt)
 
-    opt.con.commit()
 
-    show_stats(opt)
+def scan_roots(opt):
+    """scan_roots - devices and paths to scan for --path / --all-mounted
+
+    Args:
+        opt (argparse namespace): options
+    Returns:
+        [(str, str)]: (UUID, path) pairs
+    """
+    if opt.all_mounted:
+        return [
+            (uuid, dev.mountpoint)
+            for uuid, dev in get_mntpnts(opt).items()
+            # skip [SWAP] etc.
+            if dev.mountpoint and dev.mountpoint.startswith('/')
+        ]
+    if not opt.path:
+        raise FileKeeperError("No action, --path, or --all-mounted")
+    roots = []
+    for path in opt.path:
+        st_dev = os.stat(path).st_dev
+        majmin = '%s:%s' % (os.major(st_dev), os.minor(st_dev))
+        for uuid, dev in get_mntpnts(opt).items():
+            if dev['maj:min'] == majmin:
+                break
+        else:
+            raise Exception("No device for path %s" % path)
+        for other_uuid, other in roots:
+            if other_uuid == uuid and (
+                os.path.commonpath([path, other]) in (path, other)
+            ):
+                raise FileKeeperError("%s overlaps %s" % (path, other))
+        roots.append((uuid, path))
+    return roots
 
 
 def get_or_make_db(opt):
@@ -465,15 +1840,79 @@ def get_or_make_db(opt):
     else:
         con = sqlite3.connect(opt.db_file)
     if not exists:
-        for cmd in open('file_db.sql').read().split(';\n'):
-            con.execute(cmd)
-            # can't use do_query here, it uses opt.cur
-            # which doesn't exist yet, that's OK
+        with open(SCHEMA) as schema:
+            for cmd in schema.read().split(';\n'):
+                con.execute(cmd)
+                # can't use do_query here, it uses opt.cur
+                # which doesn't exist yet, that's OK
+        con.execute("pragma user_version = %d" % len(MIGRATIONS))
+    else:
+        migrate_db(opt, con)
     con.commit()
+    set_profile(opt, con)
     cur = con.cursor()
     return con, cur
 
 
+def migrate_db(opt, con):
+    """migrate_db - apply MIGRATIONS an existing DB hasn't had yet
+
+    Each migration is one transaction, and only adds columns / indexes,
+    so large DBs upgrade in place.
+
+    Args:
+        opt (argparse namespace): options
+        con (sqlite3.Connection): DB connection
+    """
+    version = con.execute("pragma user_version").fetchone()[0]
+    if version > len(MIGRATIONS):
+        raise FileKeeperError(
+            "DB '%s' is version %d, newer than this file_db.py (%d)"
+            % (opt.db_file, version, len(MIGRATIONS))
+        )
+    if version < len(MIGRATIONS) and opt.dry_run:
+        raise FileKeeperError(
+            "--dry-run: DB '%s' needs upgrading from version %d to %d, "
+            "run without --dry-run first"
+            % (opt.db_file, version, len(MIGRATIONS))
+        )
+    for version in range(version, len(MIGRATIONS)):
+        print("Upgrading DB to version %d" % (version + 1))
+        con.execute("begin")
+        for step in MIGRATIONS[version]:
+            if isinstance(step, tuple):
+                table, column, type_ = step
+                have = [
+                    i[1] for i in con.execute("pragma table_info(%s)" % table)
+                ]
+                if column not in have:
+                    con.execute(
+                        "alter table %s add column %s %s"
+                        % (table, column, type_)
+                    )
+            else:
+                con.execute(step)
+        con.execute("pragma user_version = %d" % (version + 1))
+        con.commit()
+
+
+def set_profile(opt, con):
+    """set_profile - apply a DB_PROFILES entry to a connection
+
+    Args:
+        opt (argparse namespace): options
+        con (sqlite3.Connection): DB connection
+    """
+    profile = opt.connection_profile
+    if profile == 'auto':
+        listing = any(getattr(opt, i) for i in LISTING_ACTIONS)
+        profile = 'read' if listing or opt.dry_run else 'scan'
+    for pragma, value in DB_PROFILES[profile]:
+        if pragma == 'journal_mode' and opt.dry_run:
+            continue  # can't change on a read only connection
+        con.execute("pragma %s = %s" % (pragma, value))
+
+
 def save_rec(opt, rec):
     """save_rec - save a modified record
 
@@ -501,108 +1940,592 @@ def show_stats(opt):
 def update_hashes(opt):
     """update_hashes - update hashes, oldest first
 
-    Maybe hash files where more than one of st_size exists.
+    With --dupes-only, only files sharing st_size are considered, and
+    they're fingerprinted first, see fingerprint_path(), so only files
+    whose size and fingerprint both match get a full hash.
 
     Args:
         opt (argparse namespace): options
     """
-    q = """
-create temp view if not exists up_hash as select *
-  from file join uuid using (uuid)
-"""
     if opt.dupes_only:
-        q += """
-       join (select st_size as class,
-                    count(*) as ccount from file group by st_size) as x
-            on (st_size = class)"""
-    q += "\nwhere (%s-hash_date > %s or hash is null)" % (
-        # float()/int() here are redundant, but eliminate SQL injection
-        float(time.time()),
-        24 * 60 * 60 * int(opt.max_hash_age),
-    )
-    if opt.dupes_only:
-        q += " and x.ccount > 1"
+        hash_stage(opt, 'fingerprint')
+    hash_stage(opt, 'hash')
+
+
+def hash_stage(opt, field):
+    """hash_stage - update one of the hash fields, see update_hashes()
+
+    Args:
+        opt (argparse namespace): options
+        field (str): 'fingerprint' or 'hash'
+    """
+    view = 'up_%s' % field
+    # size classes with more than one file, materialized once so
+    # hash_todo()'s pages don't repeat the group by
+    if field == 'fingerprint':
+        classes = "hash_class (class integer primary key)"
+        select = "select st_size from file where deleted is null "
+        select += "group by st_size"
+        join = "on (st_size = class)"
+    else:
+        classes = "hash_class (class integer, fp_class text, "
+        classes += "primary key (class, fp_class))"
+        select = "select st_size, fingerprint from file "
+        select += "where fingerprint is not null and deleted is null "
+        select += "group by st_size, fingerprint"
+        join = "on (st_size = class and fingerprint = fp_class)"
+    if field == 'fingerprint' or opt.dupes_only:
+        do_query(opt, "drop table if exists temp.hash_class")
+        do_query(opt, "create temp table " + classes)
+        do_query(opt, "insert into hash_class %s having count(*) > 1" % select)
+
+    q = "create temp view if not exists %s as select *" % view
+    q += "\n  from file join uuid using (uuid)\n"
+    if field == 'fingerprint':
+        q += " join hash_class %s" % join
+        q += " where fingerprint is null and deleted is null"
+    else:
+        if opt.dupes_only:
+            q += " join hash_class %s" % join
+        q += "\nwhere deleted is null"
+        q += " and (%s-hash_date > %s or hash is null" % (
+            # float()/int() here are redundant, but eliminate SQL injection
+            float(time.time()),
+            24 * 60 * 60 * int(opt.max_hash_age),
+        )
+        if opt.dupes_only:
+            # hashes are only comparable with the same algorithm
+            assert opt.hash_algo in HASH_ALGOS
+            algo = "'%s'" % opt.hash_algo
+            if opt.chunk_size:
+                algo = "case when st_size > %d then '%s' else %s end" % (
+                    chunk_bytes(opt),
+                    hash_algo_name(opt, chunk_bytes(opt) + 1),
+                    algo,
+                )
+            q += " or coalesce(hash_algo, 'sha1') != %s" % algo
+        q += ")"
 
     do_query(opt, q)
 
-    q_summary = "select count(*) as count, sum(st_size) as total from up_hash"
+    q_summary = "select count(*) as count, sum(st_size) as total from " + view
     count = do_one(opt, q_summary)
     count, total = count.count, count.total
 
-    print("%s hashes to update" % count)
+    print(
+        "%s %s to update"
+        % (count, 'hashes' if field == 'hash' else 'fingerprints')
+    )
 
-    at_once = 300
-    # do this in blocks of `at_once` working backwards because
-    # relying on updating of hashes to remove them from the todo
-    # list (working blockwise *forward* through the list) won't
-    # work when files are deleted / on unmounted drives.
-    offset = count // at_once
-
-    done = 0  # count of files done
-    read = 0  # total bytes read
-    safe = 0  # bytes read since last commit
-    start = time.time()
-    prog = 0  # time of last progress message
-    while offset >= 0:
-        todo = do_query(
-            opt,
-            "select * from up_hash limit ? offset ?",
-            [at_once, offset * at_once],
+    prog = Dict(count=count, total=total, done=0, read=0, safe=0)
+    prog.physical = 0  # bytes actually read, links to an inode read once
+    prog.field = field
+    prog.start = time.time()
+    prog.last = 0  # time of last progress message
+    hash_recs(opt, hash_todo(opt, view), prog)
+    commit(opt)
+    if prog.read:
+        print(
+            "%s %s, %s read for %s of files"
+            % (
+                prog.done,
+                'hashed' if field == 'hash' else 'fingerprinted',
+                hr(prog.physical),
+                hr(prog.read),
+            )
         )
-        offset -= 1
-        for rec in todo:
-            now = time.time()
-            if now - prog > 5:  # every 5 seconds
-                print(
-                    "{}/{} ({}/{}, {:.2f}%, "
-                    "{:.1f}/{:.1f} min., {}/s)".format(
-                        done,
-                        count,
-                        hr(read),
-                        hr(total),
-                        read / total * 100,
-                        (now - start) / 60,
-                        (now - start) / 60 * (total / read) if read else -1,
-                        hr(int(read / (now - start))),
+
+
+def hash_todo(opt, view):
+    """hash_todo - yield records from a hash_stage() view
+
+    Pages through the view by primary key, each page starting after the
+    last key seen, so the cost of a page doesn't grow with its position,
+    and records that stay in the view because they couldn't be hashed
+    (deleted / on unmounted drives) are neither revisited nor cause
+    others to be skipped.
+
+    Args:
+        opt (argparse namespace): options
+        view (str): name of view
+    """
+    at_once = 300
+    last = None  # key of last record seen
+    while True:
+        q = "select * from %s " % view
+        if last is not None:
+            q += "where file > %d " % last
+        todo = do_query(opt, q + "order by file limit ?", [at_once])
+        if not todo:
+            break
+        last = todo[-1].file
+        yield from todo
+
+
+def hash_device(opt, dev):
+    """hash_device - key and concurrency limit for hashing on dev
+
+    Partitions on the same disk share a key, so a spinning disk is only
+    ever read by one hash at a time.
+
+    Args:
+        opt (argparse namespace): options
+        dev (Dict): device from get_mntpnts()
+    Returns:
+        tuple: (key, limit)
+    """
+    key = dev.pkname or dev['maj:min']
+    # lsblk gives true/false, or "1"/"0" in older versions
+    rota = dev.rota in (True, 1, '1')
+    return key, 1 if rota else max(1, opt.hash_workers)
+
+
+def inode_key(rec):
+    """inode_key - key shared by hardlinks to the same unchanged inode
+
+    Args:
+        rec (Dict): file record
+    Returns:
+        tuple: (uuid, st_ino, st_size, st_mtime), or None if st_ino isn't
+        meaningful
+    """
+    if not rec.st_ino:
+        return None
+    return rec.uuid, rec.st_ino, rec.st_size, rec.st_mtime
+
+
+def hash_recs(opt, todo, prog):
+    """hash_recs - hash files from todo, concurrently per device
+
+    Each device gets its own thread pool, limited by hash_device(), and
+    records queue per device so a slow drive doesn't hold up the others.
+    This thread is the single writer, see hash_done().
+
+    Each inode is read once, see inode_key(), hash_done() saves its hash
+    for all its links, which then drop out of todo's later pages.  Other
+    links wait while one is hashed, and are only tried if it fails.
+
+    Args:
+        opt (argparse namespace): options
+        todo (iterable): hash_stage() records
+        prog (Dict): progress info, see hash_stage()
+    """
+    import queue
+    from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+    pools = {}  # device key -> Dict(pool, limit, running, backlog, ...)
+    pending = {}  # future -> (device, rec)
+    opt.chunk_queue = queue.Queue()  # from hash_chunks(), for save_chunk()
+    opt.chunk_read = defaultdict(int)  # file -> bytes read, see save_chunk()
+    # inode_key() -> other links waiting on the one being hashed, None
+    # once it's hashed
+    inodes = {}
+
+    def start(device):
+        while device.backlog and device.running < device.limit:
+            rec, path = device.backlog.pop(0)
+            chunks = None
+            if prog.field == 'hash' and is_chunked(opt, rec.st_size):
+                chunks = list(
+                    iter_query(
+                        opt,
+                        "select * from chunk where file = ? order by offset",
+                        [rec.file],
                     )
                 )
-                prog = now
-            try:
-                if rec.st_size > 1000000000:
-
-                    def cb(done, total=rec.st_size):
-                        print(
-                            "(%s file, %.1f%%)\r"
-                            % (hr(rec.st_size), done / total * 100),
-                            end='',
-                        )
-
-                    cb(0)
-                else:
-                    cb = None
-
-                hash_text = hash_path(
-                    os.path.join(
-                        opt.mntpnts[rec.uuid_text].mountpoint, rec.path
-                    ),
-                    callback=cb,
+            future = device.pool.submit(
+                hash_file, opt, rec, path, prog.field, chunks
+            )
+            pending[future] = device, rec
+            device.running += 1
+
+    def finish():
+        done = None
+        while not done:
+            with metrics.phase(opt.metrics, 'hash wait'):
+                done, _ = wait(
+                    list(pending), timeout=1, return_when=FIRST_COMPLETED
                 )
-                if cb:
-                    cb(rec.st_size)  # show 100%
-                    print()
-                # FIXME: may be updating hash_text here, wrong?
-                save_rec(opt, {'file': rec.file, 'hash': hash_text})
-                done += 1
-                read += rec.st_size
-                safe += rec.st_size
-                if safe > 1000000000:  # commit every GB read
-                    opt.con.commit()
-                    safe = 0
-            except FileNotFoundError:
-                print(rec.path, 'not found')
-                opt.n['offline/deleted'] += 1
-                pass
-        opt.con.commit()
+            # before the hashes, which hash_chunks() sends after chunks
+            while not opt.chunk_queue.empty():
+                save_chunk(opt, opt.chunk_queue.get())
+        for future in done:
+            device, rec = pending.pop(future)
+            device.running -= 1
+            read = hash_done(opt, rec, future, prog)
+            key = inode_key(rec)
+            if read is not None:
+                device.bytes += read
+                if key:
+                    inodes[key] = None
+            elif key:
+                # try the inode's next link, if there's one waiting
+                waiting = inodes.pop(key)
+                while waiting:
+                    if enqueue(waiting.pop(0)):
+                        inodes[key] = waiting
+                        break
+            start(device)
+
+    def enqueue(rec):
+        """queue rec on its device, False if that's not mounted"""
+        dev = get_mntpnts(opt).get(rec.uuid_text)
+        if not dev or not dev.mountpoint:
+            opt.n['offline/deleted'] += 1
+            return False
+        key, limit = hash_device(opt, dev)
+        if key not in pools:
+            pools[key] = Dict(
+                pool=ThreadPoolExecutor(limit),
+                limit=limit,
+                running=0,
+                backlog=[],
+                bytes=0,
+                start=time.perf_counter(),
+            )
+        device = pools[key]
+        path = os.path.join(dev.mountpoint, rec.path)
+        device.backlog.append((rec, path))
+        start(device)
+        return True
+
+    try:
+        for rec in todo:
+            key = inode_key(rec)
+            if key in inodes:  # another link, hashed or hashing
+                if inodes[key] is not None:
+                    inodes[key].append(rec)
+                continue
+            if enqueue(rec) and key:
+                inodes[key] = []
+            while sum(len(i.backlog) for i in pools.values()) > HASH_BACKLOG:
+                finish()
+        while pending:
+            finish()
+    finally:
+        for key, device in pools.items():
+            device.pool.shutdown()
+            metrics.add_device(
+                opt.metrics,
+                key,
+                device.bytes,
+                time.perf_counter() - device.start,
+            )
+
+
+def hash_file(opt, rec, path, field, chunks=None):
+    """hash_file - hash one file for hash_recs(), runs in a worker thread
+
+    Args:
+        opt (argparse namespace): options, only read here
+        rec (Dict): hash_stage() record
+        path (str): path to file
+        field (str): 'fingerprint' or 'hash'
+        chunks ([Row]): chunk records for file if it's hashed in chunks
+    Returns:
+        str: hex hash / fingerprint for file
+    """
+    if field == 'fingerprint':
+        with metrics.phase(opt.metrics, 'fingerprint read'):
+            return fingerprint_path(path)
+    if rec.st_size > 1000000000:
+
+        def cb(done, total=rec.st_size):
+            print(
+                "(%s file, %.1f%%)\r" % (hr(rec.st_size), done / total * 100),
+                end='',
+            )
+
+        cb(0)
+    else:
+        cb = None
+    with metrics.phase(opt.metrics, 'hash read'):
+        if chunks is not None:
+            hash_text = hash_chunks(opt, rec, path, chunks, callback=cb)
+        else:
+            hash_text = hash_path(
+                path,
+                callback=cb,
+                algo=opt.hash_algo,
+                blksize=opt.hash_block_size * 1024 * 1024,
+                use_mmap=opt.hash_mmap,
+            )
+    if cb:
+        cb(rec.st_size)  # show 100%
+        print()
+    return hash_text
+
+
+def chunk_bytes(opt):
+    """chunk_bytes - --chunk-size in bytes"""
+    return opt.chunk_size * 1024 * 1024
+
+
+def is_chunked(opt, size):
+    """is_chunked - True if a file of size bytes is hashed in chunks"""
+    return bool(opt.chunk_size) and size > chunk_bytes(opt)
+
+
+def hash_algo_name(opt, size):
+    """hash_algo_name - file.hash_algo for a file of size bytes
+
+    Hashes derived from chunk hashes depend on the chunk size, so that's
+    part of the name, e.g. sha1/64M.
+    """
+    if is_chunked(opt, size):
+        return '%s/%dM' % (opt.hash_algo, opt.chunk_size)
+    return opt.hash_algo
+
+
+def hash_chunks(opt, rec, path, chunks, callback=None):
+    """hash_chunks - hash a file in --chunk-size chunks, in a worker thread
+
+    Each chunk's hash is sent to save_chunk() through opt.chunk_queue as
+    it's done.  Chunks saved by an interrupted run, since the file's
+    last hash, for the file as it is now, aren't read again.  The file's
+    hash is the hash of its chunks' hashes.  Chunks that differ from the
+    file's previous chunk hashes are reported.
+
+    Args:
+        opt (argparse namespace): options, only read here
+        rec (Dict): hash_stage() record
+        path (str): path to file
+        chunks ([Row]): chunk records for file, by offset
+        callback (callable): called with bytes hashed so far, per chunk
+    Returns:
+        str: hex hash for file
+    """
+    size = chunk_bytes(opt)
+    blksize = min(size, opt.hash_block_size * 1024 * 1024)
+    buf = hash_buffer(blksize)
+    digests = []  # hashes of chunks so far
+    with open(path, 'rb') as data, memoryview(buf) as view:
+        stat = os.fstat(data.fileno())
+        for chunk in chunks:
+            if (
+                chunk.offset != len(digests) * size
+                or chunk.length != size
+                or chunk.hash_algo != opt.hash_algo
+                or (chunk.st_size, chunk.st_mtime)
+                != (stat.st_size, stat.st_mtime)
+                or (rec.hash_date or 0) >= chunk.hash_date
+            ):
+                break
+            digests.append(chunk.hash)
+        data.seek(len(digests) * size)
+        while True:
+            ans = HASH_ALGOS[opt.hash_algo]()
+            length = 0
+            while length < size:
+                got = data.readinto(view[: min(blksize, size - length)])
+                if not got:
+                    break
+                ans.update(view[:got])
+                length += got
+            if not length:
+                break
+            offset = len(digests) * size
+            digests.append(ans.hexdigest())
+            opt.chunk_queue.put((rec.file, offset, length, digests[-1], stat))
+            if callback:
+                callback(offset + length)
+            if length < size:
+                break
+    # drop chunks past the end of the file
+    opt.chunk_queue.put((rec.file, len(digests) * size, None, None, stat))
+
+    old = {
+        chunk.offset: chunk.hash
+        for chunk in chunks
+        if chunk.hash_algo == opt.hash_algo and chunk.length == size
+    }
+    changed = [
+        i
+        for i, digest in enumerate(digests)
+        if i * size in old and old[i * size] != digest
+    ]
+    if changed:
+        print(
+            "%s changed in chunks %s"
+            % (path, ', '.join(chunk_range(opt, i) for i in changed))
+        )
+    whole = HASH_ALGOS[opt.hash_algo]('\n'.join(digests).encode('ascii'))
+    return whole.hexdigest()
+
+
+def chunk_range(opt, i):
+    """chunk_range - text for the range of bytes chunk i covers"""
+    return "%s-%s" % (hr(i * chunk_bytes(opt)), hr((i + 1) * chunk_bytes(opt)))
+
+
+def save_chunk(opt, msg):
+    """save_chunk - save a chunk hash from hash_chunks()
+
+    Commits each chunk, so it's kept if hashing is interrupted, and
+    counts the bytes read in opt.chunk_read, so chunks kept from an
+    interrupted run don't count, see hash_done().
+
+    Args:
+        opt (argparse namespace): options
+        msg (tuple): file, offset, length, hash, os.stat_result, or
+            length None to drop chunks from offset on
+    """
+    file, offset, length, hash_text, stat = msg
+    opt.chunk_read[file] += length or 0
+    if length is None:
+        do_query(
+            opt,
+            "delete from chunk where file = ? and offset >= ?",
+            [file, offset],
+        )
+        return
+    do_query(
+        opt,
+        "insert or replace into chunk (file, offset, length, hash, hash_algo, "
+        "st_size, st_mtime, hash_date) values (?, ?, ?, ?, ?, ?, ?, ?)",
+        [
+            file,
+            offset,
+            length,
+            hash_text,
+            opt.hash_algo,
+            stat.st_size,
+            stat.st_mtime,
+            opt.run_time,
+        ],
+    )
+    commit(opt)
+
+
+def chunk_diff(opt):
+    """Show which chunks differ between two files
+
+    Args:
+        opt (argparse Namespace): options
+    """
+    chunks = []
+    for file in opt.chunk_diff:
+        rec = get_rec(opt, 'file', {'file': file})
+        if not rec:
+            raise FileKeeperError("No file %s" % file)
+        print("%s: %s %s" % (file, rec.path, hr(rec.st_size)))
+        chunks.append(
+            {
+                chunk.offset: chunk
+                for chunk in iter_query(
+                    opt, "select * from chunk where file = ?", [file]
+                )
+            }
+        )
+    differ = 0
+    for offset in sorted(set(chunks[0]) | set(chunks[1])):
+        a, b = chunks[0].get(offset), chunks[1].get(offset)
+        if a and b and (a.hash_algo, a.length) != (b.hash_algo, b.length):
+            raise FileKeeperError("Files weren't hashed with the same chunks")
+        if not a or not b or a.hash != b.hash:
+            differ += 1
+            if a and b:
+                status = 'differ'
+            else:
+                status = 'missing in %s' % opt.chunk_diff[0 if b else 1]
+            end = offset + (a or b).length
+            print("  %s-%s %s" % (hr(offset), hr(end), status))
+    total = len(set(chunks[0]) | set(chunks[1]))
+    print("%d of %d chunks differ" % (differ, total))
+
+
+def bytes_read(field, size):
+    """bytes_read - bytes read to get field for a file of size bytes"""
+    if field == 'fingerprint':
+        return min(size, FP_SAMPLE * FP_SAMPLES)
+    return size
+
+
+def hash_done(opt, rec, future, prog):
+    """hash_done - save a hash from hash_file(), report progress
+
+    Only called from the thread that owns opt.con.  Files that have gone
+    are counted as offline / deleted, and other read errors as failed,
+    rather than stopping the whole stage.  Chunks of a chunked file kept
+    from an interrupted run weren't read, so don't count as progress.
+
+    Args:
+        opt (argparse namespace): options
+        rec (Dict): hash_stage() record
+        future (Future): hash_file() job, result is the hex hash /
+            fingerprint for file
+        prog (Dict): progress info, see hash_stage()
+    Returns:
+        int: bytes read for the hash, None if it wasn't saved
+    """
+    read = bytes_read(prog.field, rec.st_size)
+    if rec.file in opt.chunk_read:  # sent by save_chunk()
+        read = opt.chunk_read.pop(rec.file)
+    try:
+        hash_text = future.result()
+    except FileNotFoundError:
+        print(rec.path, 'not found')
+        opt.n['offline/deleted'] += 1
+        return None
+    except OSError as err:
+        print(rec.path, err)
+        opt.n['hash failed'] += 1
+        return None
+    if prog.field == 'hash':
+        vals = {
+            'hash': hash_text,
+            'hash_date': opt.run_time,
+            'hash_algo': hash_algo_name(opt, rec.st_size),
+        }
+    else:
+        vals = {prog.field: hash_text}
+    key = inode_key(rec)
+    if key:
+        # all links to the inode, in one statement, counted separately
+        # as --dry-run doesn't run the update
+        where = "where uuid = ? and st_ino = ? and st_size = ? "
+        where += "and st_mtime = ? and deleted is null"
+        sets = ','.join('%s=?' % i for i in vals)
+        do_query(
+            opt,
+            "update file set %s %s" % (sets, where),
+            list(vals.values()) + list(key),
+        )
+        links = do_one(opt, "select count(*) as n from file " + where, key)
+        links = max(1, links.n)
+    else:
+        save_rec(opt, dict(file=rec.file, **vals))
+        links = 1
+    prog.done += links
+    skipped = bytes_read(prog.field, rec.st_size) - read
+    prog.total -= skipped
+    prog.read += rec.st_size * links - skipped
+    prog.physical += read
+    prog.safe += rec.st_size
+    if prog.safe > 1000000000:  # commit every GB read
+        commit(opt)
+        prog.safe = 0
+    now = time.time()
+    if now - prog.last > 5:  # every 5 seconds
+        eta = -1
+        if prog.read:
+            eta = (now - prog.start) / 60 * (prog.total / prog.read)
+        print(
+            "{}/{} ({}/{}, {} read, {:.2f}%, "
+            "{:.1f}/{:.1f} min., {}/s)".format(
+                prog.done,
+                prog.count,
+                hr(prog.read),
+                hr(prog.total),
+                hr(prog.physical),
+                prog.read / prog.total * 100 if prog.total else 100,
+                (now - prog.start) / 60,
+                eta,
+                hr(int(prog.physical / (now - prog.start))),
+            )
+        )
+        prog.last = now
+    return read
 
 
 if __name__ == '__main__':
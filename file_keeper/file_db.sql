@@ -1,3 +1,5 @@
+-- schema for new DBs, changes also need a step in MIGRATIONS in file_db.py
+
 PRAGMA foreign_keys = ON;
 
 create table uuid (    -- uuids
@@ -8,7 +10,9 @@ create table uuid (    -- uuids
     drive_size text,   -- drive size, text
     label text,        -- label
     model text,        -- drive model
-    serial text        -- drive serial
+    serial text,       -- drive serial
+    scan_gen integer,  -- number of last scan
+    dir_hash_date integer -- when dir hashes were last updated
 );
 create index idx_uuid_text on uuid (uuid_text);
 create table file (    -- files
@@ -20,10 +24,60 @@ create table file (    -- files
     st_mtime integer,  -- modification time of file
     hash text,         -- file's hash
     hash_date integer, -- date on which the file had that hash
+    hash_algo text,    -- algorithm for hash, NULL for sha1
+    scan_gen integer,  -- uuid.scan_gen of last scan that saw file
+    deleted integer,   -- when a scan found file missing, NULL if not
+    fingerprint text,  -- hash of samples of file, see fingerprint_path()
     FOREIGN KEY(uuid) REFERENCES uuid(uuid)
 );
 create index idx_file_path on file(path);
 create index idx_file_size on file(st_size);
+-- for get_pk() on every scanned file
+create index idx_file_uuid_path on file(uuid, path);
+create index idx_file_hash on file(hash);
+create index idx_file_deleted on file(deleted) where deleted is not null;
+create index idx_file_uuid_ino on file(uuid, st_ino);
+-- direct children of a directory, see PARENT in file_db.py
+create index idx_file_parent on file(uuid, rtrim(path, replace(path, '/', '')));
+create table dir (     -- directories, for incremental scans
+    dir INTEGER PRIMARY KEY,
+    uuid integer,      -- uuid of drive
+    path text,         -- path to dir, relative to mount point
+    st_ino integer,    -- inode of dir
+    st_mtime integer,  -- modification time of dir
+    n_child integer,   -- number of entries in dir
+    scan_time integer, -- when dir was last listed
+    hash text,         -- hash of contents' names and hashes
+    tree_files integer, -- number of files in subtree
+    tree_size integer, -- size of files in subtree
+    FOREIGN KEY(uuid) REFERENCES uuid(uuid)
+);
+create unique index idx_dir_uuid_path on dir(uuid, path);
+create index idx_dir_hash on dir(hash);
+create index idx_dir_parent on dir(uuid, rtrim(path, replace(path, '/', '')));
+create table chunk (   -- hashes of parts of large files, see --chunk-size
+    chunk INTEGER PRIMARY KEY,
+    file integer,      -- file chunk is part of
+    offset integer,    -- start of chunk in file
+    length integer,    -- length of chunk
+    hash text,         -- chunk's hash
+    hash_algo text,    -- algorithm for hash
+    st_size integer,   -- size of file when chunk was hashed
+    st_mtime integer,  -- modification time of file when chunk was hashed
+    hash_date integer, -- date on which the chunk had that hash
+    FOREIGN KEY(file) REFERENCES file(file)
+);
+create unique index idx_chunk_file on chunk(file, offset);
+create table run (     -- summary of each file_db.py run, see save_run()
+    run INTEGER PRIMARY KEY,
+    run_time integer,  -- start of run
+    action text,       -- 'scan', 'update_hashes', etc.
+    paths text,        -- JSON list of --path values
+    wall real,         -- seconds
+    cpu real,          -- CPU seconds, all threads
+    counters text,     -- JSON of the counters show_stats() shows
+    metrics text       -- JSON of metrics.py's timings etc.
+);
 
 -- create table hash (    -- hashes
 --     hash INTEGER PRIMARY KEY,
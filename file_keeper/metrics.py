@@ -0,0 +1,188 @@
+"""metrics.py - timing and counting for file_db.py runs
+
+Everything is kept in a plain Dict from new_metrics(), so it can be
+dumped as JSON, see as_json(), or written for Prometheus' node_exporter
+textfile collector, see as_prometheus().
+"""
+
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from addict import Dict
+
+# upper bounds, in seconds, of SQL latency histogram buckets
+SQL_BUCKETS = 0.0001, 0.001, 0.01, 0.1, 1, 10
+
+_lock = threading.Lock()  # phases can be timed in worker threads
+
+
+def new_metrics():
+    """new_metrics - empty metrics
+
+    Returns:
+        Dict: phases {name: Dict(wall, cpu, count)}, sql {kind: Dict(count,
+        sec, buckets)}, statements {kind: count}, devices {key: Dict(bytes,
+        sec)}
+    """
+    return Dict(phases={}, sql={}, statements={}, devices={})
+
+
+@contextmanager
+def phase(metrics, name):
+    """phase - time a block of code, adding to metrics.phases[name]
+
+    CPU time is for the whole process, so includes worker threads, and
+    wall time for a phase run in several threads at once is the sum of
+    each thread's time.
+
+    Args:
+        metrics (Dict): from new_metrics()
+        name (str): phase name
+    """
+    wall, cpu = time.perf_counter(), time.process_time()
+    try:
+        yield
+    finally:
+        wall = time.perf_counter() - wall
+        cpu = time.process_time() - cpu
+        with _lock:
+            rec = metrics.phases.setdefault(name, Dict(wall=0, cpu=0, count=0))
+            rec.wall += wall
+            rec.cpu += cpu
+            rec.count += 1
+
+
+def sql_kind(q):
+    """sql_kind - first word of a SQL statement, e.g. 'select'"""
+    return q.lstrip().split(None, 1)[0].lower() if q.strip() else ''
+
+
+def add_sql(metrics, q, sec):
+    """add_sql - record a SQL statement's latency
+
+    Args:
+        metrics (Dict): from new_metrics()
+        q (str): SQL
+        sec (float): seconds it took
+    """
+    rec = metrics.sql.setdefault(
+        sql_kind(q), Dict(count=0, sec=0, buckets=[0] * len(SQL_BUCKETS))
+    )
+    rec.count += 1
+    rec.sec += sec
+    for i, limit in enumerate(SQL_BUCKETS):
+        if sec <= limit:
+            rec.buckets[i] += 1
+            break
+
+
+def trace_statements(metrics, con):
+    """trace_statements - count every statement con runs, by kind
+
+    Includes statements run without add_sql(), e.g. executemany() rows
+    and commits.
+
+    Args:
+        metrics (Dict): from new_metrics()
+        con (sqlite3.Connection): connection to trace
+    """
+
+    def trace(q):
+        kind = sql_kind(q)
+        metrics.statements[kind] = metrics.statements.get(kind, 0) + 1
+
+    con.set_trace_callback(trace)
+
+
+def add_device(metrics, key, nbytes, sec):
+    """add_device - record bytes read from a device in sec seconds
+
+    Args:
+        metrics (Dict): from new_metrics()
+        key (str): device
+        nbytes (int): bytes read
+        sec (float): seconds spent
+    """
+    rec = metrics.devices.setdefault(key, Dict(bytes=0, sec=0))
+    rec.bytes += nbytes
+    rec.sec += sec
+    rec.bytes_per_sec = rec.bytes / rec.sec if rec.sec else 0
+
+
+def as_json(metrics, counters):
+    """as_json - metrics and counters as JSON text
+
+    Args:
+        metrics (Dict): from new_metrics()
+        counters (dict): other values, e.g. file_db.py's opt.n
+    Returns:
+        str: JSON
+    """
+    return json.dumps(dict(metrics.to_dict(), counters=counters), indent=4)
+
+
+def as_prometheus(metrics, counters, prefix='file_keeper'):
+    """as_prometheus - metrics and counters in Prometheus' text format
+
+    Args:
+        metrics (Dict): from new_metrics()
+        counters (dict): other values, e.g. file_db.py's opt.n
+        prefix (str): metric name prefix
+    Returns:
+        str: text exposition format
+    """
+    lines = []
+
+    def family(name, help_text, mtype='gauge'):
+        lines.append('# HELP %s_%s %s' % (prefix, name, help_text))
+        lines.append('# TYPE %s_%s %s' % (prefix, name, mtype))
+
+    def sample(metric, value, **labels):
+        label_text = ','.join(
+            '%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+            for k, v in sorted(labels.items())
+        )
+        lines.append('%s_%s{%s} %s' % (prefix, metric, label_text, value))
+
+    family('count', "Run counters")
+    for name, value in sorted(counters.items()):
+        sample('count', value, name=name)
+    family('phase_seconds', "Phase wall time")
+    family('phase_cpu_seconds', "Phase CPU time, all threads")
+    for name, rec in sorted(metrics.phases.items()):
+        sample('phase_seconds', rec.wall, phase=name)
+        sample('phase_cpu_seconds', rec.cpu, phase=name)
+    family('sql_statements', "SQL statements run")
+    for kind, count in sorted(metrics.statements.items()):
+        sample('sql_statements', count, kind=kind)
+    family('sql_seconds', "SQL latency", 'histogram')
+    for kind, rec in sorted(metrics.sql.items()):
+        total = 0
+        for limit, count in zip(SQL_BUCKETS, rec.buckets):
+            total += count
+            sample('sql_seconds_bucket', total, kind=kind, le=limit)
+        sample('sql_seconds_bucket', rec.count, kind=kind, le='+Inf')
+        sample('sql_seconds_sum', rec.sec, kind=kind)
+        sample('sql_seconds_count', rec.count, kind=kind)
+    family('device_read_bytes', "Bytes read for hashing")
+    family('device_read_bytes_per_second', "Hashing read rate")
+    for key, rec in sorted(metrics.devices.items()):
+        sample('device_read_bytes', rec.bytes, device=key)
+        sample('device_read_bytes_per_second', rec.bytes_per_sec, device=key)
+    return '\n'.join(lines) + '\n'
+
+
+def write_file(path, text):
+    """write_file - replace path with text, never leaving a partial file
+
+    Args:
+        path (str): file to write
+        text (str): content
+    """
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as out:
+        out.write(text)
+    os.replace(tmp, path)
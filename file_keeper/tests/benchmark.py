@@ -0,0 +1,285 @@
+"""
+benchmark.py - time file_db.py phases on a generated file hierarchy
+
+    cd file_keeper
+    python tests/benchmark.py --files 1000000 --output results.json \
+        --baseline last_results.json
+
+Each phase runs file_db.py in a fresh child process, so its peak RSS is
+its own, not this process's.  Results
+are JSON, with any metric worse than --thresholds or --baseline listed
+in "regressions", and a non-zero exit status.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+from mkfakefs import makebigfs
+
+# file_db.py is in the parent directory
+FILE_DB = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'file_db.py'
+)
+
+MB = 1024 * 1024
+
+# metric -> True if higher is better
+METRICS = {
+    'generate_sec': False,
+    'scan_sec': False,
+    'scan_stats_per_sec': True,
+    'scan_rss_mb': False,
+    'rescan_sec': False,
+    'hash_sec': False,
+    'hash_mb_per_sec': True,
+    'hash_rss_mb': False,
+    'list_dupes_sec': False,
+    'list_dupes_rss_mb': False,
+    'db_mb_per_million_files': False,
+}
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(
+        description="""Benchmark file_db.py""",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("--files", type=int, default=10000)
+    parser.add_argument("--dupe-pct", type=int, default=5)
+    parser.add_argument("--max-size", type=int, default=100000)
+    parser.add_argument("--sparse", type=int, default=0)
+    parser.add_argument("--hardlinks", type=int, default=0)
+    parser.add_argument("--links", type=int, default=30)
+    parser.add_argument("--symlinks", type=int, default=0)
+    parser.add_argument(
+        "--dir", help="Where to generate files, default a temp. dir."
+    )
+    parser.add_argument(
+        "--keep", action='store_true', help="Don't delete generated files"
+    )
+    parser.add_argument(
+        "--file-db-args",
+        default='',
+        help="Extra file_db.py options for all phases, e.g. '--bulk'",
+    )
+    parser.add_argument("--output", help="Save results to this JSON file")
+    parser.add_argument(
+        "--thresholds",
+        help="JSON file of {metric: {'min': x} or {'max': x}} limits",
+    )
+    parser.add_argument(
+        "--baseline", help="Results JSON from an earlier run to compare to"
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="Fraction a metric can be worse than --baseline",
+    )
+    parser.add_argument(
+        "--verbose", action='store_true', help="Show file_db.py output"
+    )
+    return parser
+
+
+def get_options(args=None):
+    """
+    get_options - use argparse to parse args, and return a
+    argparse.Namespace, possibly with some changes / expansions /
+    validations.
+
+    Client code should call this method with args as per sys.argv[1:],
+    rather than calling make_parser() directly.
+
+    Args:
+        args ([str]): arguments to parse
+
+    Returns:
+        argparse.Namespace: options with modifications / validations
+    """
+    opt = make_parser().parse_args(args)
+
+    # modifications / validations go here
+
+    return opt
+
+
+def run_phase(opt, db, args, measure=None):
+    """run_phase - run file_db.py with args in a fresh child process
+
+    The child is forked and execs file_db.py, so nothing it reports
+    comes from this process, and its peak RSS is read with wait4().
+
+    Args:
+        opt (argparse namespace): options
+        db (str): DB file
+        args ([str]): file_db.py arguments, other than --db-file
+        measure (callable): called with a connection to db and the run's
+            row from the run table, see file_db.save_run(), returns a
+            dict of extra results
+    Returns:
+        dict: sec (wall time), rss_mb (peak RSS), and measure()'s results
+    """
+    cmd = [sys.executable, FILE_DB, '--db-file', db] + args
+    cmd += opt.file_db_args.split()
+    sys.stdout.flush()
+    start = time.time()
+    pid = os.fork()
+    if pid == 0:  # child
+        try:
+            if not opt.verbose:
+                devnull = os.open(os.devnull, os.O_WRONLY)
+                os.dup2(devnull, sys.stdout.fileno())
+            os.execv(sys.executable, cmd)
+        finally:
+            os._exit(1)  # only reached if exec failed
+    _, status, rusage = os.wait4(pid, 0)
+    if status:
+        raise Exception("file_db.py %s failed" % ' '.join(args))
+    ans = {}
+    if measure:
+        con = sqlite3.connect(db)
+        con.row_factory = sqlite3.Row
+        try:
+            run = con.execute(
+                "select * from run order by run desc limit 1"
+            ).fetchone()
+            ans = measure(con, run)
+        finally:
+            con.close()
+    ans['sec'] = time.time() - start
+    ans['rss_mb'] = rusage.ru_maxrss / 1024  # KB on Linux
+    return ans
+
+
+def stated(con, run):
+    """stated - files a scan stat()ed, from its run's counters"""
+    return {'stated': json.loads(run['counters'])['stated']}
+
+
+def hashed_bytes(con, run):
+    """hashed_bytes - bytes a hashing run had to read, links counted once"""
+    return {
+        'bytes': con.execute(
+            "select coalesce(sum(st_size), 0) from (select distinct "
+            "uuid, st_ino, st_size from file where hash_date = ?)",
+            [run['run_time']],
+        ).fetchone()[0]
+    }
+
+
+def run_benchmark(opt):
+    """run_benchmark - generate files and time each phase
+
+    Args:
+        opt (argparse namespace): options
+    Returns:
+        dict: results, see METRICS
+    """
+    top = opt.dir or tempfile.mkdtemp()
+    base = os.path.join(top, 'fs')
+    db = os.path.join(top, 'bench.db')
+    res = {'options': vars(opt)}
+    try:
+        start = time.time()
+        res['made'] = makebigfs(
+            base,
+            files=opt.files,
+            dupe_pct=opt.dupe_pct,
+            size=(0, opt.max_size),
+            sparse=opt.sparse,
+            hardlinks=opt.hardlinks,
+            links=opt.links,
+            symlinks=opt.symlinks,
+        )
+        res['generate_sec'] = time.time() - start
+
+        scan = run_phase(opt, db, ['--path', base], stated)
+        res['scan_sec'] = scan['sec']
+        res['scan_stats_per_sec'] = scan['stated'] / scan['sec']
+        res['scan_rss_mb'] = scan['rss_mb']
+        res['rescan_sec'] = run_phase(opt, db, ['--path', base])['sec']
+
+        hashed = run_phase(
+            opt, db, ['--update-hashes', '--dupes-only'], hashed_bytes
+        )
+        res['hash_sec'] = hashed['sec']
+        res['hash_mb_per_sec'] = hashed['bytes'] / MB / hashed['sec']
+        res['hash_rss_mb'] = hashed['rss_mb']
+
+        dupes = run_phase(opt, db, ['--list-dupes'])
+        res['list_dupes_sec'] = dupes['sec']
+        res['list_dupes_rss_mb'] = dupes['rss_mb']
+
+        size = sum(
+            os.path.getsize(i) for i in (db, db + '-wal') if os.path.exists(i)
+        )
+        res['db_mb'] = size / MB
+        res['db_mb_per_million_files'] = (
+            res['db_mb'] / res['made']['paths'] * 1000000
+        )
+    finally:
+        if not opt.keep:
+            shutil.rmtree(top if not opt.dir else base, ignore_errors=True)
+            if opt.dir and os.path.exists(db):
+                os.unlink(db)
+    return res
+
+
+def regressions(opt, res):
+    """regressions - metrics in res worse than thresholds / baseline
+
+    Args:
+        opt (argparse namespace): options
+        res (dict): run_benchmark() results
+    Returns:
+        [str]: descriptions of regressions
+    """
+    ans = []
+    if opt.thresholds:
+        with open(opt.thresholds) as inp:
+            limits = json.load(inp)
+        for metric, limit in limits.items():
+            value = res[metric]
+            if 'min' in limit and value < limit['min']:
+                ans.append("%s %s < min %s" % (metric, value, limit['min']))
+            if 'max' in limit and value > limit['max']:
+                ans.append("%s %s > max %s" % (metric, value, limit['max']))
+    if opt.baseline:
+        with open(opt.baseline) as inp:
+            base = json.load(inp)
+        for metric, higher_better in METRICS.items():
+            if metric not in base:
+                continue
+            if higher_better:
+                worse = res[metric] < base[metric] * (1 - opt.tolerance)
+            else:
+                worse = res[metric] > base[metric] * (1 + opt.tolerance)
+            if worse:
+                ans.append(
+                    "%s %s, baseline %s" % (metric, res[metric], base[metric])
+                )
+    return ans
+
+
+def main():
+    opt = get_options()
+    res = run_benchmark(opt)
+    res['regressions'] = regressions(opt, res)
+    text = json.dumps(res, indent=4)
+    if opt.output:
+        with open(opt.output, 'w') as out:
+            out.write(text)
+    print(text)
+    if res['regressions']:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
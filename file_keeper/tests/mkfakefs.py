@@ -1,3 +1,4 @@
+import os
 from pathlib import Path
 from random import choices, randint
 import random
@@ -47,5 +48,101 @@ def makefilehier(base, seed=None, _depth=0):
             makefilehier(base.joinpath(name), seed=False, _depth=_depth + 1)
 
 
+def makebigfs(
+    base,
+    files=1000,
+    dupe_pct=DUPE_PCT,
+    size=SIZE,
+    per_dir=100,
+    sparse=0,
+    sparse_size=1000000000,
+    hardlinks=0,
+    links=30,
+    symlinks=0,
+    seed=SEED,
+):
+    """Quickly create a large file hierarchy, the same for the same args
+
+    Content comes from slices of one block of random bytes, after an
+    8 byte file number, so files (of 8 bytes or more) are only the same
+    when they're meant to be.
+
+    Args:
+        base (str): path at which to create files
+        files (int): number of regular files
+        dupe_pct (int): percent of files that also get a duplicate
+        size ((int, int)): range of sizes for regular files
+        per_dir (int): files per directory
+        sparse (int): number of sparse files of sparse_size bytes
+        sparse_size (int): size of sparse files
+        hardlinks (int): number of files to also link into each of
+            `links` snapshot directories, like rsnapshot
+        links (int): number of snapshot directories
+        symlinks (int): number of symlinks to files
+        seed (str): random.seed()
+    Returns:
+        dict: counts of what was made, 'paths' is the number of paths
+        to files, not counting symlinks
+    """
+    rnd = random.Random(seed)
+    block = rnd.randbytes(size[1] + 1)
+    base = Path(base)
+    made = dict(files=0, dupes=0, sparse=0, hardlinks=0, symlinks=0)
+    paths = []
+    dirs = set()
+
+    def write(path, data):
+        if path.parent not in dirs:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            dirs.add(path.parent)
+        with open(path, 'wb') as out:
+            out.write(data)
+
+    for file_i in range(files):
+        path = base.joinpath(
+            '%03d' % (file_i // per_dir // 1000),
+            '%03d' % (file_i // per_dir % 1000),
+            'f%07d' % file_i,
+        )
+        length = rnd.randint(*size)
+        start = rnd.randint(0, size[1] - length)
+        data = file_i.to_bytes(8, 'little')[:length]
+        data += block[start : start + length - len(data)]
+        write(path, data)
+        made['files'] += 1
+        paths.append(path)
+        if rnd.randint(0, 99) < dupe_pct:
+            write(path.with_name(path.name + 'd'), data)
+            made['dupes'] += 1
+
+    for sparse_i in range(sparse):
+        path = base.joinpath('sparse', 's%04d' % sparse_i)
+        write(path, b'')
+        with open(path, 'r+b') as out:
+            out.truncate(sparse_size)
+            # distinct first and last blocks
+            for offset in 0, sparse_size - 4096:
+                out.seek(offset)
+                out.write(sparse_i.to_bytes(8, 'little') + block[:4088])
+        made['sparse'] += 1
+
+    for snap_i in range(links if hardlinks else 0):
+        snap = base.joinpath('farm', 'snap%03d' % snap_i)
+        snap.mkdir(parents=True)
+        for path in paths[:hardlinks]:
+            os.link(path, snap.joinpath(path.name))
+            made['hardlinks'] += 1
+
+    if symlinks:
+        base.joinpath('symlinks').mkdir()
+    for link_i in range(symlinks):
+        target = paths[link_i % len(paths)]
+        os.symlink(target, base.joinpath('symlinks', 'l%07d' % link_i))
+        made['symlinks'] += 1
+
+    made['paths'] = sum(made.values()) - made['symlinks']
+    return made
+
+
 if __name__ == "__main__":
     makefilehier("testfs")
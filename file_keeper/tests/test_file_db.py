@@ -1,16 +1,24 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+
 import file_db
 import light_orm as lo
 
 import pytest
-from mkfakefs import makefilehier
+from mkfakefs import makebigfs, makefilehier
 
 from collections import namedtuple
 from addict import Dict
 
 FakeFS = namedtuple("FakeFS", "path db")
 
-# based on SEED from makefilehier.py
-GOLD = Dict(n=342, dupe_pairs=23)
+# based on SEED from makefilehier.py, one of the 23 pairs of files with
+# the same size is a coincidence, which fingerprinting skips
+GOLD = Dict(n=342, dupe_pairs=22)
 
 
 @pytest.fixture
@@ -23,6 +31,35 @@ def fakefs(tmp_path_factory):
     )
 
 
+@pytest.fixture(autouse=True)
+def devices_cache(tmp_path, monkeypatch):
+    """keep cached_devs() out of ~/.cache"""
+    path = tmp_path.joinpath("lsblk.json")
+    monkeypatch.setattr(file_db, 'DEVICES_CACHE', str(path))
+    return path
+
+
+def lsblk(*mounts):
+    """`lsblk --json` output for a disk per (UUID, mount point)"""
+    devs = []
+    for i, (uuid, mountpoint) in enumerate(mounts):
+        st_dev = os.stat(mountpoint).st_dev
+        devs.append(
+            {
+                'name': 'sd%s' % chr(ord('a') + i),
+                'uuid': uuid,
+                'label': uuid,
+                'model': 'm',
+                'serial': 's',
+                'size': '1G',
+                'rota': True,
+                'mountpoint': mountpoint,
+                'maj:min': '%d:%d' % (os.major(st_dev), os.minor(st_dev)),
+            }
+        )
+    return Dict(blockdevices=devs)
+
+
 def test_create_db(fakefs):
     "just a weak end to end test for now" ""
 
@@ -37,3 +74,665 @@ def test_create_db(fakefs):
         cur, "select count(*) as n from file where hash is not null"
     )
     assert count.n == GOLD.dupe_pairs * 2
+
+
+def test_bulk_scan(fakefs):
+    """--bulk should catalog exactly what the per-file scan does"""
+
+    opt = ['--db', fakefs.db, '--path', fakefs.path, '--bulk']
+    file_db.run_opt(file_db.get_options(opt))
+    con, cur = lo.get_con_cur(fakefs.db)
+    count = lo.do_one(cur, "select count(*) as n from file")
+    assert count.n == GOLD.n
+    # rescan finds nothing new or changed
+    file_db.run_opt(file_db.get_options(opt))
+    count = lo.do_one(cur, "select count(*) as n from file")
+    assert count.n == GOLD.n
+
+
+@pytest.mark.parametrize(
+    "walker", [['--walker', 'walk'], ['--walk-workers', '4']]
+)
+def test_walkers(fakefs, walker):
+    """all walkers should find the same files"""
+
+    opt = ['--db', fakefs.db, '--path', fakefs.path] + walker
+    file_db.run_opt(file_db.get_options(opt))
+    con, cur = lo.get_con_cur(fakefs.db)
+    count = lo.do_one(cur, "select count(*) as n from file")
+    assert count.n == GOLD.n
+
+
+def test_deleted(fakefs):
+    """files missing from a rescan are flagged, and can be forgotten"""
+
+    opt = ['--db', fakefs.db, '--path', fakefs.path]
+    file_db.run_opt(file_db.get_options(opt))
+    path, dirs, files = next(os.walk(fakefs.path))
+    os.unlink(os.path.join(path, files[0]))
+    file_db.run_opt(file_db.get_options(opt + ['--full']))
+    con, cur = lo.get_con_cur(fakefs.db)
+    count = lo.do_one(
+        cur, "select count(*) as n from file where deleted is not null"
+    )
+    assert count.n == 1
+    file_db.run_opt(file_db.get_options(opt + ['--forget-deleted']))
+    count = lo.do_one(cur, "select count(*) as n from file")
+    assert count.n == GOLD.n - 1
+
+
+def test_hardlinks(fakefs):
+    """hardlinks are hashed once, and all get the hash"""
+
+    path, dirs, files = next(os.walk(fakefs.path))
+    os.link(os.path.join(path, files[0]), os.path.join(path, 'hardlink'))
+    opt = ['--db', fakefs.db, '--path', fakefs.path]
+    file_db.run_opt(file_db.get_options(opt))
+    opt += ['--update-hashes', '--dupes-only']
+    file_db.run_opt(file_db.get_options(opt))
+    con, cur = lo.get_con_cur(fakefs.db)
+    count = lo.do_one(
+        cur,
+        "select count(*) as n, count(distinct hash) as hashes from file "
+        "where st_ino = ? and hash is not null",
+        [os.stat(os.path.join(path, 'hardlink')).st_ino],
+    )
+    assert (count.n, count.hashes) == (2, 1)
+
+
+def test_multiple_paths(fakefs):
+    """several --path roots are scanned in one run"""
+
+    path, dirs, files = next(os.walk(fakefs.path))
+    roots = [os.path.join(path, i) for i in dirs]
+    opt = ['--db', fakefs.db, '--path'] + roots
+    file_db.run_opt(file_db.get_options(opt))
+    con, cur = lo.get_con_cur(fakefs.db)
+    count = lo.do_one(cur, "select count(*) as n from file")
+    assert count.n == GOLD.n - len(files)
+    with pytest.raises(file_db.FileKeeperError):
+        opt = ['--db', fakefs.db, '--path', fakefs.path, roots[0]]
+        file_db.run_opt(file_db.get_options(opt))
+
+
+def test_makebigfs(tmp_path):
+    """makebigfs() makes what it says, links to an inode are all found"""
+
+    base = str(tmp_path.joinpath("fs"))
+    made = makebigfs(base, files=500, hardlinks=10, links=3, symlinks=5)
+    assert made['hardlinks'] == 30
+    db = str(tmp_path.joinpath("tmp.db"))
+    file_db.run_opt(file_db.get_options(['--db', db, '--path', base]))
+    con, cur = lo.get_con_cur(db)
+    count = lo.do_one(cur, "select count(*) as n from file")
+    assert count.n == made['paths']
+
+
+def test_metrics(fakefs, tmp_path):
+    """runs are summarized in the run table, metrics exported"""
+
+    json_file = str(tmp_path.joinpath("metrics.json"))
+    opt = ['--db', fakefs.db, '--path', fakefs.path]
+    file_db.run_opt(file_db.get_options(opt + ['--metrics-json', json_file]))
+    with open(json_file) as inp:
+        metrics = json.load(inp)
+    assert metrics['counters']['stated'] == GOLD.n
+    assert 'scan' in metrics['phases']
+    con, cur = lo.get_con_cur(fakefs.db)
+    run = lo.do_one(cur, "select * from run")
+    assert run.action == 'scan'
+
+
+def test_hash_devices(fakefs, monkeypatch, capsys):
+    """spinning disks get one worker, read errors and offline devices are
+    counted, and hash_date is set so --max-hash-age skips fresh hashes"""
+
+    opt = file_db.get_options(['--hash-workers', '3'])
+    dev = Dict({'maj:min': '8:1', 'pkname': 'sda', 'rota': True})
+    assert file_db.hash_device(opt, dev) == ('sda', 1)
+    dev.rota = '0'  # older lsblk
+    assert file_db.hash_device(opt, dev) == ('sda', 3)
+
+    opt = ['--db', fakefs.db, '--path', fakefs.path]
+    file_db.run_opt(file_db.get_options(opt))
+    opt += ['--update-hashes']
+    hash_path = file_db.hash_path
+
+    def failing(path, *args, **kwargs):
+        if path == unreadable:
+            raise PermissionError("denied")
+        return hash_path(path, *args, **kwargs)
+
+    path, dirs, files = next(os.walk(fakefs.path))
+    unreadable = os.path.join(path, files[0])
+    monkeypatch.setattr(file_db, 'hash_path', failing)
+    hashing = file_db.get_options(opt)
+    file_db.run_opt(hashing)
+    assert hashing.n['hash failed'] == 1
+    con, cur = lo.get_con_cur(fakefs.db)
+    count = lo.do_one(
+        cur,
+        "select count(*) as n from file where hash is not null "
+        "and hash_date = ?",
+        [hashing.run_time],
+    )
+    assert count.n == GOLD.n - 1
+    # only the failed file is still due
+    monkeypatch.setattr(file_db, 'hash_path', hash_path)
+    capsys.readouterr()
+    file_db.run_opt(file_db.get_options(opt))
+    assert capsys.readouterr().out.startswith("1 hashes to update")
+
+    monkeypatch.setattr(file_db, 'get_mntpnts', lambda opt: {})
+    hashing = file_db.get_options(opt + ['--max-hash-age', '-1'])
+    file_db.run_opt(hashing)
+    assert hashing.n['offline/deleted'] == GOLD.n
+
+
+def test_hash_algos(fakefs, tmp_path, capsys):
+    """--hash-algo / --hash-mmap give the algorithm's digest, and hashes
+    from different algorithms aren't compared"""
+
+    data = os.urandom(100000)
+    path = str(tmp_path.joinpath("data"))
+    with open(path, 'wb') as out:
+        out.write(data)
+    sha256 = hashlib.sha256(data).hexdigest()
+    for use_mmap in False, True:
+        # several blocks, and a short last one
+        assert sha256 == file_db.hash_path(
+            path, algo='sha256', blksize=4096, use_mmap=use_mmap
+        )
+
+    opt = ['--db', fakefs.db, '--path', fakefs.path]
+    file_db.run_opt(file_db.get_options(opt))
+    opt += ['--update-hashes', '--hash-algo', 'sha256', '--hash-mmap']
+    file_db.run_opt(file_db.get_options(opt))
+    con, cur = lo.get_con_cur(fakefs.db)
+    rec = lo.do_one(cur, "select * from file order by st_size desc limit 1")
+    with open(os.path.join('/', rec.path), 'rb') as inp:
+        assert rec.hash == hashlib.sha256(inp.read()).hexdigest()
+    assert rec.hash_algo == 'sha256'
+
+    recs = [
+        Dict(hash='x', hash_algo=algo, st_size=1, uuid=1, st_ino=i, path=algo)
+        for i, algo in enumerate(['sha1', 'sha256'])
+    ]
+    capsys.readouterr()
+    file_db.dupe_check(None, recs)
+    assert capsys.readouterr().out == ''
+
+
+def open_db(db):
+    """options with .con / .cur open on db, as run_opt() sets them up"""
+    opt = file_db.get_options(['--db', db])
+    opt.metrics = file_db.metrics.new_metrics()
+    opt.con, opt.cur = file_db.get_or_make_db(opt)
+    return opt
+
+
+# file_db.sql from before MIGRATIONS, see test_migrate_db()
+BASELINE_SCHEMA = """
+create table uuid (
+    uuid INTEGER PRIMARY KEY,
+    uuid_text text,
+    part_size text,
+    drive_size text,
+    label text,
+    model text,
+    serial text
+);
+create index idx_uuid_text on uuid (uuid_text);
+create table file (
+    file INTEGER PRIMARY KEY,
+    uuid integer,
+    path text,
+    st_ino integer,
+    st_size integer,
+    st_mtime integer,
+    hash text,
+    hash_date integer,
+    FOREIGN KEY(uuid) REFERENCES uuid(uuid)
+);
+create index idx_file_path on file(path);
+create index idx_file_size on file(st_size);
+"""
+
+
+def schema(cur):
+    """{table: [columns]} and index names in a DB"""
+    tables = {}
+    for (name,) in cur.execute(
+        "select name from sqlite_master where type = 'table'"
+    ).fetchall():
+        info = cur.execute("pragma table_info(%s)" % name)
+        tables[name] = sorted(i[1] for i in info)
+    indexes = cur.execute(
+        "select name from sqlite_master where type = 'index'"
+    )
+    return tables, sorted(i[0] for i in indexes)
+
+
+def test_migrate_db(tmp_path):
+    """a DB from before versioning is upgraded to file_db.sql's schema,
+    keeping its data"""
+
+    db = str(tmp_path.joinpath("old.db"))
+    con, cur = lo.get_con_cur(db)
+    con.executescript(BASELINE_SCHEMA)
+    rows = [
+        (1, 1, 'a/b', 11, 100, 1000, 'h1', 2000),
+        (2, 1, 'a/c', 12, 100, 1001, None, None),
+    ]
+    cur.execute("insert into uuid values (1, 'U1', '1G', '2G', 'L', 'm', 's')")
+    cur.executemany("insert into file values (?,?,?,?,?,?,?,?)", rows)
+    con.commit()
+    con.close()
+
+    opt = open_db(db)
+    version = opt.cur.execute("pragma user_version").fetchone()[0]
+    assert version == len(file_db.MIGRATIONS) == 8
+    fresh = open_db(str(tmp_path.joinpath("new.db")))
+    assert schema(opt.cur) == schema(fresh.cur)
+    old = "select file, uuid, path, st_ino, st_size, st_mtime, hash, "
+    old += "hash_date from file order by file"
+    assert [tuple(i) for i in opt.cur.execute(old)] == rows
+    uuid = opt.cur.execute("select uuid_text, label from uuid").fetchall()
+    assert [tuple(i) for i in uuid] == [('U1', 'L')]
+    # and the upgraded DB is usable
+    opt.cur.execute("insert into run (action) values ('scan')")
+
+
+def test_hash_todo_pages(fakefs):
+    """hash_todo() pages through more records than fit in one page"""
+
+    file_db.run_opt(
+        file_db.get_options(['--db', fakefs.db, '--path', fakefs.path])
+    )
+    opt = open_db(fakefs.db)
+    keys = [rec.file for rec in file_db.hash_todo(opt, 'file')]
+    assert GOLD.n > 300  # more than one page
+    assert keys == sorted(set(keys))
+    assert len(keys) == GOLD.n
+
+
+def test_iter_query(fakefs):
+    """iter_query() streams, and other queries run while it's consumed"""
+
+    file_db.run_opt(
+        file_db.get_options(['--db', fakefs.db, '--path', fakefs.path])
+    )
+    opt = open_db(fakefs.db)
+    rows = file_db.iter_query(opt, "select file from file order by file")
+    assert next(rows).file == 1  # a generator, nothing read yet
+    count = file_db.do_query(opt, "select count(*) as n from file")[0].n
+    assert count == GOLD.n
+    assert len(list(rows)) == GOLD.n - 1
+
+
+def test_list_dupes_last_class(tmp_path, capsys):
+    """the last (smallest) size class is checked too"""
+
+    base = tmp_path.joinpath("files")
+    base.mkdir()
+    for name, size in ('big', 100), ('small', 10):
+        for copy in 'ab':
+            base.joinpath(name + copy).write_bytes(b'x' * size)
+    opt = ['--db', str(tmp_path.joinpath("tmp.db")), '--path', str(base)]
+    file_db.run_opt(file_db.get_options(opt))
+    file_db.run_opt(file_db.get_options(opt + ['--update-hashes']))
+    capsys.readouterr()
+    file_db.run_opt(file_db.get_options(opt + ['--list-dupes']))
+    out = capsys.readouterr().out
+    for name in 'biga', 'bigb', 'smalla', 'smallb':
+        assert os.path.join(str(base), name).lstrip('/') in out
+
+
+def test_list_dupes_candidates(tmp_path, monkeypatch):
+    """only files of a shared size whose hash isn't unique reach
+    dupe_check()"""
+
+    base = tmp_path.joinpath("files")
+    base.mkdir()
+    for name, data in ('a', b'same'), ('b', b'same'), ('c', b'diff'):
+        base.joinpath(name).write_bytes(data)
+    base.joinpath("unique").write_bytes(b'unique size')
+    os.link(str(base.joinpath("a")), str(base.joinpath("a_link")))
+    opt = ['--db', str(tmp_path.joinpath("tmp.db")), '--path', str(base)]
+    file_db.run_opt(file_db.get_options(opt))
+    file_db.run_opt(file_db.get_options(opt + ['--update-hashes']))
+    checked = []
+    monkeypatch.setattr(
+        file_db,
+        'dupe_check',
+        lambda opt, todo: checked.append(
+            sorted(os.path.basename(i.path) for i in todo)
+        ),
+    )
+    file_db.run_opt(file_db.get_options(opt + ['--list-dupes']))
+    assert checked == [['a', 'a_link', 'b']]
+
+
+def test_list_dupes_probable(tmp_path, capsys):
+    """a hashed and an unhashed file with the same fingerprint are
+    probable duplicates"""
+
+    base = tmp_path.joinpath("files")
+    base.mkdir()
+    for name, data in ('a', b'same'), ('b', b'same'), ('c', b'diff'):
+        base.joinpath(name).write_bytes(data)
+    db = str(tmp_path.joinpath("tmp.db"))
+    opt = ['--db', db, '--path', str(base)]
+    file_db.run_opt(file_db.get_options(opt))
+    hash_opt = opt + ['--update-hashes', '--dupes-only']  # fingerprints
+    file_db.run_opt(file_db.get_options(hash_opt))
+    con, cur = lo.get_con_cur(db)
+    # as if b was new since the last --update-hashes
+    cur.execute("update file set hash = null where path like '%/b'")
+    con.commit()
+    capsys.readouterr()
+    file_db.run_opt(file_db.get_options(opt + ['--list-dupes']))
+    out = capsys.readouterr().out
+    assert '(probable)' in out and '(confirmed' not in out
+    for name in 'ab':
+        assert os.path.join(str(base), name).lstrip('/') in out
+    assert os.path.join(str(base), 'c').lstrip('/') not in out
+
+def test_unchanged_dirs(tmp_path, capsys):
+    """rescans skip unchanged dirs, but not changes waiting for
+    --accept-current"""
+
+    base = tmp_path.joinpath("files")
+    sub = base.joinpath("sub")
+    sub.mkdir(parents=True)
+    sub.joinpath("f").write_bytes(b'old')
+    past = time.time() - 100
+    for path in sub, base:
+        os.utime(str(path), (past, past))
+    opt = ['--db', str(tmp_path.joinpath("tmp.db")), '--path', str(base)]
+    file_db.run_opt(file_db.get_options(opt))
+    capsys.readouterr()
+    file_db.run_opt(file_db.get_options(opt))
+    assert "dirs unchanged: 2" in capsys.readouterr().out
+
+    # replace f, as editors do, which changes sub's mtime
+    sub.joinpath("new").write_bytes(b'newer')
+    os.rename(str(sub.joinpath("new")), str(sub.joinpath("f")))
+    os.utime(str(sub), (past + 50, past + 50))
+    for accept in [], [], ['--accept-current']:
+        file_db.run_opt(file_db.get_options(opt + accept))
+        assert "f changed" in capsys.readouterr().out
+    con, cur = lo.get_con_cur(str(tmp_path.joinpath("tmp.db")))
+    assert lo.do_one(cur, "select st_size from file").st_size == 5
+    file_db.run_opt(file_db.get_options(opt))
+    out = capsys.readouterr().out
+    assert "f changed" not in out
+    assert "dirs unchanged: 2" in out
+
+
+def test_deleted_unseen_dirs(tmp_path, monkeypatch):
+    """files in trusted or unreadable dirs aren't flagged, or rewritten"""
+
+    base = tmp_path.joinpath("files")
+    deep = base.joinpath("sub", "deep")
+    deep.mkdir(parents=True)
+    for path in "a", "sub/b", "sub/deep/c", "sub/deep/d":
+        base.joinpath(path).write_bytes(b'x')
+    past = time.time() - 100
+    for path in deep, deep.parent, base:
+        os.utime(str(path), (past, past))
+    db = str(tmp_path.joinpath("tmp.db"))
+    opt = ['--db', db, '--path', str(base)]
+    file_db.run_opt(file_db.get_options(opt))
+    file_db.run_opt(file_db.get_options(opt))
+    con, cur = lo.get_con_cur(db)
+    cur.execute("select scan_gen from file")
+    assert [i[0] for i in cur.fetchall()] == [1] * 4  # trusted, not stamped
+    q = "select path from file where deleted is not null"
+
+    base.joinpath("sub", "b").unlink()
+    os.utime(str(deep.parent), (past + 50, past + 50))
+    file_db.run_opt(file_db.get_options(opt))
+    deleted = cur.execute(q).fetchall()
+    assert [i[0].endswith('sub/b') for i in deleted] == [True]
+
+    scan_dir = file_db.scan_dir
+    monkeypatch.setattr(
+        file_db,
+        'scan_dir',
+        lambda path: None if path.endswith('deep') else scan_dir(path),
+    )
+    file_db.run_opt(file_db.get_options(opt + ['--full']))
+    assert cur.execute(q).fetchall() == deleted
+
+
+def test_dir_hashes(tmp_path, capsys):
+    """duplicated subtrees are listed once, and rehashed incrementally"""
+
+    base = tmp_path.joinpath("files")
+    for top in "A", "B":
+        base.joinpath(top, "sub").mkdir(parents=True)
+        base.joinpath(top, "x").write_bytes(b'x')
+        base.joinpath(top, "sub", "y").write_bytes(b'y')
+    base.joinpath("D").mkdir()
+    base.joinpath("D", "x").write_bytes(b'x')
+    past = time.time() - 200
+    for path in sorted(base.glob('**/'), reverse=True):
+        os.utime(str(path), (past, past))
+    db = str(tmp_path.joinpath("tmp.db"))
+    opt = ['--db', db, '--path', str(base)]
+
+    def dupe_dirs():
+        capsys.readouterr()
+        file_db.run_opt(file_db.get_options(opt + ['--list-dupe-dirs']))
+        out = capsys.readouterr().out.split('\n')
+        return sorted(i.rsplit('/', 1)[-1] for i in out if i[:2] == '  ')
+
+    file_db.run_opt(file_db.get_options(opt))
+    file_db.run_opt(file_db.get_options(opt + ['--update-hashes']))
+    con, cur = lo.get_con_cur(db)
+    # as if hashed and scanned a while ago
+    cur.execute("update file set hash_date = hash_date - 100")
+    cur.execute("update dir set scan_time = scan_time - 100")
+    con.commit()
+    file_db.run_opt(file_db.get_options(opt + ['--update-dir-hashes']))
+    assert dupe_dirs() == ['A', 'B']  # not A/sub, B/sub
+
+    shutil.rmtree(str(base.joinpath("B", "sub")))
+    file_db.run_opt(file_db.get_options(opt))
+    capsys.readouterr()
+    file_db.run_opt(file_db.get_options(opt + ['--update-dir-hashes']))
+    # B, files, and files' parents, not B/sub
+    todo = ": %d directories to hash" % (len(base.parts) + 1)
+    assert todo in capsys.readouterr().out
+    # B's gone subdir doesn't count
+    assert dupe_dirs() == ['B', 'D']
+
+
+def test_chunks(tmp_path, capsys):
+    """chunked hashing resumes, reports changed chunks, and --chunk-diff
+    compares files"""
+
+    mb = 1024 * 1024
+    data = bytearray(os.urandom(5 * mb // 2))  # 3 chunks of 1 MB
+    base = tmp_path.joinpath("files")
+    base.mkdir()
+    one, two = base.joinpath("one"), base.joinpath("two")
+    one.write_bytes(data)
+    data[3 * mb // 2] ^= 1  # in the second chunk
+    two.write_bytes(data)
+    db = str(tmp_path.joinpath("tmp.db"))
+    opt = ['--db', db, '--path', str(base)]
+    file_db.run_opt(file_db.get_options(opt))
+    opt += ['--chunk-size', '1']
+
+    def update_hashes(*args):
+        hashing = file_db.get_options(opt + ['--update-hashes'] + list(args))
+        file_db.run_opt(hashing)
+        return sum(i.bytes for i in hashing.metrics.devices.values())
+
+    assert update_hashes() == 2 * len(data)
+    con, cur = lo.get_con_cur(db)
+
+    def rows(q, vals=()):
+        return [tuple(i) for i in cur.execute(q, vals)]
+
+    files = rows("select file, hash from file order by path")
+    count = "select count(*) from chunk group by file order by file"
+    assert rows(count) == [(3,), (3,)]
+
+    # as if interrupted before the last chunk of one
+    cur.execute(
+        "update file set hash = null, hash_date = null where file = ?",
+        [files[0][0]],
+    )
+    cur.execute(
+        "delete from chunk where file = ? and offset = ?",
+        [files[0][0], 2 * mb],
+    )
+    con.commit()
+    assert update_hashes() == len(data) - 2 * mb
+    assert rows("select file, hash from file order by path") == files
+
+    def chunk_diff():
+        capsys.readouterr()
+        keys = [str(i[0]) for i in files]
+        file_db.run_opt(file_db.get_options(opt + ['--chunk-diff'] + keys))
+        return capsys.readouterr().out
+
+    out = chunk_diff()
+    second = "  %s-%s differ\n" % (file_db.hr(mb), file_db.hr(2 * mb))
+    assert out.endswith(second + "1 of 3 chunks differ\n")
+
+    one.write_bytes(data)  # now the same as two
+    os.utime(str(one), (1, 1))
+    capsys.readouterr()
+    update_hashes('--max-hash-age', '-1')
+    out = capsys.readouterr().out
+    assert "%s changed in chunks " % one in out
+    assert "%s changed" % two not in out
+    assert chunk_diff().endswith("0 of 3 chunks differ\n")
+
+
+def test_listing_runs(fakefs):
+    """listing actions don't write run summaries"""
+
+    opt = ['--db', fakefs.db, '--path', fakefs.path]
+    file_db.run_opt(file_db.get_options(opt))
+    for action in '--list-dupes', '--list-drives', '--list-deleted':
+        file_db.run_opt(file_db.get_options(opt + [action]))
+    con, cur = lo.get_con_cur(fakefs.db)
+    runs = [tuple(i) for i in cur.execute("select action from run")]
+    assert runs == [('scan',)]
+
+
+def test_listing_skips_devices(fakefs, monkeypatch):
+    """listing actions only read the DB, they don't look for devices"""
+
+    opt = ['--db', fakefs.db, '--path', fakefs.path]
+    file_db.run_opt(file_db.get_options(opt))
+    calls = []
+    monkeypatch.setattr(file_db, 'get_devs', lambda: calls.append(1))
+    for action in (
+        '--list-dupes',
+        '--list-files',
+        '--list-drives',
+        '--list-deleted',
+        '--list-dupe-dirs',
+    ):  # with no lsblk cache to hide a get_devs() call
+        file_db.run_opt(
+            file_db.get_options(opt + [action, '--devices-ttl', '0'])
+        )
+    assert calls == []
+
+
+def test_devices_cache(devices_cache, monkeypatch):
+    """cached_devs() reuses lsblk output until mounts change or it's
+    --devices-ttl old"""
+
+    calls = []
+    signature = ['one']
+
+    def get_devs():
+        calls.append(1)
+        return Dict(blockdevices=[dict(name='sd%d' % len(calls))])
+
+    monkeypatch.setattr(file_db, 'get_devs', get_devs)
+    monkeypatch.setattr(file_db, 'topology_signature', lambda: signature[0])
+    opt = file_db.get_options(['--devices-ttl', '60'])
+
+    def name():
+        return file_db.cached_devs(opt).blockdevices[0].name
+
+    assert (name(), name(), len(calls)) == ('sd1', 'sd1', 1)
+    assert devices_cache.exists()
+    signature[0] = 'two'  # something was mounted
+    assert (name(), name(), len(calls)) == ('sd2', 'sd2', 2)
+    cache = json.loads(devices_cache.read_text())
+    cache['time'] -= 61
+    devices_cache.write_text(json.dumps(cache))
+    assert (name(), name(), len(calls)) == ('sd3', 'sd3', 3)
+    opt.devices_ttl = 0
+    assert (name(), name(), len(calls)) == ('sd4', 'sd5', 5)
+
+
+def test_all_mounted(fakefs, monkeypatch):
+    """--all-mounted scans /, and a failed start_dev() stops its walker"""
+
+    monkeypatch.setattr(
+        file_db, 'get_devs', lambda: lsblk(('ROOT', '/'), ('FS', fakefs.path))
+    )
+    walk_files = file_db.walk_files
+    monkeypatch.setattr(  # not all of /
+        file_db,
+        'walk_files',
+        lambda opt, top: iter([]) if top == '/' else walk_files(opt, top),
+    )
+    opt = ['--db', fakefs.db, '--all-mounted', '--devices-ttl', '0']
+    file_db.run_opt(file_db.get_options(opt))
+    con, cur = lo.get_con_cur(fakefs.db)
+    count = lo.do_one(cur, "select count(*) as n from file")
+    assert count.n == GOLD.n
+    roots = [tuple(i) for i in cur.execute("select uuid_text from uuid")]
+    assert sorted(roots) == [('FS',), ('ROOT',)]
+
+    def start_dev(opt, uuid, path):
+        raise file_db.FileKeeperError("can't start")
+
+    monkeypatch.setattr(file_db, 'start_dev', start_dev)
+    threads = threading.active_count()
+    with pytest.raises(file_db.FileKeeperError):
+        file_db.run_opt(file_db.get_options(opt))
+    for wait in range(100):  # walkers end, not wait forever
+        if threading.active_count() <= threads:
+            break
+        time.sleep(0.01)
+    assert threading.active_count() <= threads
+
+
+def test_hardlink_fallback(tmp_path, monkeypatch):
+    """if one link to an inode can't be read, another one is hashed"""
+
+    base = tmp_path.joinpath("files")
+    base.mkdir()
+    base.joinpath("a").write_bytes(b'linked')
+    os.link(str(base.joinpath("a")), str(base.joinpath("b")))
+    db = str(tmp_path.joinpath("tmp.db"))
+    opt = ['--db', db, '--path', str(base)]
+    file_db.run_opt(file_db.get_options(opt))
+    failed = []
+    hash_path = file_db.hash_path
+
+    def unreadable_first(path, **kwargs):
+        if not failed:
+            failed.append(path)
+            raise PermissionError(path)
+        return hash_path(path, **kwargs)
+
+    monkeypatch.setattr(file_db, 'hash_path', unreadable_first)
+    hashing = file_db.get_options(opt + ['--update-hashes'])
+    file_db.run_opt(hashing)
+    assert hashing.n['hash failed'] == 1
+    con, cur = lo.get_con_cur(db)
+    hashes = [tuple(i) for i in cur.execute("select hash from file")]
+    assert len(hashes) == 2 and hashes[0] == hashes[1] != (None,)
@@ -0,0 +1,344 @@
+import json
+import optparse
+import os
+import struct
+from xml.etree import ElementTree as ET
+
+import pytest
+
+import devprobe
+import drivelayout
+
+# name: (maj:min, sectors, rotational, parent, dm name, slaves)
+DEVICES = {
+    'sda': ('8:0', 1953525168, '1', None, None, []),
+    'sda1': ('8:1', 1048576, None, 'sda', None, []),
+    'sda2': ('8:2', 1952474768, None, 'sda', None, []),
+    'nvme0n1': ('259:0', 500118192, '0', None, None, []),
+    'nvme0n1p1': ('259:1', 500116144, None, 'nvme0n1', None, []),
+    'dm-0': ('253:0', 1048576000, '1', None, 'vg-data', ['sda2']),
+    'sdb': ('8:16', 3907029168, '1', None, None, []),
+    'sdb1': ('8:17', 3907027120, None, 'sdb', None, []),
+}
+UUIDS = {'sda1': 'AAAA-1111', 'nvme0n1p1': 'bbbb-2222', 'dm-0': 'cccc-3333'}
+LABELS = {'sda1': 'EFI', 'dm-0': 'my data'}
+MOUNTINFO = """\
+22 1 259:1 / / rw,relatime shared:1 - ext4 /dev/nvme0n1p1 rw
+23 22 8:1 / /boot/efi rw,relatime shared:2 - vfat /dev/sda1 rw
+24 22 253:0 / /mnt/my\\040data rw,relatime shared:3 - ext4 /dev/mapper/vg-data rw
+25 22 253:0 /home /home rw,relatime shared:3 - ext4 /dev/mapper/vg-data rw
+26 22 0:5 / /proc rw - proc proc rw
+27 22 0:35 / /srv rw,relatime shared:4 - btrfs /dev/sdb1 rw,space_cache
+28 22 0:35 /@snap /snap rw,relatime shared:4 - btrfs /dev/sdb1 rw,space_cache
+"""
+
+
+def write(path, text):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as out:
+        out.write(text)
+
+
+@pytest.fixture
+def roots(tmp_path):
+    """a fake /proc, /sys, /dev, and /run/udev, laid out like the real ones"""
+    roots = devprobe.Roots(
+        proc=str(tmp_path / 'proc'),
+        sys=str(tmp_path / 'sys'),
+        dev=str(tmp_path / 'dev'),
+        udev=str(tmp_path / 'udev'),
+    )
+    block = os.path.join(roots.sys, 'class', 'block')
+    os.makedirs(block)
+    devices = os.path.join(roots.sys, 'devices', 'virtual', 'block')
+    for name, (majmin, size, rota, parent, dm_name, slaves) in DEVICES.items():
+        sysdir = os.path.join(devices, parent or '', name)
+        write(os.path.join(sysdir, 'dev'), majmin + '\n')
+        write(os.path.join(sysdir, 'size'), '%d\n' % size)
+        os.makedirs(os.path.join(sysdir, 'holders'))
+        if rota:
+            write(os.path.join(sysdir, 'queue', 'rotational'), rota + '\n')
+        if parent:
+            write(os.path.join(sysdir, 'partition'), name[-1] + '\n')
+        else:
+            write(os.path.join(sysdir, 'device', 'model'), 'Disk %s\n' % name)
+        if dm_name:
+            write(os.path.join(sysdir, 'dm', 'name'), dm_name + '\n')
+        os.symlink(sysdir, os.path.join(block, name))
+    for name, (majmin, size, rota, parent, dm_name, slaves) in DEVICES.items():
+        os.makedirs(os.path.join(block, name, 'slaves'))
+        for slave in slaves:
+            os.symlink(
+                os.path.join(block, slave),
+                os.path.join(block, name, 'slaves', slave),
+            )
+            os.symlink(
+                os.path.join(block, name),
+                os.path.join(block, slave, 'holders', name),
+            )
+    for by, names in ('by-uuid', UUIDS), ('by-label', LABELS):
+        os.makedirs(os.path.join(roots.dev, 'disk', by))
+        for name, link in names.items():
+            os.symlink(
+                '../../' + name,
+                os.path.join(
+                    roots.dev, 'disk', by, link.replace(' ', '\\x20')
+                ),
+            )
+    write(os.path.join(roots.proc, 'self', 'mountinfo'), MOUNTINFO)
+    write(
+        os.path.join(roots.udev, 'data', 'b8:2'),
+        "S:disk/by-id/x\nE:ID_FS_TYPE=LVM2_member\nE:ID_SERIAL_SHORT=S123\n",
+    )
+    return roots
+
+
+def test_probe(roots):
+    devs = devprobe.probe(roots)
+    assert sorted(devs) == sorted(DEVICES)
+    assert devs['sda']['size'] == 1953525168 * 512
+    assert devs['sda2']['parent'] == 'sda'
+    assert devs['sda2']['type'] == 'part'
+    # inherited from the disk
+    assert devs['sda2']['rotational'] and devs['sda2']['model'] == 'Disk sda'
+    assert not devs['nvme0n1p1']['rotational']
+    assert devs['sda2']['fstype'] == 'LVM2_member'  # from udev
+    assert devs['sda2']['serial'] == 'S123'
+    assert devs['dm-0']['type'] == 'lvm'
+    assert devs['dm-0']['path'].endswith('/mapper/vg-data')
+    assert devs['dm-0']['slaves'] == ['sda2']
+    assert devs['sda2']['holders'] == ['dm-0']
+    assert devs['dm-0']['label'] == 'my data'
+    assert devs['dm-0']['uuid'] == 'cccc-3333'
+    assert devs['dm-0']['mountpoints'] == ['/mnt/my data']  # not /home
+    assert devs['sda1']['fstype'] == 'vfat'  # from mountinfo
+    # btrfs's 0:N maj:min, found by source
+    assert devs['sdb1']['mountpoints'] == ['/srv']
+    assert devs['sdb1']['fstype'] == 'btrfs'
+
+
+def test_as_lsblk(roots):
+    tree = devprobe.as_lsblk(devprobe.probe(roots))['blockdevices']
+    assert sorted(i['name'] for i in tree) == ['nvme0n1', 'sda', 'sdb']
+    sda = [i for i in tree if i['name'] == 'sda'][0]
+    assert sda['size'] == '931.5G'
+    assert [i['name'] for i in sda['children']] == ['sda1', 'sda2']
+    lv = sda['children'][1]['children'][0]
+    assert (lv['name'], lv['pkname'], lv['maj:min']) == ('dm-0', 'sda2', '253:0')
+
+
+def test_stat_devs(roots):
+    devs, mntpnt = drivelayout.stat_devs(roots)
+    dev = roots.dev + '/'
+    assert mntpnt[dev + 'sda1'] == '/boot/efi'
+    assert devs[dev + 'sda'][dev + 'sda1']['LABEL'] == 'EFI'
+    assert devs[dev + 'sda'][dev + 'sda2']['TYPE'] == 'LVM2_member'
+    assert devs[dev + 'mapper/vg-data'][dev + 'mapper/vg-data']['SIZE'] == (
+        '500 Gb'
+    )
+    assert dev + 'nvme0n1' not in devs[dev + 'nvme0n1']
+
+
+def test_sizeof(roots):
+    drivelayout.SIZES.clear()
+    dev = roots.dev + '/'
+    # sizes from the probe are reused
+    drivelayout.stat_devs(roots)
+    assert drivelayout.sizeof(dev + 'sda') == 1953525168 * 512
+    # others are read from sysfs, in 512 byte sectors
+    del drivelayout.SIZES[dev + 'nvme0n1']
+    assert drivelayout.sizeof(dev + 'nvme0n1', roots) == 500118192 * 512
+    assert drivelayout.sizeof(dev + 'nothing', roots) is None
+    drivelayout.SIZES.clear()
+
+
+def test_is_mounted(roots):
+    assert drivelayout.is_mounted('/boot/efi', roots)
+    assert drivelayout.is_mounted('/mnt/my data', roots)
+    assert not drivelayout.is_mounted('/mnt', roots)
+    assert not drivelayout.is_mounted(drivelayout.TMPMP + '-sdb1', roots)
+
+
+def test_probe_cache(tmp_path, monkeypatch):
+    part = str(tmp_path / 'sdb1')
+    block = bytearray(2048)
+    struct.pack_into('<IIH', block, 1024 + 44, 100, 200, 0)
+    struct.pack_into('<H', block, 1024 + 56, drivelayout.EXT_MAGIC)
+    with open(part, 'wb') as out:
+        out.write(block)
+    devs = {'/dev/sdb': {part: {'TYPE': 'ext4', 'UUID': 'dddd-4444'}}}
+    monkeypatch.setattr(drivelayout, 'PROBE_CACHE', str(tmp_path / 'c.json'))
+    monkeypatch.setitem(drivelayout.SIZES, part, 2048)
+    mounts = []
+
+    def mount_temp(opt, part, info):
+        mounts.append(part)
+        return '/mnt/x'
+
+    monkeypatch.setattr(drivelayout, 'mount_temp', mount_temp)
+    monkeypatch.setattr(drivelayout, 'is_mounted', lambda mp: True)
+    monkeypatch.setattr(
+        drivelayout, 'mount_info', lambda mp: {'ON': mp, 'FILES': ['etc']}
+    )
+    opt = optparse.Values(
+        dict(ls=True, mount_all=False, refresh=False, cache_ttl=60)
+    )
+    assert drivelayout.fs_signature(part, devs['/dev/sdb'][part]) == [
+        'ext4', 2048, 100, 200
+    ]
+    for expect in 1, 1:  # second run is a cache hit
+        drivelayout.probe_parts(opt, devs, {})
+        assert len(mounts) == expect
+    assert devs['/dev/sdb'][part]['_:MOUNTED']['FILES'] == ['etc']
+    assert 'CACHED' in devs['/dev/sdb'][part]['_:MOUNTED']
+    opt.refresh = True
+    drivelayout.probe_parts(opt, devs, {})
+    assert len(mounts) == 2
+    opt.refresh = False
+    block[1024 + 48] = 201  # written since
+    with open(part, 'wb') as out:
+        out.write(block)
+    drivelayout.probe_parts(opt, devs, {})
+    assert len(mounts) == 3
+
+
+def test_probe_cache_no_signature(tmp_path, monkeypatch):
+    btrfs, vfat = str(tmp_path / 'sdc1'), str(tmp_path / 'sdc2')
+    block = bytearray(0x10000 + 0x50)
+    block[0x10040:0x10048] = drivelayout.BTRFS_MAGIC
+    struct.pack_into('<Q', block, 0x10048, 7)
+    for path in btrfs, vfat:
+        with open(path, 'wb') as out:
+            out.write(block)
+        monkeypatch.setitem(drivelayout.SIZES, path, len(block))
+    devs = {
+        '/dev/sdc': {
+            btrfs: {'TYPE': 'btrfs', 'UUID': 'eeee-5555'},
+            vfat: {'TYPE': 'vfat', 'UUID': 'FFFF-6666'},
+        }
+    }
+    assert drivelayout.fs_signature(btrfs, devs['/dev/sdc'][btrfs]) == [
+        'btrfs',
+        len(block),
+        7,
+    ]
+    assert drivelayout.fs_signature(vfat, devs['/dev/sdc'][vfat]) is None
+    cache = str(tmp_path / 'c.json')
+    monkeypatch.setattr(drivelayout, 'PROBE_CACHE', cache)
+    mounts = []
+
+    def mount_temp(opt, part, info):
+        mounts.append(part)
+        return '/mnt/x'
+
+    monkeypatch.setattr(drivelayout, 'mount_temp', mount_temp)
+    monkeypatch.setattr(drivelayout, 'is_mounted', lambda mp: True)
+    monkeypatch.setattr(drivelayout, 'mount_info', lambda mp: {'ON': mp})
+    opt = optparse.Values(
+        dict(ls=True, mount_all=False, refresh=False, cache_ttl=60)
+    )
+    for run in 1, 2:  # vfat is mounted every time
+        drivelayout.probe_parts(opt, devs, {})
+    assert sorted(mounts) == [btrfs, vfat, vfat]
+    with open(cache) as inp:
+        assert list(json.load(inp)) == ['eeee-5555']
+
+
+def test_probe_parts_failure(monkeypatch):
+    devs = {
+        '/dev/sdb': {
+            '/dev/sdb1': {'TYPE': 'ext4'},
+            '/dev/sdb2': {'TYPE': 'ext4'},
+        }
+    }
+    monkeypatch.setattr(
+        drivelayout, 'mount_temp', lambda opt, part, info: part + '.mp'
+    )
+    monkeypatch.setattr(drivelayout, 'is_mounted', lambda mp: True)
+
+    def mount_info(mp):
+        raise OSError(mp)
+
+    monkeypatch.setattr(drivelayout, 'mount_info', mount_info)
+    opt = optparse.Values(
+        dict(ls=True, mount_all=False, refresh=False, cache_ttl=0)
+    )
+    temp = []
+    with pytest.raises(OSError):
+        drivelayout.probe_parts(opt, devs, {}, temp)
+    assert temp  # still there to unmount
+
+
+def test_mount_temp_label(monkeypatch):
+    mounted = {}  # mount point -> source
+    monkeypatch.setattr(
+        devprobe,
+        'read_mountinfo',
+        lambda roots=None: [
+            dict(mountpoint=k, source=v) for k, v in mounted.items()
+        ],
+    )
+
+    def call(cmd, **kwargs):
+        mounted[cmd[-1]] = cmd[-2]
+        return 0
+
+    monkeypatch.setattr(drivelayout.subprocess, 'call', call)
+    monkeypatch.setattr(drivelayout.os, 'makedirs', lambda path: None)
+    monkeypatch.setattr(drivelayout, 'CLAIMED', set())
+    opt = optparse.Values(dict(mount_all=True))
+    info = {'LABEL': 'DATA'}
+    assert drivelayout.mount_temp(opt, '/dev/sdb1', info) == '/mnt/DATA'
+    assert drivelayout.mount_temp(opt, '/dev/sdc1', info) == '/mnt/DATA-sdc1'
+    assert mounted == {'/mnt/DATA': '/dev/sdb1', '/mnt/DATA-sdc1': '/dev/sdc1'}
+    drivelayout.CLAIMED.clear()  # a later run, reusing the mounts
+    assert drivelayout.mount_temp(opt, '/dev/sdb1', info) == '/mnt/DATA'
+    assert len(mounted) == 2
+
+
+def test_watch_events(roots):
+    partitions = ''.join(
+        '%s %s %d %s\n' % (tuple(info[0].split(':')) + (info[1] // 2, name))
+        for name, info in DEVICES.items()
+    )
+    write(os.path.join(roots.proc, 'partitions'), 'major minor  #blocks  '
+          'name\n\n' + partitions)
+    events = drivelayout.watch_events(roots, interval=0.01)
+    dev = roots.dev + '/'
+    added = next(events)
+    assert set(i['event'] for i in added) == {'add'}
+    assert len(added) == len(DEVICES)
+    # unmount /boot/efi
+    write(os.path.join(roots.proc, 'self', 'mountinfo'),
+          MOUNTINFO.replace('23 22 8:1 / /boot/efi', '23 22 8:1 / /x'))
+    change, = next(events)
+    assert change['event'] == 'change' and change['device'] == dev + 'sda1'
+    assert change['changes'] == {'ON': ['/boot/efi', '/x']}
+    # remove sda1
+    os.unlink(os.path.join(roots.sys, 'class', 'block', 'sda1'))
+    write(os.path.join(roots.proc, 'partitions'), partitions.replace(
+        ' sda1\n', ' gone\n'))
+    remove, = next(events)
+    assert (remove['event'], remove['device']) == ('remove', dev + 'sda1')
+    events.close()
+
+
+def test_exports(roots, tmp_path):
+    devs, mntpnt = drivelayout.stat_devs(roots)
+    opml, ndjson = str(tmp_path / 'x.opml'), str(tmp_path / 'x.ndjson')
+    opt = optparse.Values(
+        dict(summary=True, details=True, opml=opml, json=ndjson)
+    )
+    drivelayout.desc_devs(opt, devs, mntpnt)
+    body = '{%s}body' % drivelayout.OpmlExport.LEO
+    top = ET.parse(opml).find('body/outline')
+    assert top.find(body).text.startswith('LVM info')
+    efi = top.find("outline/outline[@text='%ssda1 EFI 512 Mb vfat']"
+                   % (roots.dev + '/'))
+    assert 'LABEL: EFI' in efi.find(body).text
+    with open(ndjson) as inp:
+        recs = [json.loads(line) for line in inp]
+    assert [i['record'] for i in recs] == ['host'] + ['device'] * 4
+    assert recs[1]['partitions'][roots.dev + '/mapper/vg-data']['LABEL'] == (
+        'my data'
+    )
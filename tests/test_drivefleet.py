@@ -0,0 +1,57 @@
+import json
+import os
+
+import drivefleet
+import drivelayout
+
+
+def ndjson(path, host, when, devs):
+    with open(path, 'w') as out:
+        out.write(json.dumps(dict(record='host', host=host, time=when)) + '\n')
+        for dev, parts in devs.items():
+            rec = dict(record='device', device=dev, partitions=parts)
+            out.write(json.dumps(rec) + '\n')
+
+
+def test_drivefleet(tmp_path, monkeypatch):
+    snaps = tmp_path / 'snaps'
+    snaps.mkdir()
+    disk = {'/dev/sdb1': {'UUID': 'aaaa', 'FREE': '1 Gb 5%', 'ON': '/data'}}
+    ndjson(str(snaps / 'a1.ndjson'), 'a', '2026-01-01T00:00:00',
+           {'/dev/sdb': disk})
+    ndjson(str(snaps / 'a2.ndjson'), 'a', '2026-01-02T00:00:00',
+           {'/dev/sdb': disk})  # unchanged
+    ndjson(str(snaps / 'b1.ndjson'), 'b', '2026-01-03T00:00:00',
+           {'/dev/sdc': {'/dev/sdc1': disk['/dev/sdb1']}})  # moved to b
+    # and an OPML snapshot, as drivelayout.py writes it
+    monkeypatch.setattr(drivelayout.socket, 'gethostname', lambda: 'c')
+    monkeypatch.setitem(drivelayout.SIZES, '/dev/sda', 10 ** 12)
+    export = drivelayout.OpmlExport(str(snaps / 'c.opml'))
+    export.begin('summary')
+    export.device('/dev/sda', {'/dev/sda1': {
+        'UUID': 'cccc', 'FREE': '9 Gb 50%', 'ON': '/', 'FILES': ['etc']}})
+    export.end()
+    # files that can't be read don't stop the others loading
+    (snaps / 'bad.opml').write_text('<opml><body>')
+    (snaps / 'bad.json').write_text('{"host": "d"}')
+    (snaps / 'bad.ndjson').write_text('{"record": "host"')
+
+    con = drivefleet.connect(str(tmp_path / 'fleet.db'))
+    n = drivefleet.ingest(con, [str(snaps)])
+    assert n == dict(loaded=3, unchanged=1, skipped=0, bad=3, parts=3)
+    # including the one collapsed into a1
+    again = drivefleet.ingest(con, [str(snaps)])
+    assert again == dict(loaded=0, unchanged=0, skipped=4, bad=3, parts=0)
+
+    here, there = drivefleet.where(con, 'aaaa')
+    assert (here['host'], here['part']) == ('b', '/dev/sdc1')
+    assert there['last_seen'] == '2026-01-02T00:00:00'
+    # as of each host's latest snapshot
+    assert [tuple(i)[:2] for i in drivefleet.low_free(con, 10)] == [
+        ('a', '/dev/sdb1'), ('b', '/dev/sdc1')
+    ]
+    moved, = drivefleet.moved(con)
+    assert moved['hosts'] == 'b=2026-01-03T00:00:00, a=2026-01-02T00:00:00'
+    files = con.execute("select files from part where host = 'c'").fetchone()
+    assert json.loads(files[0]) == ['etc']
+    assert os.path.exists(str(tmp_path / 'fleet.db'))